@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import typing
+from datetime import datetime
+
+import bcrypt
+from fakes import FakeDuo, FakeRedis
+
+from checkduo import checkduo
+from checkduo.duo import DuoClient, sign
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+PASSWORD = "password"  # noqa: S105
+
+
+def summarize(timings: typing.List[float]) -> dict:
+    timings = sorted(timings)
+
+    def percentile(p: float) -> float:
+        return timings[min(len(timings) - 1, int(len(timings) * p))] * 1000
+
+    return {
+        "count": len(timings),
+        "p50": percentile(0.50),
+        "p95": percentile(0.95),
+        "p99": percentile(0.99),
+        "mean": statistics.mean(timings) * 1000,
+        "throughput": len(timings) / sum(timings),
+    }
+
+
+def measure(function: typing.Callable[[int], typing.Any], iterations: int) -> dict:
+    timings = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        # one untimed call so that imports and connections do not count. for
+        # the cookie hit this is also the call that creates the session.
+        function(-1)
+
+        for i in range(iterations):
+            started = time.perf_counter()
+            function(i)
+            timings.append(time.perf_counter() - started)
+
+    return summarize(timings)
+
+
+def run_main(configuration_path: str, username: str, environment: dict) -> int:
+    sys.stdin = io.StringIO(f"{username}\n{PASSWORD}\n")
+    os.environ.update(environment)
+    return checkduo.main(configuration_path)
+
+
+def write_configuration(
+    path: str,
+    users: int,
+    cost: int,
+    redis: FakeRedis,
+    duo: FakeDuo,
+) -> None:
+    # every user shares one hash because hashing thousands of passwords at a
+    # high cost would take longer than the benchmark itself.
+    hashed = bcrypt.hashpw(PASSWORD.encode("utf-8"), bcrypt.gensalt(cost)).decode(
+        "utf-8",
+    )
+    usernames = {f"user{i}": hashed for i in range(users)}
+    usernames.update({"benchmark": hashed, "denyme": hashed})
+
+    with open(path, "wt", encoding="utf8") as f:
+        json.dump(
+            {
+                "usernames": usernames,
+                "duo": {"ikey": "ikey", "skey": "skey", "host": duo.host},
+                "cache": {
+                    "host": "127.0.0.1",
+                    "port": redis.port,
+                    "prefix": "session:",
+                },
+                "session": {"name": "session", "expiry": 3600},
+            },
+            f,
+        )
+
+
+def scenario(
+    users: int,
+    cost: int,
+    iterations: int,
+    redis: FakeRedis,
+    duo: FakeDuo,
+) -> dict:
+    results = {}
+
+    with tempfile.TemporaryDirectory() as t:
+        configuration_path = os.path.join(t, "configuration.json")
+        write_configuration(configuration_path, users, cost, redis, duo)
+        configuration = checkduo.load_configuration(configuration_path)
+        client = DuoClient(**configuration["duo"])
+
+        # the helpers on their own
+        results["load_configuration"] = measure(
+            lambda i: checkduo.load_configuration(configuration_path),
+            iterations,
+        )
+        results["load_compiled_configuration"] = measure(
+            lambda i: checkduo.load_compiled_configuration(configuration_path),
+            iterations,
+        )
+        results["is_valid_password"] = measure(
+            lambda i: checkduo.is_valid_password(
+                configuration["usernames"],
+                "benchmark",
+                PASSWORD,
+                "127.0.0.1",
+                "localhost/private",
+            ),
+            iterations,
+        )
+        results["get_cookie"] = measure(
+            lambda i: checkduo.get_cookie("other=1; session=abc123; more=2", "session"),
+            iterations,
+        )
+        results["sign"] = measure(
+            lambda i: sign(
+                "skey",
+                duo.host,
+                "/auth/v2/auth",
+                "now",
+                {"username": "benchmark"},
+            ),
+            iterations,
+        )
+        results["check_duo"] = measure(
+            lambda i: checkduo.check_duo(
+                "benchmark",
+                "127.0.0.1",
+                configuration["duo"],
+                client,
+            ),
+            iterations,
+        )
+
+        # the whole thing the way that mod_auth_external runs it
+        base = {"IP": "127.0.0.1", "HTTP_HOST": "localhost", "URI": "/private"}
+        paths = {
+            "login": ("benchmark", {"CONTEXT": "login", "COOKIE": ""}),
+            "cookie_hit": ("benchmark", {"CONTEXT": "", "COOKIE": "session=hit"}),
+            "cookie_miss_allow": (
+                "benchmark",
+                {"CONTEXT": "", "COOKIE": "session=miss{i}"},
+            ),
+            "deny": ("denyme", {"CONTEXT": "", "COOKIE": "session=deny{i}"}),
+        }
+        expected = {"login": 0, "cookie_hit": 0, "cookie_miss_allow": 0, "deny": 1}
+        for name, (username, environment) in paths.items():
+
+            def run(
+                i: int,
+                name: str = name,
+                username: str = username,
+                environment: dict = environment,
+            ) -> None:
+                # every miss needs a cookie that has never been seen before
+                environment = {
+                    k: v.format(i=f"{name}{i}") for k, v in environment.items()
+                }
+                status = run_main(configuration_path, username, {**base, **environment})
+                if status != expected[name]:
+                    raise RuntimeError(f"{name} returned {status}")
+
+            results[f"main:{name}"] = measure(run, iterations)
+
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> typing.List[str]:
+    regressions = []
+    for run, measurements in results["runs"].items():
+        for name, summary in measurements.items():
+            previous = baseline.get("runs", {}).get(run, {}).get(name)
+            if previous is None:
+                continue
+
+            change = (summary["p50"] - previous["p50"]) / previous["p50"]
+            if change > threshold:
+                regressions.append(
+                    f"{run} {name}: p50 {previous['p50']:.3f}ms -> {summary['p50']:.3f}ms ({change:+.0%})",
+                )
+    return regressions
+
+
+def main(
+    iterations: int,
+    users: typing.List[int],
+    costs: typing.List[int],
+    output: typing.Optional[str],
+    baseline: typing.Optional[str],
+    threshold: float,
+) -> int:
+    # the fake duo does not speak https
+    DuoClient.scheme = "http"
+
+    results: dict = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "iterations": iterations,
+        "runs": {},
+    }
+
+    with FakeRedis() as redis, FakeDuo() as duo:
+        for size in users:
+            for cost in costs:
+                run = f"users={size},cost={cost}"
+                print(f"running {run}", file=sys.stderr)
+                results["runs"][run] = scenario(size, cost, iterations, redis, duo)
+
+    for run, measurements in results["runs"].items():
+        print(f"\n{run}")
+        print(f"{'':40} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'per sec':>10}")
+        for name, summary in measurements.items():
+            columns = [summary[c] for c in ("p50", "p95", "p99", "throughput")]
+            print(f"{name:40} " + " ".join(f"{c:10.3f}" for c in columns))
+
+    if output is None:
+        os.makedirs(RESULTS, exist_ok=True)
+        output = os.path.join(RESULTS, f"{datetime.utcnow():%Y%m%dT%H%M%S}.json")
+    with open(output, "wt", encoding="utf8") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nwrote {output}")
+
+    if baseline is not None:
+        with open(baseline, "rt", encoding="utf8") as f:
+            regressions = compare(results, json.load(f), threshold)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            return 1
+
+    return 0
+
+
+def integers(value: str) -> typing.List[int]:
+    return [int(v) for v in value.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="bench")
+    parser.add_argument(
+        "--iterations",
+        "-n",
+        type=int,
+        default=200,
+        help="how many times to run each path",
+    )
+    parser.add_argument(
+        "--users",
+        type=integers,
+        default=[10, 10000],
+        help="comma separated sizes of the usernames table to try",
+    )
+    parser.add_argument(
+        "--costs",
+        type=integers,
+        default=[4, 10],
+        help="comma separated bcrypt costs to try",
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        default=None,
+        help="where to write the results, by default a new file in benchmarks/results",
+    )
+    parser.add_argument(
+        "--baseline",
+        "-b",
+        default=None,
+        help="a previous results file to compare against",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="how much slower a p50 can get before it counts as a regression",
+    )
+    args = parser.parse_args()
+    sys.exit(main(**vars(args)))
@@ -0,0 +1,293 @@
+import json
+import socketserver
+import threading
+import time
+import typing
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from checkduo.stores import EXTEND_SCRIPT
+
+# what is kept for each key and when it expires, if it ever does
+Entry = typing.Tuple[typing.Any, typing.Optional[float]]
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    server: "FakeRedis"
+    disable_nagle_algorithm = True
+
+    def read_command(self) -> typing.Optional[typing.List[bytes]]:
+        line = self.rfile.readline()
+        if not line:
+            return None
+
+        if not line.startswith(b"*"):
+            return line.split()  # an inline command like redis-cli sends
+
+        arguments = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            arguments.append(self.rfile.read(length + 2)[:-2])
+        return arguments
+
+    @classmethod
+    def encode(cls, value: typing.Any) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        elif isinstance(value, dict):
+            parts = [b"%%%d\r\n" % len(value)]
+            for item in value.items():
+                parts.extend(cls.encode(part) for part in item)
+            return b"".join(parts)
+        elif isinstance(value, list):
+            parts = [b"*%d\r\n" % len(value)]
+            parts.extend(cls.encode(item) for item in value)
+            return b"".join(parts)
+        elif isinstance(value, bool):
+            return b"+OK\r\n" if value else b"$-1\r\n"
+        elif isinstance(value, int):
+            return b":%d\r\n" % value
+        elif isinstance(value, Exception):
+            return b"-ERR %s\r\n" % str(value).encode("utf-8")
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def reply(self, value: typing.Any) -> None:
+        # each reply goes out in one write. several small writes would wait on
+        # delayed acks and the benchmark would be measuring this fake.
+        self.wfile.write(self.encode(value))
+
+    def handle(self) -> None:
+        while True:
+            command = self.read_command()
+            if command is None:
+                return
+
+            name = command[0].decode("utf-8").lower()
+            method = getattr(self.server, f"command_{name}", None)
+            if method is None:
+                self.reply(Exception(f"unknown command '{name}'"))
+                continue
+
+            with self.server.lock:
+                self.reply(method(*command[1:]))
+
+
+class FakeRedis(socketserver.ThreadingTCPServer):
+    # just enough of redis for checkduo to be benchmarked without a server.
+    # strings are kept as bytes and sorted sets as a dict of member to score.
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self) -> None:
+        self.data: typing.Dict[bytes, Entry] = {}
+        self.lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), FakeRedisHandler)
+
+    def __enter__(self) -> "FakeRedis":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        self.shutdown()
+        self.server_close()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def _get(self, key: bytes) -> typing.Optional[Entry]:
+        entry = self.data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return entry
+
+    def command_hello(self, *args: bytes) -> typing.Any:
+        # newer clients ask for resp3, whose replies are a superset of what
+        # we send
+        return {b"server": b"redis", b"version": b"7.2.0", b"proto": 3}
+
+    def command_ping(self, *args: bytes) -> bytes:
+        return b"PONG"
+
+    def command_select(self, db: bytes) -> bool:
+        return True
+
+    def command_exists(self, *keys: bytes) -> int:
+        return sum(1 for key in keys if self._get(key) is not None)
+
+    def command_get(self, key: bytes) -> typing.Any:
+        entry = self._get(key)
+        if entry is not None and not isinstance(entry[0], bytes):
+            return Exception("WRONGTYPE Operation against a key holding the wrong kind")
+        return None if entry is None else entry[0]
+
+    def command_pttl(self, key: bytes) -> int:
+        entry = self._get(key)
+        if entry is None:
+            return -2
+        if entry[1] is None:
+            return -1
+        return int((entry[1] - time.monotonic()) * 1000)
+
+    def command_set(self, key: bytes, value: bytes, *options: bytes) -> bool:
+        expires = None
+        names = [option.upper() for option in options]
+        if b"EX" in names:
+            expires = time.monotonic() + int(options[names.index(b"EX") + 1])
+        if b"NX" in names and self._get(key) is not None:
+            return False
+        self.data[key] = (value, expires)
+        return True
+
+    def command_expire(self, key: bytes, seconds: bytes) -> int:
+        entry = self._get(key)
+        if entry is None:
+            return 0
+        self.data[key] = (entry[0], time.monotonic() + int(seconds))
+        return 1
+
+    def command_eval(
+        self,
+        script: bytes,
+        count: bytes,
+        *arguments: bytes,
+    ) -> typing.Any:
+        # lua is not run here, the scripts that checkduo sends are done by hand
+        if script.decode("utf-8") != EXTEND_SCRIPT:
+            return Exception("unknown script")
+
+        key, seconds = arguments
+        entry = self._get(key)
+        if entry is None:
+            return 0
+
+        # a key without an expiry is given one, any other is only given longer
+        expires = time.monotonic() + int(seconds)
+        if entry[1] is not None and expires <= entry[1]:
+            return 0
+        self.data[key] = (entry[0], expires)
+        return 1
+
+    def command_del(self, *keys: bytes) -> int:
+        return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    def _members(self, key: bytes) -> typing.Dict[bytes, float]:
+        entry = self._get(key)
+        return {} if entry is None else entry[0]
+
+    def _set_members(self, key: bytes, members: typing.Dict[bytes, float]) -> None:
+        # like redis, a sorted set with nothing in it does not exist
+        entry = self._get(key)
+        if not members:
+            self.data.pop(key, None)
+        else:
+            self.data[key] = (members, None if entry is None else entry[1])
+
+    def command_zadd(self, key: bytes, *arguments: bytes) -> int:
+        members = self._members(key)
+        added = 0
+        for score, member in zip(arguments[::2], arguments[1::2]):
+            added += member not in members
+            members[member] = float(score)
+        self._set_members(key, members)
+        return added
+
+    def command_zremrangebyscore(self, key: bytes, low: bytes, high: bytes) -> int:
+        members = self._members(key)
+        removed = [
+            m for m, score in members.items() if float(low) <= score <= float(high)
+        ]
+        for member in removed:
+            del members[member]
+        self._set_members(key, members)
+        return len(removed)
+
+    def command_zrem(self, key: bytes, *removed: bytes) -> int:
+        members = self._members(key)
+        count = sum(1 for member in removed if members.pop(member, None) is not None)
+        self._set_members(key, members)
+        return count
+
+    def command_zrange(
+        self,
+        key: bytes,
+        start: bytes,
+        stop: bytes,
+        *options: bytes,
+    ) -> typing.List[bytes]:
+        ordered = sorted(
+            self._members(key).items(),
+            key=lambda item: (item[1], item[0]),
+        )
+        last = int(stop) if int(stop) >= 0 else len(ordered) + int(stop)
+        selected = ordered[int(start) : last + 1]
+        if b"WITHSCORES" not in [option.upper() for option in options]:
+            return [member for member, _ in selected]
+        return [
+            value
+            for member, score in selected
+            for value in (member, repr(score).encode("ascii"))
+        ]
+
+
+class FakeDuoHandler(BaseHTTPRequestHandler):
+    server: "FakeDuo"
+    # the headers and the body are written separately
+    disable_nagle_algorithm = True
+
+    def log_message(self, format: str, *args: typing.Any) -> None:  # noqa: A002
+        pass
+
+    def respond(self, response: dict) -> None:
+        body = json.dumps({"stat": "OK", "response": response}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:  # noqa: N802
+        length = int(self.headers.get("Content-Length", 0))
+        params = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode("utf-8")))
+
+        # users whose names start with "deny" never approve a push
+        result = "deny" if params.get("username", "").startswith("deny") else "allow"
+        time.sleep(self.server.latency)
+
+        if params.get("async") == "1":
+            with self.server.lock:
+                txid = f"tx{len(self.server.transactions)}"
+                self.server.transactions[txid] = result
+            self.respond({"txid": txid})
+        else:
+            self.respond({"result": result, "status": result, "status_msg": result})
+
+    def do_GET(self) -> None:  # noqa: N802
+        query = urllib.parse.urlparse(self.path).query
+        txid = dict(urllib.parse.parse_qsl(query)).get("txid", "")
+        with self.server.lock:
+            result = self.server.transactions.get(txid, "deny")
+        self.respond({"result": result, "status": result, "status_msg": result})
+
+
+class FakeDuo(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0) -> None:
+        self.latency = latency
+        self.transactions: typing.Dict[str, str] = {}
+        self.lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), FakeDuoHandler)
+
+    def __enter__(self) -> "FakeDuo":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        self.shutdown()
+        self.server_close()
+
+    @property
+    def host(self) -> str:
+        return f"127.0.0.1:{self.server_address[1]}"
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import json
+import os
+import random
+import subprocess  # noqa: S404
+import sys
+import tempfile
+import time
+import typing
+
+from bench import PASSWORD, summarize, write_configuration
+from fakes import FakeDuo, FakeRedis
+
+# the fake duo does not speak https so the checker is started through this
+# instead of the check-duo script. everything after that is the same code.
+CHECKER = """
+import sys
+from checkduo.duo import DuoClient
+DuoClient.scheme = "http"
+from checkduo.{module} import cli
+sys.argv[0] = "{name}"
+cli()
+"""
+
+
+# kind of traffic, username, environment, and the expected exit code
+Request = typing.Tuple[str, str, typing.Dict[str, str], int]
+
+
+class Result(typing.NamedTuple):
+    kind: str
+    seconds: float
+    status: int
+    expected: int
+    cpu: float
+    rss: int
+
+
+def spawn(
+    command: typing.List[str],
+    username: str,
+    environment: typing.Dict[str, str],
+) -> typing.Tuple[int, float, int]:
+    # this is what mod_auth_external does for every request: start the
+    # checker, write the username and password to its stdin, and wait for its
+    # exit code. wait4 gives us the cpu and memory of that one child.
+    process = subprocess.Popen(  # noqa: S603
+        command,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        env=environment,
+    )
+    stdin = typing.cast(typing.IO[bytes], process.stdin)
+    stdin.write(f"{username}\n{PASSWORD}\n".encode("utf-8"))
+    stdin.close()
+
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage.ru_utime + usage.ru_stime, usage.ru_maxrss * 1024
+
+
+def plan(
+    requests: int,
+    mix: typing.Dict[str, int],
+    storm_size: int,
+    seed: int,
+) -> typing.List[Request]:
+    # an asset storm is one new session followed straight away by every image and
+    # script on the page asking for it at the same time.
+    generator = random.Random(seed)  # noqa: S311
+    kinds = [kind for kind, weight in mix.items() for _ in range(weight)]
+
+    requests_planned: typing.List[Request] = []
+    storms = 0
+    while len(requests_planned) < requests:
+        kind = generator.choice(kinds)
+        if kind == "login":
+            requests_planned.append(
+                ("login", "benchmark", {"CONTEXT": "login", "COOKIE": ""}, 0),
+            )
+        elif kind == "cookie":
+            requests_planned.append(
+                ("cookie", "benchmark", {"CONTEXT": "", "COOKIE": "session=hit"}, 0),
+            )
+        elif kind == "deny":
+            cookie = f"session=deny{len(requests_planned)}"
+            requests_planned.append(
+                ("deny", "denyme", {"CONTEXT": "", "COOKIE": cookie}, 1),
+            )
+        elif kind == "storm":
+            storms += 1
+            cookie = f"session=storm{storms}"
+            for _ in range(storm_size):
+                requests_planned.append(
+                    ("storm", "benchmark", {"CONTEXT": "", "COOKIE": cookie}, 0),
+                )
+        else:
+            raise ValueError(f"unknown kind of traffic: {kind}")
+
+    return requests_planned[:requests]
+
+
+def run(
+    command: typing.List[str],
+    requests_planned: typing.List[Request],
+    concurrency: int,
+) -> typing.Tuple[typing.List[Result], float]:
+    base = {
+        **os.environ,
+        "IP": "127.0.0.1",
+        "HTTP_HOST": "localhost",
+        "URI": "/private",
+    }
+
+    def one(kind: str, username: str, environment: dict, expected: int) -> Result:
+        started = time.perf_counter()
+        status, cpu, rss = spawn(command, username, {**base, **environment})
+        return Result(kind, time.perf_counter() - started, status, expected, cpu, rss)
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(lambda r: one(*r), requests_planned))
+    return results, time.perf_counter() - started
+
+
+def report(
+    results: typing.List[Result],
+    elapsed: float,
+    daemon: typing.Optional[dict],
+) -> dict:
+    summary: dict = {"elapsed": elapsed, "requests": len(results), "kinds": {}}
+    for kind in sorted({r.kind for r in results} | {"all"}):
+        selected = [r for r in results if kind in ("all", r.kind)]
+        summary["kinds"][kind] = {
+            **summarize([r.seconds for r in selected]),
+            "errors": sum(1 for r in selected if r.status != r.expected),
+            "cpu_per_auth": sum(r.cpu for r in selected) / len(selected),
+            "peak_rss": max(r.rss for r in selected),
+        }
+    summary["kinds"]["all"]["throughput"] = len(results) / elapsed
+    if daemon is not None:
+        summary["daemon"] = daemon
+
+    print(
+        f"{len(results)} requests in {elapsed:.2f} seconds, {len(results) / elapsed:.1f} per second",
+    )
+    print(
+        f"{'':10} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'errors':>8} {'cpu ms':>10} {'rss MiB':>10}",
+    )
+    for kind, s in summary["kinds"].items():
+        print(
+            f"{kind:10} {s['p50']:10.2f} {s['p95']:10.2f} {s['p99']:10.2f} {s['errors']:8} "  # noqa: NIC002
+            f"{s['cpu_per_auth'] * 1000:10.2f} {s['peak_rss'] / 2**20:10.1f}",
+        )
+    if daemon is not None:
+        print(
+            f"daemon used {daemon['cpu']:.2f} cpu seconds and peaked at {daemon['peak_rss'] / 2**20:.1f} MiB",
+        )
+
+    return summary
+
+
+def main(
+    requests: int,
+    concurrency: int,
+    mix: typing.Dict[str, int],
+    storm_size: int,
+    users: int,
+    cost: int,
+    duo_latency: float,
+    daemon: bool,
+    seed: int,
+    output: typing.Optional[str],
+) -> int:
+    requests_planned = plan(requests, mix, storm_size, seed)
+
+    redis = FakeRedis()
+    duo = FakeDuo(duo_latency)
+    with redis, duo, tempfile.TemporaryDirectory() as t:
+        configuration_path = os.path.join(t, "configuration.json")
+        write_configuration(configuration_path, users, cost, redis, duo)
+
+        # every cookie hit is for a session that already exists
+        redis.data[b"session:hit"] = (b'{"username": "benchmark"}', None)
+
+        checker = [
+            sys.executable,
+            "-c",
+            CHECKER.format(module="checkduo", name="check-duo"),
+        ]
+        subprocess.run(  # noqa: S603
+            [*checker, f"--configuration-file={configuration_path}", "--compile"],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+
+        if not daemon:
+            results, elapsed = run(
+                [*checker, f"--configuration-file={configuration_path}"],
+                requests_planned,
+                concurrency,
+            )
+            summary = report(results, elapsed, None)
+        else:
+            socket_path = os.path.join(t, "check-duo.sock")
+            server = subprocess.Popen(  # noqa: S603
+                [
+                    sys.executable,
+                    "-c",
+                    CHECKER.format(module="daemon", name="check-duo-daemon"),
+                    f"--configuration-file={configuration_path}",
+                    f"--socket={socket_path}",
+                ],
+                stdout=subprocess.DEVNULL,
+            )
+            try:
+                deadline = time.monotonic() + 30
+                while not os.path.exists(socket_path):
+                    if time.monotonic() > deadline or server.poll() is not None:
+                        raise RuntimeError("the daemon did not start")
+                    time.sleep(0.05)
+
+                results, elapsed = run(
+                    [
+                        sys.executable,
+                        "-m",
+                        "checkduo.client",
+                        f"--socket={socket_path}",
+                    ],
+                    requests_planned,
+                    concurrency,
+                )
+            finally:
+                server.terminate()
+                _, _, usage = os.wait4(server.pid, 0)
+                server.returncode = 0
+
+            summary = report(
+                results,
+                elapsed,
+                {
+                    "cpu": usage.ru_utime + usage.ru_stime,
+                    "peak_rss": usage.ru_maxrss * 1024,
+                },
+            )
+
+    if output is not None:
+        with open(output, "wt", encoding="utf8") as f:
+            json.dump(summary, f, indent=2)
+
+    return 1 if summary["kinds"]["all"]["errors"] else 0
+
+
+def weights(value: str) -> typing.Dict[str, int]:
+    mix = {}
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        mix[kind.strip()] = int(weight or 1)
+    return mix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="loadtest")
+    parser.add_argument(
+        "--requests",
+        "-n",
+        type=int,
+        default=500,
+        help="how many requests to send in total",
+    )
+    parser.add_argument(
+        "--concurrency",
+        "-c",
+        type=int,
+        default=16,
+        help="how many requests to have running at once, like MaxRequestWorkers",
+    )
+    parser.add_argument(
+        "--mix",
+        type=weights,
+        default={"login": 1, "cookie": 8, "storm": 1},
+        help="comma separated weights of login, cookie, storm, and deny traffic",
+    )
+    parser.add_argument(
+        "--storm-size",
+        type=int,
+        default=20,
+        help="how many requests for one new session make up an asset storm",
+    )
+    parser.add_argument(
+        "--users",
+        type=int,
+        default=1000,
+        help="how many users to put in the configuration",
+    )
+    parser.add_argument(
+        "--cost",
+        type=int,
+        default=10,
+        help="the bcrypt cost of every password",
+    )
+    parser.add_argument(
+        "--duo-latency",
+        type=float,
+        default=0.5,
+        help="how many seconds the fake duo takes to answer a push",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="run check-duo-daemon and spawn check-duo-client instead of check-duo",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="the seed for choosing the mix of traffic so that runs are repeatable",
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        default=None,
+        help="where to write the results as json",
+    )
+    args = parser.parse_args()
+    sys.exit(main(**vars(args)))
@@ -0,0 +1,226 @@
+import json
+import queue
+import sys
+import threading
+import time
+import typing
+
+# redis is only imported by the sink that uses it
+
+# streams are named with this in front so that the one we write to can never
+# be mistaken for a session when it shares a redis with them
+AUDIT_STREAM = "audit-log:"
+
+
+class Sink:
+    def write(self, records: typing.List[dict]) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class ConsoleSink(Sink):
+    # the same lines that have always been written for mod_auth_external to
+    # put in the web server's error log
+    def write(self, records: typing.List[dict]) -> None:
+        sys.stdout.write("".join(f"{record['message']}\n" for record in records))
+        sys.stdout.flush()
+
+
+class FileSink(Sink):
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._file: typing.Optional[typing.TextIO] = None
+
+    def write(self, records: typing.List[dict]) -> None:
+        # opened on the first write so that a process that never logs anything
+        # never touches the file
+        if self._file is None:
+            self._file = open(self.path, "at", encoding="utf8")  # noqa: SIM115
+
+        self._file.write("".join(json.dumps(record) + "\n" for record in records))
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class SyslogSink(Sink):
+    # syslog is opened once for the whole process so only the sink that opened
+    # it last gets to close it
+    _current: typing.Optional["SyslogSink"] = None
+
+    def __init__(self, ident: str = "check-duo", facility: str = "auth") -> None:
+        import syslog
+
+        self.syslog = syslog
+        facility_number = getattr(syslog, f"LOG_{facility.upper()}", None)
+        if facility_number is None:
+            raise ValueError(f"unknown syslog facility: {facility}")
+        syslog.openlog(ident, syslog.LOG_PID, facility_number)
+        SyslogSink._current = self
+
+    def write(self, records: typing.List[dict]) -> None:
+        for record in records:
+            self.syslog.syslog(self.syslog.LOG_INFO, json.dumps(record))
+
+    def close(self) -> None:
+        if SyslogSink._current is self:
+            self.syslog.closelog()
+            SyslogSink._current = None
+
+
+class RedisStreamSink(Sink):
+    def __init__(
+        self,
+        stream: str = f"{AUDIT_STREAM}checkduo",
+        maxlen: int = 100000,
+        **kwargs: typing.Any,
+    ) -> None:
+        from redis import Redis
+
+        self.stream = stream
+        self.maxlen = maxlen
+        self.redis = Redis(**kwargs)
+
+    def write(self, records: typing.List[dict]) -> None:
+        # one round trip for the whole batch
+        pipeline = self.redis.pipeline(transaction=False)
+        for record in records:
+            pipeline.xadd(
+                self.stream,
+                {name: str(value) for name, value in record.items()},
+                maxlen=self.maxlen,
+                approximate=True,
+            )
+        pipeline.execute()
+
+    def close(self) -> None:
+        self.redis.close()
+
+
+class AuditLog:
+    def __init__(
+        self,
+        sinks: typing.Optional[typing.List[Sink]] = None,
+        queue_size: int = 10000,
+        batch_size: int = 256,
+        interval: float = 1,
+    ) -> None:
+        self.sinks: typing.List[Sink] = sinks if sinks is not None else [ConsoleSink()]
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dropped = 0
+
+        # events are only ever put on the queue by a request. writing them
+        # happens on a background thread in the daemon or at exit otherwise,
+        # and when the queue is full events are dropped rather than making a
+        # request wait.
+        self._queue: "queue.Queue[typing.Optional[dict]]" = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._thread: typing.Optional[threading.Thread] = None
+
+    def emit(self, event: str, message: str, **fields: typing.Any) -> None:
+        record = {"time": time.time(), "event": event, **fields, "message": message}
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                record = self._queue.get(timeout=self.interval)
+            except queue.Empty:
+                continue
+            if record is None:
+                return
+
+            batch = [record]
+            while len(batch) < self.batch_size:
+                try:
+                    record = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    self._write(batch)
+                    return
+                batch.append(record)
+
+            self._write(batch)
+
+    def _write(self, records: typing.List[dict]) -> None:
+        for sink in self.sinks:
+            try:
+                sink.write(records)
+            except Exception as e:
+                # the audit log is the only place to report this
+                print(
+                    f"could not write {len(records)} audit events to {type(sink).__name__}: {e}",
+                )
+
+    def flush(self) -> None:
+        batch = []
+        while True:
+            try:
+                record = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if record is not None:
+                batch.append(record)
+
+        if batch:
+            self._write(batch)
+
+    def close(self) -> None:
+        if self._thread is not None:
+            # the writer finishes what is ahead of this before it stops
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+        self.flush()
+        for sink in self.sinks:
+            sink.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"queued": self._queue.qsize(), "dropped": self.dropped}
+
+
+def create_audit_log(configuration: dict) -> AuditLog:
+    configuration = dict(configuration)
+
+    sinks: typing.List[Sink] = []
+    if configuration.pop("console", True):
+        sinks.append(ConsoleSink())
+    if "file" in configuration:
+        sinks.append(FileSink(**configuration.pop("file")))
+    if "syslog" in configuration:
+        sinks.append(SyslogSink(**configuration.pop("syslog")))
+    if "redis" in configuration:
+        sinks.append(RedisStreamSink(**configuration.pop("redis")))
+
+    return AuditLog(sinks, **configuration)
+
+
+def emit(
+    audit: typing.Optional[AuditLog],
+    event: str,
+    message: str,
+    **fields: typing.Any,
+) -> None:
+    # functions that are called without an audit log print like they always
+    # have
+    if audit is None:
+        print(message)
+    else:
+        audit.emit(event, message, **fields)
@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+
+import argparse
+import secrets
+import sys
+import typing
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from checkduo.checkduo import Authenticator, get_basic_credentials
+from checkduo.daemon import ReloadableServer, serve, start_authenticator
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    server: "Server"
+
+    # nginx keeps connections to an upstream open when it is told to
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: typing.Any) -> None:  # noqa: A002
+        pass  # every decision is already in the audit log
+
+    def request_environment(self) -> typing.Dict[str, str]:
+        # nginx makes the subrequest itself so the client's address and the
+        # page that they asked for have to be passed along in headers
+        return {
+            "IP": self.headers.get("X-Real-IP", self.client_address[0]),
+            "HTTP_HOST": self.headers.get("Host", ""),
+            "URI": self.headers.get("X-Original-URI", self.path),
+            "CONTEXT": "",
+            "COOKIE": self.headers.get("Cookie", ""),
+            "HTTP_USER_AGENT": self.headers.get("User-Agent", ""),
+        }
+
+    def authorize(self) -> None:
+        # a reload can swap the authenticator at any time so each request
+        # keeps using the one that it started with
+        authenticator = self.server.authenticator
+        session = authenticator.configuration["session"]
+
+        # nginx should not be sending the request body. if it does then it is
+        # never read so the connection cannot be used again.
+        if (
+            self.headers.get("Content-Length", "0") != "0"
+            or "Transfer-Encoding" in self.headers
+        ):
+            self.close_connection = True
+
+        username, password = get_basic_credentials(
+            self.headers.get("Authorization", ""),
+        )
+        environment = self.request_environment()
+
+        cookies: dict = SimpleCookie(environment["COOKIE"])
+        presented = cookies[session["name"]].value if session["name"] in cookies else ""
+
+        # there is no mod_session in front of us to give the browser a
+        # session cookie, so we give it one. a browser is never allowed to
+        # choose where its session is kept so anything that it sends which
+        # is not already a session is replaced by a cookie that we made. the
+        # new cookie is only sent back if the request is allowed.
+        issued = None
+        try:
+            if not presented or not authenticator.has_session(presented, username):
+                issued = secrets.token_urlsafe(32)
+                environment["COOKIE"] = f"{session['name']}={issued}"
+
+            status = authenticator.authenticate(username, password, environment)
+        except Exception as e:
+            print(f"could not authenticate user: {e}")
+            status = 1
+        finally:
+            authenticator.metrics.flush()
+
+        if status == 0:
+            self.send_response(200)
+            if issued is not None:
+                self.send_header(
+                    "Set-Cookie",
+                    f"{session['name']}={issued}; Max-Age={session['expiry']}; Path=/; Secure; HttpOnly; SameSite=Lax",
+                )
+        else:
+            self.send_response(401)
+            self.send_header(
+                "WWW-Authenticate",
+                f'Basic realm="{self.server.realm}", charset="UTF-8"',
+            )
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    # nginx sends the subrequest with the method of the request it is for
+    do_GET = do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = authorize  # noqa: N815
+    do_OPTIONS = authorize  # noqa: N815
+
+
+class Server(ReloadableServer, ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        authenticator: Authenticator,
+        realm: str = "check-duo",
+    ) -> None:
+        self.authenticator = authenticator
+        self.realm = realm
+        super().__init__((host, port), RequestHandler)
+
+
+def main(
+    configuration_file: str,
+    host: str,
+    port: int,
+    realm: str,
+    reload_interval: float,
+) -> int:
+    authenticator = start_authenticator(configuration_file)
+
+    with Server(host, port, authenticator, realm) as server:
+        print(f"listening for auth requests on {host}:{port}")
+        serve(server, configuration_file, reload_interval)
+
+    return 0
+
+
+def cli() -> None:
+    parser = argparse.ArgumentParser(prog="check-duo-auth-request")
+    parser.add_argument(
+        "--configuration-file",
+        "-c",
+        required=True,
+        action="store",
+        metavar="FILE",
+        help="the path to the authentication configuration",
+    )
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        action="store",
+        metavar="HOST",
+        help="the address to listen on, which only nginx should be able to reach",
+    )
+    parser.add_argument(
+        "--port",
+        "-p",
+        required=True,
+        type=int,
+        action="store",
+        metavar="PORT",
+        help="the port to listen on",
+    )
+    parser.add_argument(
+        "--realm",
+        default="check-duo",
+        action="store",
+        metavar="REALM",
+        help="the name that browsers show when asking for a username and password",
+    )
+    parser.add_argument(
+        "--reload-interval",
+        default=5.0,
+        type=float,
+        action="store",
+        metavar="SECONDS",
+        help="how often to check the configuration for changes, zero to never reload",
+    )
+    args = parser.parse_args()
+
+    try:
+        sys.exit(main(**vars(args)))
+    except Exception as exc:
+        print(f"could not start auth request server: {exc}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,166 @@
+import contextlib
+import json
+import math
+import threading
+import time
+import typing
+
+from checkduo.audit import AuditLog, emit
+from checkduo.networks import NetworkIndex
+from checkduo.stores import SessionStore, SessionStoreError
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        store: SessionStore,
+        prefix: str = "duo-circuit:",
+        window: float = 60,
+        minimum: int = 5,
+        failure_rate: float = 0.5,
+        slow: float = 10,
+        cooldown: float = 30,
+        probe_timeout: int = 60,
+        fail_open: typing.Optional[typing.List[str]] = None,
+        audit: typing.Optional[AuditLog] = None,
+    ) -> None:
+        # the state is kept in the session store so that every process, and
+        # every host that shares the store, stops asking duo at once
+        self.store = store
+        self.prefix = prefix
+        self.window = window
+        self.minimum = minimum
+        self.failure_rate = failure_rate
+        self.slow = slow
+        self.cooldown = cooldown
+        self.probe_timeout = probe_timeout
+        self.fail_open = NetworkIndex.from_networks(fail_open or [])
+        self.audit = audit
+
+        self.state = CLOSED  # the last state that we saw
+        self.trips = 0
+        self.probes = 0
+        self.fast_failures = 0
+        self._lock = threading.Lock()
+
+        # whether the request on this thread is the one seeing if duo is back
+        self._local = threading.local()
+
+    def _read(self) -> str:
+        try:
+            value = self.store.get(f"{self.prefix}state")
+        except SessionStoreError as e:
+            # a breaker that cannot be read never stops anybody asking duo
+            print(f"could not read duo circuit breaker: {e}")
+            return CLOSED
+
+        try:
+            opened = float(json.loads(value or "")["opened"])
+        except (ValueError, TypeError, KeyError):
+            return CLOSED
+        return OPEN if time.time() < opened + self.cooldown else HALF_OPEN
+
+    def _change(self, state: str, message: str) -> None:
+        with self._lock:
+            changed = state != self.state
+            self.state = state
+        if changed:
+            emit(self.audit, "circuit", message, result=state)
+
+    def allow(self) -> bool:
+        # returns false if duo is not to be asked right now. every request
+        # that is allowed must then call record or release.
+        state = self._read()
+        if state == HALF_OPEN:
+            # once the breaker has cooled down one request, across every
+            # process, is let through to see if duo has recovered
+            try:
+                probing = self.store.claim(
+                    f"{self.prefix}probe",
+                    "{}",
+                    self.probe_timeout,
+                )
+            except SessionStoreError:
+                probing = False
+
+            if probing:
+                self._local.probing = True
+                with self._lock:
+                    self.probes += 1
+                self._change(HALF_OPEN, "asking duo again to see if it has recovered")
+                return True
+
+        if state == CLOSED:
+            self._change(CLOSED, "asking duo again")
+            return True
+
+        self._change(OPEN, "not asking duo because it is failing")
+        with self._lock:
+            self.fast_failures += 1
+        return False
+
+    def release(self) -> None:
+        # an allowed request did not ask duo after all
+        if getattr(self._local, "probing", False):
+            self._local.probing = False
+            with contextlib.suppress(SessionStoreError):
+                self.store.delete(f"{self.prefix}probe")
+
+    def record(self, failed: bool) -> None:
+        # an allowed request asked duo and it either worked or it did not
+        if getattr(self._local, "probing", False):
+            self._local.probing = False
+            try:
+                if failed:
+                    self._open("duo has not recovered")
+                else:
+                    self.store.delete(f"{self.prefix}state")
+                    self._change(CLOSED, "duo has recovered")
+                self.store.delete(f"{self.prefix}probe")
+            except SessionStoreError as e:
+                print(f"could not update duo circuit breaker: {e}")
+            return
+
+        # failures are counted over fixed windows, shared by every process.
+        # a success only needs to be counted because it cannot open the
+        # breaker.
+        window = int(time.time() // self.window)
+        expiry = math.ceil(self.window * 2)
+        try:
+            calls = self.store.increment(f"{self.prefix}calls:{window}", expiry)
+            if not failed:
+                return
+            failures = self.store.increment(f"{self.prefix}failures:{window}", expiry)
+            if calls >= self.minimum and failures / calls >= self.failure_rate:
+                self._open(f"{failures} of the last {calls} requests to duo failed")
+        except SessionStoreError as e:
+            print(f"could not update duo circuit breaker: {e}")
+
+    def _open(self, reason: str) -> None:
+        with self._lock:
+            self.trips += 1
+
+        # kept long enough after cooling down to be seen as half open
+        self.store.set(
+            f"{self.prefix}state",
+            json.dumps({"opened": time.time(), "reason": reason}),
+            math.ceil(self.cooldown + self.window),
+        )
+        self._change(OPEN, f"not asking duo for {self.cooldown} seconds: {reason}")
+
+    def fails_open(self, ip_address: str) -> bool:
+        # requests from these networks are let in while duo is not asked
+        return ip_address in self.fail_open
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "trips": self.trips,
+                "probes": self.probes,
+                "fast_failures": self.fast_failures,
+            }
@@ -1,26 +1,101 @@
 #!/usr/bin/python3
 
-import argparse
+import binascii
 import hashlib
-import hmac
 import json
+import marshal
 import os
 import sys
+import tempfile
+import time
 import typing
-import urllib.parse
 from datetime import datetime
 from http.cookies import SimpleCookie
 
-import bcrypt
-import requests
-from redis import Redis
-from schema import And, Optional, Or, Schema, SchemaError, Use  # type: ignore
+from checkduo.audit import AUDIT_STREAM, AuditLog, create_audit_log, emit
+from checkduo.credentials import CredentialCache
+from checkduo.metrics import Metrics
+from checkduo.passwords import UnsupportedHash, verify_password
+
+# requests, redis, schema, the verification pool, and the password hashing
+# libraries are each imported where they are used. most invocations end with a
+# cookie check or a login and never need the duo client, and paying for every
+# import on every request adds up.
+if typing.TYPE_CHECKING:
+    from checkduo.breaker import CircuitBreaker
+    from checkduo.duo import DuoClient, DuoError
+    from checkduo.networks import NetworkIndex
+    from checkduo.pool import VerificationPool
+    from checkduo.ratelimit import RateLimiter
+    from checkduo.stores import SessionStore
 
 
 class ConfigurationError(Exception):
     pass
 
 
+# bump this whenever the shape of a validated configuration changes so that
+# snapshots written by an older version are not trusted.
+SNAPSHOT_VERSION = 1
+
+# how long a request can hold the right to ask duo for a session. this needs
+# to be longer than a duo push can take so that it is only ever reached if a
+# process dies while waiting on duo.
+PENDING_EXPIRY = 60
+
+# how often requests waiting on another request to finish with duo check for
+# the result
+PENDING_POLL_INTERVAL = 0.25
+
+# each user's sessions are indexed under a key that starts with the session
+# prefix followed by this. cookies that start with it are never accepted,
+# because a cookie like this would look up the index instead of a session.
+SESSION_INDEX = "sessions-of:"
+
+# the same goes for the duo circuit breaker, which is kept next to sessions
+CIRCUIT = "duo-circuit:"
+
+# and for recent duo approvals, which are remembered for each user on each
+# device so that a new session from the same place does not need another push
+REMEMBERED = "remembered-device:"
+
+# and for the marker held by the one request that is asking duo for a session
+PENDING = "pending-duo:"
+
+# and for the buckets that the rate limiter keeps when it shares our redis
+RATE_LIMIT = "rate-limit:"
+
+# everything that is kept next to sessions without being one, including the
+# audit stream, which can be in the same redis
+RESERVED = (SESSION_INDEX, CIRCUIT, REMEMBERED, PENDING, RATE_LIMIT, AUDIT_STREAM)
+
+# what a device can be told apart by and where each is found in a request
+DEVICE = {"ip": "IP", "user_agent": "HTTP_USER_AGENT"}
+
+# settings in the duo section that are for us rather than for the client
+DUO_SETTINGS = ("async", "async_wait", "circuit")
+
+
+def duo_client_options(configuration: dict) -> dict:
+    return {
+        name: value for name, value in configuration.items() if name not in DUO_SETTINGS
+    }
+
+
+def session_index(prefix: str, username: str) -> str:
+    return f"{prefix}{SESSION_INDEX}{username}"
+
+
+def pending_session(prefix: str, cookie: str) -> str:
+    return f"{prefix}{PENDING}{cookie}"
+
+
+def remembered_device(prefix: str, username: str, device: typing.List[str]) -> str:
+    # addresses and browsers are hashed so that they are never kept in keys
+    fingerprint = hashlib.sha256(json.dumps([username, *device]).encode("utf-8"))
+    return f"{prefix}{REMEMBERED}{fingerprint.hexdigest()}"
+
+
 def load_configuration(configuration_file: str) -> dict:
     try:
         with open(configuration_file, "rt", encoding="utf8") as f:
@@ -30,229 +105,1237 @@ def load_configuration(configuration_file: str) -> dict:
             f"could not load configuration file from {configuration_file}: {e}",
         ) from e
 
+    return validate_configuration(configuration)
+
+
+def validate_configuration(configuration: dict) -> dict:
+    import ipaddress
+
+    from schema import And, Optional, Or, Schema, SchemaError, Use  # type: ignore
+
+    from checkduo.networks import compile_networks
+
+    network: typing.Any = And(
+        str,
+        Use(str.strip),
+        lambda x: ipaddress.ip_network(x, strict=False),
+    )
+
+    # a session store on this host, usable by itself or as a fallback
+    local_cache: dict = {
+        "backend": "sqlite",
+        "path": And(str, Use(str.strip), len),
+    }
+
+    # options for every redis deployment that can have keyspace notifications
+    redis_cache: dict = {
+        Optional("prefix"): And(str, Use(str.strip), len),
+        Optional("fallback"): local_cache,
+        Optional("local"): {
+            Optional("size"): And(Use(int), lambda x: x > 0),
+            Optional("ttl"): And(Use(int), lambda x: x > 0),
+        },
+    }
+
+    # how many password checks can happen at once and how many more every
+    # second after that
+    rate_limit: dict = {
+        Optional("rate"): And(Use(float), lambda x: x > 0),
+        Optional("burst"): And(Use(int), lambda x: x >= 1),
+    }
+
     schema = Schema(
         {
             "usernames": Or(
                 {},
                 {And(str, Use(str.strip), len): Or(And(str, Use(str.strip)), None)},
             ),
+            Optional("user_directory"): {"path": And(str, Use(str.strip), len)},
+            # looked up on every new session so they are only parsed once
+            Optional("trusted_networks"): And([network], Use(compile_networks)),
             "duo": {
                 "ikey": And(str, Use(str.strip), len),
                 "skey": And(str, Use(str.strip), len),
                 "host": And(str, Use(str.strip), len),
+                Optional("connect_timeout"): And(Use(float), lambda x: x > 0),
+                Optional("timeout"): And(Use(float), lambda x: x > 0),
+                Optional("retries"): And(Use(int), lambda x: x >= 0),
+                Optional("pool_size"): And(Use(int), lambda x: x > 0),
+                Optional("async"): bool,
+                Optional("async_wait"): And(Use(float), lambda x: x > 0),
+                Optional("circuit"): {
+                    Optional("window"): And(Use(float), lambda x: x > 0),
+                    Optional("minimum"): And(Use(int), lambda x: x > 0),
+                    Optional("failure_rate"): And(Use(float), lambda x: 0 < x <= 1),
+                    Optional("slow"): And(Use(float), lambda x: x > 0),
+                    Optional("cooldown"): And(Use(float), lambda x: x > 0),
+                    Optional("fail_open"): [network],
+                },
             },
-            "session": {
-                "name": And(str, Use(str.strip), len),
-                "expiry": And(Use(int), lambda x: x >= 0),
+            "session": And(
+                {
+                    "name": And(str, Use(str.strip), len),
+                    "expiry": And(Use(int), lambda x: x >= 0),
+                    Optional("wait"): And(Use(int), lambda x: x >= 0),
+                    Optional("idle"): And(Use(int), lambda x: x > 1),
+                    Optional("refresh_interval"): And(Use(int), lambda x: x > 0),
+                    Optional("remember"): {
+                        "ttl": And(Use(int), lambda x: x > 0),
+                        Optional("match"): And([Or(*DEVICE)], len),
+                    },
+                },
+                # a session is only refreshed once it has used up more than
+                # this much of its idle time
+                lambda x: x.get("refresh_interval", 0) < x.get("idle", float("inf")),
+            ),
+            "cache": Or(
+                {
+                    Optional("backend"): "redis",
+                    "host": And(str, Use(str.strip), len),
+                    Optional("port"): And(Use(int), lambda x: x > 0),
+                    Optional("db"): And(Use(int), lambda x: 0 <= x <= 15),
+                    Optional("replicas"): [
+                        {
+                            "host": And(str, Use(str.strip), len),
+                            Optional("port"): And(Use(int), lambda x: x > 0),
+                        },
+                    ],
+                    **redis_cache,
+                },
+                {
+                    Optional("backend"): "redis",
+                    "sentinel": {
+                        "hosts": And([And(str, Use(str.strip), len)], len),
+                        "service": And(str, Use(str.strip), len),
+                    },
+                    Optional("db"): And(Use(int), lambda x: 0 <= x <= 15),
+                    Optional("read_from_replicas"): bool,
+                    **redis_cache,
+                },
+                {
+                    # keyspace notifications are only sent by the node that
+                    # has the key so sessions cannot be remembered locally
+                    Optional("backend"): "redis",
+                    "cluster": True,
+                    "host": And(str, Use(str.strip), len),
+                    Optional("port"): And(Use(int), lambda x: x > 0),
+                    Optional("read_from_replicas"): bool,
+                    Optional("prefix"): And(str, Use(str.strip), len),
+                    Optional("fallback"): local_cache,
+                },
+                {
+                    "backend": "memcached",
+                    "host": And(str, Use(str.strip), len),
+                    Optional("port"): And(Use(int), lambda x: x > 0),
+                    Optional("prefix"): And(str, Use(str.strip), len),
+                    Optional("fallback"): local_cache,
+                },
+                {
+                    **local_cache,
+                    Optional("prefix"): And(str, Use(str.strip), len),
+                },
+            ),
+            Optional("rate_limit"): {
+                Optional("ip"): rate_limit,
+                Optional("username"): rate_limit,
             },
-            "cache": {
-                "host": And(str, Use(str.strip), len),
-                Optional("port"): And(Use(int), lambda x: x > 0),
-                Optional("db"): And(Use(int), lambda x: 0 <= x <= 15),
-                Optional("prefix"): And(str, Use(str.strip), len),
+            Optional("verification"): {
+                Optional("workers"): And(Use(int), lambda x: x > 0),
+                Optional("queue_size"): And(Use(int), lambda x: x > 0),
+                Optional("timeout"): And(Use(float), lambda x: x > 0),
+            },
+            Optional("password_cache"): {
+                Optional("size"): And(Use(int), lambda x: x >= 0),
+                Optional("ttl"): And(Use(int), lambda x: x >= 0),
+                Optional("failure_ttl"): And(Use(int), lambda x: x >= 0),
+            },
+            Optional("audit"): {
+                Optional("console"): bool,
+                Optional("queue_size"): And(Use(int), lambda x: x > 0),
+                Optional("batch_size"): And(Use(int), lambda x: x > 0),
+                Optional("file"): {"path": And(str, Use(str.strip), len)},
+                Optional("syslog"): {
+                    Optional("ident"): And(str, Use(str.strip), len),
+                    Optional("facility"): And(str, Use(str.strip), len),
+                },
+                Optional("redis"): {
+                    "host": And(str, Use(str.strip), len),
+                    Optional("port"): And(Use(int), lambda x: x > 0),
+                    Optional("db"): And(Use(int), lambda x: 0 <= x <= 15),
+                    Optional("stream"): And(
+                        str,
+                        Use(str.strip),
+                        lambda x: x.startswith(AUDIT_STREAM) and x != AUDIT_STREAM,
+                    ),
+                    Optional("maxlen"): And(Use(int), lambda x: x > 0),
+                },
+            },
+            Optional("metrics"): {
+                Optional("prometheus"): {
+                    Optional("host"): And(str, Use(str.strip), len),
+                    "port": And(Use(int), lambda x: x > 0),
+                },
+                Optional("statsd"): {
+                    Optional("host"): And(str, Use(str.strip), len),
+                    Optional("port"): And(Use(int), lambda x: x > 0),
+                    Optional("prefix"): And(str, Use(str.strip), len),
+                },
             },
         },
     )
 
+    # users can be kept entirely in a user directory instead
+    if "user_directory" in configuration:
+        configuration = {"usernames": {}, **configuration}
+
     try:
         return schema.validate(configuration)
     except SchemaError as e:
         raise ConfigurationError from e
 
 
-def sign(skey: str, host: str, path: str, date: str, params: dict) -> str:
-    canonical_params = []
-    for key, value in sorted(
-        (urllib.parse.quote(key, "~"), urllib.parse.quote(value, "~"))
-        for (key, value) in list(params.items())
-    ):
-        canonical_params.append(f"{key}={value}")
-
-    parts = [
-        date,
-        "POST",
-        host.lower(),
-        path,
-        "&".join(canonical_params),
-    ]
-
-    sig = hmac.new(skey.encode("utf-8"), "\n".join(parts).encode("utf-8"), hashlib.sha1)
-    return sig.hexdigest()
-
-
-def check_duo(username: str, ip_address: str, configuration: dict) -> bool:
-    ikey = configuration["ikey"]
-    skey = configuration["skey"]
-    host = configuration["host"]
-
-    now = datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S -0000")
-    request_path = "/auth/v2/auth"
-    request_headers = {"Date": now}
-    request_data = {
-        "username": username,
-        "factor": "auto",
-        "device": "auto",
-        "ipaddr": ip_address,
-        "pushinfo": f"IP={ip_address}",
+def snapshot_path(configuration_file: str) -> str:
+    return f"{configuration_file}.compiled"
+
+
+def _build_snapshot(configuration_file: str) -> dict:
+    try:
+        with open(configuration_file, "rb") as f:
+            source = os.fstat(f.fileno())
+            data = f.read()
+        configuration = json.loads(data)
+    except (IOError, ValueError) as e:
+        raise ConfigurationError(
+            f"could not load configuration file from {configuration_file}: {e}",
+        ) from e
+
+    return {
+        "version": SNAPSHOT_VERSION,
+        "module": _module_signature(),
+        "mtime": source.st_mtime_ns,
+        "size": source.st_size,
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "configuration": validate_configuration(configuration),
     }
 
-    r = requests.post(
-        f"https://{host}{request_path}",
-        headers=request_headers,
-        data=request_data,
-        auth=(ikey, sign(skey, host, request_path, now, request_data)),
-        timeout=30,
+
+def _write_snapshot(configuration_file: str, snapshot: dict) -> None:
+    # write the snapshot atomically. mkstemp creates the file readable only
+    # by us which is important because the configuration is full of secrets.
+    path = snapshot_path(configuration_file)
+    fd, temporary_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".",
+        prefix=".checkduo-",
     )
     try:
-        data = r.json()
-    except json.JSONDecodeError as e:
-        print(f"unable to parse duo response: {e}")
-        return False
+        with os.fdopen(fd, "wb") as f:
+            marshal.dump(snapshot, f)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
 
-    if r.status_code != 200:
-        print(
-            f"received {r.status_code} from duo: {data['message']}, {data['message_detail']}",
-        )
-        return False
 
-    response = data.get("response")
-    if response is None:
-        print("empty response from duo")
-        return False
+def compile_configuration(configuration_file: str) -> dict:
+    snapshot = _build_snapshot(configuration_file)
+    _write_snapshot(configuration_file, snapshot)
+    return snapshot["configuration"]
+
+
+def load_compiled_configuration(configuration_file: str) -> dict:
+    try:
+        source = os.stat(configuration_file)
+        with open(snapshot_path(configuration_file), "rb") as f:
+            # only trust a snapshot that nobody else could have written
+            owner = os.fstat(f.fileno())
+            if owner.st_uid != source.st_uid or owner.st_mode & 0o022:
+                raise ValueError("snapshot has unsafe ownership or permissions")
+            snapshot = marshal.load(f)  # noqa: S302
+
+        if (
+            snapshot["version"] == SNAPSHOT_VERSION
+            and snapshot["module"] == _module_signature()
+        ):
+            # the common case is that nothing has touched the file
+            if (
+                snapshot["mtime"] == source.st_mtime_ns
+                and snapshot["size"] == source.st_size
+            ):
+                return snapshot["configuration"]
+
+            # the file was touched but maybe not changed
+            if snapshot["size"] == source.st_size:
+                with open(configuration_file, "rb") as f:
+                    if hashlib.sha256(f.read()).hexdigest() == snapshot["sha256"]:
+                        return snapshot["configuration"]
+    except (OSError, EOFError, ValueError, TypeError, KeyError):
+        pass  # missing, unreadable, or corrupt snapshots are just rebuilt
+
+    # the snapshot is missing or out of date so validate the configuration the
+    # slow way and try to leave a snapshot behind for the next request.
+    snapshot = _build_snapshot(configuration_file)
+    try:
+        _write_snapshot(configuration_file, snapshot)
+    except OSError as e:
+        print(f"could not write configuration snapshot: {e}")
+    return snapshot["configuration"]
+
+
+def _module_signature() -> typing.Tuple[int, int]:
+    # upgrading checkduo can change what a validated configuration looks like
+    source = os.stat(__file__)
+    return source.st_mtime_ns, source.st_size
+
+
+def load_usernames(configuration: dict) -> typing.Mapping[str, typing.Optional[str]]:
+    if "user_directory" not in configuration:
+        return configuration["usernames"]
+
+    # users listed in the configuration come first so that a few accounts can
+    # be added or changed without rebuilding the directory.
+    from checkduo.users import UserDirectory
+
+    return UserDirectory(
+        configuration["user_directory"]["path"],
+        overrides=configuration["usernames"],
+    )
+
 
-    return response.get("result", "deny") == "allow"
+def record_duo_error(
+    breaker: typing.Optional["CircuitBreaker"],
+    error: "DuoError",
+) -> None:
+    from checkduo.duo import DuoReadTimeout, DuoUnavailable
 
+    if breaker is None:
+        return
 
-def get_cookie(cookies: str, cookie_name: str) -> typing.Optional[str]:
+    # a push that the user has not answered yet says nothing about duo, and
+    # an error that duo sent back means that it is up
+    if isinstance(error, DuoReadTimeout):
+        breaker.release()
+    else:
+        breaker.record(failed=isinstance(error, DuoUnavailable))
+
+
+def check_duo(
+    username: str,
+    ip_address: str,
+    configuration: dict,
+    client: typing.Optional["DuoClient"] = None,
+    metrics: typing.Optional[Metrics] = None,
+    audit: typing.Optional[AuditLog] = None,
+    breaker: typing.Optional["CircuitBreaker"] = None,
+) -> bool:
+    from checkduo.duo import DuoClient, DuoError, DuoTimeout
+
+    if client is None:
+        client = DuoClient(**duo_client_options(configuration))
+
+    with (metrics if metrics is not None else Metrics()).timer("duo") as timer:
+        try:
+            allowed = client.auth(username, ip_address)
+        except DuoError as e:
+            # how long this took is not recorded because it is mostly how
+            # long the user took to answer
+            record_duo_error(breaker, e)
+            timer.outcome = "timeout" if isinstance(e, DuoTimeout) else "error"
+            emit(
+                audit,
+                "second_factor",
+                str(e),
+                result=timer.outcome,
+                username=username,
+                ip=ip_address,
+            )
+            return False
+
+        if breaker is not None:
+            breaker.record(failed=False)
+        timer.outcome = "allow" if allowed else "deny"
+        return allowed
+
+
+def get_cookie(
+    cookies: str,
+    cookie_name: str,
+    audit: typing.Optional[AuditLog] = None,
+) -> typing.Optional[str]:
     parsed_cookies: dict = SimpleCookie(cookies)
     if cookie_name not in parsed_cookies:
-        print(f"no cookie named {cookie_name} found in cookies")
+        emit(
+            audit,
+            "cookie",
+            f"no cookie named {cookie_name} found in cookies",
+            result="missing",
+            cookie=cookie_name,
+        )
+        return None
+
+    value = parsed_cookies[cookie_name].value
+    if value.startswith(RESERVED):
+        emit(
+            audit,
+            "cookie",
+            f"cookie named {cookie_name} names something that is not a session",
+            result="invalid",
+            cookie=cookie_name,
+        )
         return None
 
     # see if this key is in redis. if it is then the session is valid and the
     # user is authorized and can continue without doing 2FA again.
-    return parsed_cookies[cookie_name].value
+    return value
+
+
+def is_session(value: str, username: str) -> bool:
+    # anything can be stored under a key that a cookie names, whether by
+    # something else that shares the store or by a user who was sent a
+    # cookie for somebody else. only what was written as a session for this
+    # user counts.
+    try:
+        session = json.loads(value)
+    except ValueError:
+        return False
+    return isinstance(session, dict) and session.get("username") == username
+
+
+def get_basic_credentials(authorization: str) -> typing.Tuple[str, str]:
+    # front ends that are not given a username and password by the web server
+    # read them from the request. anything unreadable is an empty username,
+    # which never matches anybody.
+    scheme, _, credentials = authorization.strip().partition(" ")
+    if scheme.lower() != "basic":
+        return "", ""
+
+    try:
+        decoded = binascii.a2b_base64(credentials.strip()).decode("utf-8")
+    except (binascii.Error, UnicodeDecodeError):
+        return "", ""
+
+    username, _, password = decoded.partition(":")
+    return username.strip(), password.strip()
 
 
 def is_valid_password(
-    usernames: dict,
+    usernames: typing.Mapping[str, typing.Optional[str]],
     username: str,
     password: str,
     ip_address: str,
     request: str,
+    cache: typing.Optional[CredentialCache] = None,
+    metrics: typing.Optional[Metrics] = None,
+    audit: typing.Optional[AuditLog] = None,
+    limiter: typing.Optional["RateLimiter"] = None,
+    pool: typing.Optional["VerificationPool"] = None,
 ) -> bool:
+    def deny(reason: str, message: str) -> bool:
+        emit(
+            audit,
+            "first_factor",
+            message,
+            result="deny",
+            reason=reason,
+            username=username,
+            ip=ip_address,
+            request=request,
+        )
+        return False
+
     if username == "":
-        print(
+        return deny(
+            "no_username",
             f"user provided no username from {ip_address} for {request}",
         )
-        return False
 
     if password == "":  # noqa S105
-        print(
+        return deny(
+            "no_password",
             f"user provided no password from {ip_address} for {request}",
         )
-        return False
 
     # see if the username is in the usernames dict
     if username not in usernames:
-        print(
+        return deny(
+            "unknown_user",
             f"username '{username}' not found in configuration from {ip_address} for {request}",
         )
-        return False
 
     # see if the username has a password
     valid_password = usernames[username]
     if not valid_password:
-        print(
+        return deny(
+            "no_password_configured",
             f"username '{username}' does not have a configured password from {ip_address} for {request}",
         )
-        return False
 
-    # check the password against what was provided
-    if not bcrypt.checkpw(bytes(password, "utf-8"), bytes(valid_password, "utf-8")):
-        print(
+    # check the password against what was provided, reusing a recent result
+    # for this exact username, password, and hash if we have one.
+    valid = None
+    if cache is not None:
+        valid = cache.get(username, password, valid_password)
+
+    if metrics is None:
+        metrics = Metrics()
+
+    if valid is None:
+        # hashing is the expensive part so someone trying a lot of passwords
+        # is turned away before it
+        if limiter is not None:
+            with metrics.timer("rate_limit") as timer:
+                allowed = limiter.allow(username, ip_address)
+                timer.outcome = "allow" if allowed else "deny"
+            if not allowed:
+                return deny(
+                    "rate_limited",
+                    f"username '{username}' has tried too many passwords from {ip_address} for {request}",
+                )
+
+        with metrics.timer("hash") as timer:
+            try:
+                if pool is None:
+                    valid = verify_password(password, valid_password)
+                else:
+                    valid = pool.verify(password, valid_password)
+            except UnsupportedHash as e:
+                timer.outcome = "unsupported"
+                return deny(
+                    "unsupported_hash",
+                    f"username '{username}' has an unusable password hash ({e}) from {ip_address} for {request}",
+                )
+            except Exception as e:
+                if pool is None:
+                    raise
+
+                # the pool was imported when it was started
+                from checkduo.pool import VerificationPoolError, VerificationTimeout
+
+                if not isinstance(e, VerificationPoolError):
+                    raise
+
+                # nothing was learned about the password so nothing is cached
+                timer.outcome = (
+                    "timeout" if isinstance(e, VerificationTimeout) else "shed"
+                )
+                return deny(
+                    "overloaded",
+                    f"username '{username}' password could not be checked ({e}) from {ip_address} for {request}",
+                )
+            timer.outcome = "allow" if valid else "deny"
+        if cache is not None:
+            cache.put(username, password, valid_password, valid)
+
+        # only guesses use up the limits
+        if limiter is not None and not valid:
+            limiter.failed(username, ip_address)
+
+    if not valid:
+        return deny(
+            "wrong_password",
             f"username '{username}' password did not match from {ip_address} for {request}",
         )
-        return False
 
     # username and password are valid
-    print(
+    emit(
+        audit,
+        "first_factor",
         f"{username} successfully passed first factor from {ip_address} for {request}",
+        result="allow",
+        username=username,
+        ip=ip_address,
+        request=request,
     )
     return True
 
 
+class Authenticator:
+    def __init__(
+        self,
+        configuration: dict,
+        *,
+        password_cache: typing.Optional[CredentialCache] = None,
+        metrics: typing.Optional[Metrics] = None,
+        audit: typing.Optional[AuditLog] = None,
+    ) -> None:
+        self.configuration = configuration
+        if password_cache is None:
+            password_cache = CredentialCache(**configuration.get("password_cache", {}))
+        if metrics is None:
+            metrics = Metrics(configuration.get("metrics", {}).get("statsd"))
+        if audit is None:
+            audit = create_audit_log(configuration.get("audit", {}))
+
+        self.password_cache = password_cache
+        self.metrics = metrics
+        self.audit = audit
+        self._usernames: typing.Optional[typing.Mapping] = None
+        self._rate_limiter: typing.Optional["RateLimiter"] = None
+        self._pool: typing.Optional["VerificationPool"] = None
+        self._store: typing.Optional["SessionStore"] = None
+        self._backend: typing.Optional["SessionStore"] = None
+        self._duo: typing.Optional["DuoClient"] = None
+        self._breaker: typing.Optional["CircuitBreaker"] = None
+        self._trusted_networks: typing.Optional["NetworkIndex"] = None
+
+    @property
+    def usernames(self) -> typing.Mapping[str, typing.Optional[str]]:
+        if self._usernames is None:
+            self._usernames = load_usernames(self.configuration)
+        return self._usernames
+
+    @property
+    def rate_limiter(self) -> typing.Optional["RateLimiter"]:
+        if "rate_limit" not in self.configuration:
+            return None
+
+        if self._rate_limiter is None:
+            from checkduo.ratelimit import create_rate_limiter
+
+            self._rate_limiter = create_rate_limiter(
+                self.configuration["rate_limit"],
+                self.configuration["cache"],
+                prefix=f"{self.configuration['cache'].get('prefix', '')}{RATE_LIMIT}",
+            )
+        return self._rate_limiter
+
+    @property
+    def store(self) -> "SessionStore":
+        # the store is created on first use so that the login context never
+        # has to load a client library or connect to anything.
+        if self._store is None:
+            from checkduo.stores import create_session_store
+
+            self._backend = create_session_store(self.configuration["cache"])
+            self._store = self._session_layer(self._backend)
+        return self._store
+
+    def _session_layer(self, backend: "SessionStore") -> "SessionStore":
+        # only sessions with an idle timeout need anything over the backend
+        from checkduo.stores import SlidingSessionStore
+
+        idle = self.configuration["session"].get("idle")
+        if idle is None:
+            return backend
+
+        return SlidingSessionStore(
+            backend,
+            idle,
+            self.configuration["session"].get(
+                "refresh_interval",
+                min(60, idle // 2),
+            ),
+        )
+
+    @property
+    def duo(self) -> "DuoClient":
+        if self._duo is None:
+            from checkduo.duo import DuoClient
+
+            self._duo = DuoClient(**duo_client_options(self.configuration["duo"]))
+        return self._duo
+
+    @property
+    def trusted_networks(self) -> typing.Optional["NetworkIndex"]:
+        if "trusted_networks" not in self.configuration:
+            return None
+
+        if self._trusted_networks is None:
+            from checkduo.networks import NetworkIndex
+
+            self._trusted_networks = NetworkIndex(
+                self.configuration["trusted_networks"],
+            )
+        return self._trusted_networks
+
+    @property
+    def breaker(self) -> typing.Optional["CircuitBreaker"]:
+        if "circuit" not in self.configuration["duo"]:
+            return None
+
+        if self._breaker is None:
+            from checkduo.breaker import CircuitBreaker
+
+            self._breaker = CircuitBreaker(
+                self.store,
+                prefix=f"{self.configuration['cache'].get('prefix', '')}{CIRCUIT}",
+                audit=self.audit,
+                **self.configuration["duo"]["circuit"],
+            )
+        return self._breaker
+
+    def start(self) -> None:
+        # long running processes create their clients before taking requests
+        # so that handler threads never race to create them, and start any
+        # background work that the session store needs.
+        self.store.start()
+        self.duo  # noqa: B018
+        self.audit.start()
+        self._start_pool()
+
+    def _start_pool(self) -> None:
+        # passwords are only checked off the request thread when there are
+        # many requests at once to share the workers between
+        from checkduo.pool import VerificationPool
+
+        self._pool = VerificationPool(
+            **self.configuration.get("verification", {}),
+            metrics=self.metrics,
+        )
+        self._pool.start()
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.close()
+
+        # sessions that were used are refreshed as the store closes
+        if self._store is not None:
+            self._store.close()
+
+        # write out anything that is still waiting to be logged
+        self.audit.close()
+
+    def reconfigure(self, configuration: dict) -> "Authenticator":
+        # build a started authenticator for a new configuration. everything
+        # whose section did not change is shared with this one so that
+        # connection pools, remembered sessions, and remembered passwords
+        # survive a reload.
+        def changed(section: str) -> bool:
+            return configuration.get(section) != self.configuration.get(section)
+
+        replacement = Authenticator(
+            configuration,
+            password_cache=None if changed("password_cache") else self.password_cache,
+            # the metrics server is already serving these
+            metrics=self.metrics,
+            audit=None if changed("audit") else self.audit,
+        )
+        if replacement.audit is not self.audit:
+            replacement.audit.start()
+
+        if changed("cache") or self._backend is None:
+            replacement.store.start()
+        elif changed("session"):
+            # the backend and its connections only depend on the cache
+            # section so a new layer is put over the one that is running
+            from checkduo.stores import SlidingSessionStore
+
+            replacement._backend = self._backend
+            replacement._store = replacement._session_layer(self._backend)
+            if isinstance(replacement._store, SlidingSessionStore):
+                replacement._store.start_refresh()
+        else:
+            replacement._backend = self._backend
+            replacement._store = self._store
+
+        if changed("duo") or self._duo is None:
+            replacement.duo  # noqa: B018
+        else:
+            replacement._duo = self._duo
+
+        if not changed("rate_limit") and not changed("cache"):
+            replacement._rate_limiter = self._rate_limiter
+
+        if changed("verification") or self._pool is None:
+            replacement._start_pool()
+        else:
+            replacement._pool = self._pool
+
+        return replacement
+
+    def retire(self, replacement: "Authenticator") -> None:
+        # close whatever the replacement did not take over. this is called
+        # once requests that were using this authenticator have finished.
+        if self._store is not None and self._store is not replacement._store:
+            from checkduo.stores import SlidingSessionStore
+
+            if self._backend is None or self._backend is not replacement._backend:
+                self._store.close()
+            elif isinstance(self._store, SlidingSessionStore):
+                self._store.stop_refresh()
+        if self._duo is not None and self._duo is not replacement._duo:
+            self._duo.close()
+        if (
+            self._rate_limiter is not None
+            and self._rate_limiter is not replacement._rate_limiter
+        ):
+            self._rate_limiter.close()
+        if self._pool is not None and self._pool is not replacement._pool:
+            self._pool.close()
+        if self.audit is not replacement.audit:
+            self.audit.close()
+
+    def has_session(self, cookie: str, username: str) -> bool:
+        # whether a session cookie names a session that was written for this
+        # user, for front ends that hand out session cookies themselves
+        if cookie.startswith(RESERVED):
+            return False
+        prefix = self.configuration["cache"].get("prefix", "")
+        return self._has_session(f"{prefix}{cookie}", username)
+
+    def _has_session(self, key: str, username: str) -> bool:
+        found = self.store.lookup(key)
+        return found is not None and is_session(found.value, username)
+
+    def _wait_for_session(
+        self,
+        key: str,
+        username: str,
+        pending: str,
+        deadline: float,
+    ) -> bool:
+        while time.monotonic() < deadline:
+            if self._has_session(key, username):
+                return True
+
+            # the request that was asking duo is finished. look one more time
+            # in case it finished between our two checks.
+            if not self.store.exists(pending):
+                return self._has_session(key, username)
+
+            time.sleep(PENDING_POLL_INTERVAL)
+
+        return False
+
+    def _wait_for_txid(self, pending: str, deadline: float) -> typing.Optional[str]:
+        # the request that claimed the session might still be sending the push
+        while time.monotonic() < deadline:
+            marker = self.store.get(pending)
+            if marker is None:
+                return None
+
+            txid = json.loads(marker).get("txid")
+            if txid is not None:
+                return txid
+
+            time.sleep(PENDING_POLL_INTERVAL)
+
+        return None
+
+    def stats(self) -> dict:
+        stats = {
+            "password_cache": self.password_cache.stats(),
+            "audit": self.audit.stats(),
+        }
+        if self._store is not None:
+            stats["session_cache"] = self._store.stats()
+        if self._rate_limiter is not None:
+            stats["rate_limit"] = self._rate_limiter.stats()
+        if self._pool is not None:
+            stats["verification"] = self._pool.stats()
+        if self._breaker is not None:
+            stats["circuit"] = self._breaker.stats()
+        return stats
+
+    def authenticate(
+        self,
+        username: str,
+        password: str,
+        environment: typing.Mapping[str, str],
+    ) -> int:
+        with self.metrics.timer("request") as timer:
+            status = self._authenticate(username, password, environment)
+            timer.outcome = "allow" if status == 0 else "deny"
+        return status
+
+    def _authenticate(
+        self,
+        username: str,
+        password: str,
+        environment: typing.Mapping[str, str],
+    ) -> int:
+        configuration = self.configuration
+
+        ip_address = environment.get("IP", "").strip()
+        request_host = environment.get("HTTP_HOST", "").strip()
+        request_path = environment.get("URI", "").strip()
+        context = environment.get("CONTEXT", "").strip()
+        cookies = environment.get("COOKIE", "").strip()
+
+        with self.metrics.timer("password") as timer:
+            valid = is_valid_password(
+                self.usernames,
+                username,
+                password,
+                ip_address,
+                f"{request_host}{request_path}",
+                cache=self.password_cache,
+                metrics=self.metrics,
+                audit=self.audit,
+                limiter=self.rate_limiter,
+                pool=self._pool,
+            )
+            timer.outcome = "allow" if valid else "deny"
+        if not valid:
+            return 1
+
+        # if they are logging in for the first time then we're good here
+        if context == "login":
+            return 0
+
+        # if the context is NOT "login" then they are NOT logging in for
+        # the first time so we need to check to see if they have passed
+        # through duo.
+        with self.metrics.timer("cookie") as timer:
+            cookie = get_cookie(
+                cookies,
+                configuration["session"]["name"],
+                audit=self.audit,
+            )
+            timer.outcome = "missing" if cookie is None else "found"
+        if cookie is None:
+            return 1  # no cookie, no login
+
+        prefix = configuration["cache"].get("prefix", "")
+        key = f"{prefix}{cookie}"
+
+        with self.metrics.timer("session_lookup") as timer:
+            found = self._has_session(key, username)
+            timer.outcome = "hit" if found else "miss"
+        if found:
+            # found the session in the store, the user already went through duo
+            self.audit.emit(
+                "cookie",
+                f"{username} successfully passed cookie check from {ip_address} for {request_host}{request_path}",
+                result="allow",
+                username=username,
+                ip=ip_address,
+                request=f"{request_host}{request_path}",
+            )
+            return 0
+
+        # users on networks that we trust get a session without duo so that
+        # their next request finds it like anybody else's
+        trusted_networks = self.trusted_networks
+        if trusted_networks is not None and ip_address in trusted_networks:
+            self._save_session(key, username)
+            self.audit.emit(
+                "second_factor",
+                f"{username} skipped second factor from trusted network {ip_address} for {request_host}{request_path}",
+                result="trusted",
+                username=username,
+                ip=ip_address,
+                request=f"{request_host}{request_path}",
+            )
+            return 0
+
+        # a user who went through duo from this device not long ago gets a
+        # new session without another push
+        remembered = self._remembered_device(username, environment)
+        if remembered is not None and self._has_session(remembered, username):
+            self._save_session(key, username)
+            self.audit.emit(
+                "second_factor",
+                f"{username} skipped second factor from remembered device at {ip_address} for {request_host}{request_path}",
+                result="remembered",
+                username=username,
+                ip=ip_address,
+                request=f"{request_host}{request_path}",
+            )
+            return 0
+
+        pending = pending_session(prefix, cookie)
+        if self._second_factor(username, ip_address, key, pending, remembered):
+            self.audit.emit(
+                "second_factor",
+                f"{username} successfully passed second factor from {ip_address} for {request_host}{request_path}",
+                result="allow",
+                username=username,
+                ip=ip_address,
+                request=f"{request_host}{request_path}",
+            )
+            return 0
+
+        self.audit.emit(
+            "second_factor",
+            f"second factor failed from {ip_address} for {request_host}{request_path}",
+            result="deny",
+            username=username,
+            ip=ip_address,
+            request=f"{request_host}{request_path}",
+        )
+        return 1
+
+    def _remembered_device(
+        self,
+        username: str,
+        environment: typing.Mapping[str, str],
+    ) -> typing.Optional[str]:
+        remember = self.configuration["session"].get("remember")
+        if remember is None:
+            return None
+
+        # a device that cannot be told apart from others is never remembered
+        device = [
+            environment.get(DEVICE[name], "").strip()
+            for name in remember.get("match", ["ip"])
+        ]
+        if not all(device):
+            return None
+
+        prefix = self.configuration["cache"].get("prefix", "")
+        return remembered_device(prefix, username, device)
+
+    def _second_factor(
+        self,
+        username: str,
+        ip_address: str,
+        key: str,
+        pending: str,
+        remembered: typing.Optional[str] = None,
+    ) -> bool:
+        # while duo is failing nobody waits on it
+        breaker = self.breaker
+        if breaker is not None and not breaker.allow():
+            return self._duo_unavailable(breaker, username, ip_address)
+
+        if self.configuration["duo"].get("async"):
+            return self._second_factor_async(
+                username,
+                ip_address,
+                key,
+                pending,
+                remembered,
+            )
+
+        # only one request for a session gets to ask duo. when a page with a
+        # lot of images loads right after login every one of those requests
+        # would otherwise send the user a push.
+        marker = json.dumps({"username": username})
+        if not self.store.claim(pending, marker, PENDING_EXPIRY):
+            if breaker is not None:
+                breaker.release()
+            self.audit.emit(
+                "second_factor",
+                f"{username} waiting on another request for second factor from {ip_address}",
+                result="waiting",
+                username=username,
+                ip=ip_address,
+            )
+            wait = self.configuration["session"].get("wait", 35)
+            return self._wait_for_session(
+                key,
+                username,
+                pending,
+                time.monotonic() + wait,
+            )
+
+        try:
+            # send the user to duo and if they succeed then save it but
+            # with an expiration so that they have to reauthenticate after
+            # some configurable period of time.
+            if check_duo(
+                username,
+                ip_address,
+                self.configuration["duo"],
+                client=self.duo,
+                metrics=self.metrics,
+                audit=self.audit,
+                breaker=breaker,
+            ):
+                self._save_session(key, username, remembered)
+                return True
+            return False
+        finally:
+            self.store.delete(pending)
+
+    def _duo_unavailable(
+        self,
+        breaker: "CircuitBreaker",
+        username: str,
+        ip_address: str,
+    ) -> bool:
+        # the session is not saved so that the user goes through duo once it
+        # is back
+        allowed = breaker.fails_open(ip_address)
+        with self.metrics.timer("duo") as timer:
+            timer.outcome = "fail_open" if allowed else "circuit_open"
+        self.audit.emit(
+            "second_factor",
+            f"duo is unavailable, {'allowing' if allowed else 'denying'} {username} from {ip_address}",
+            result=timer.outcome,
+            username=username,
+            ip=ip_address,
+        )
+        return allowed
+
+    def _second_factor_async(
+        self,
+        username: str,
+        ip_address: str,
+        key: str,
+        pending: str,
+        remembered: typing.Optional[str] = None,
+    ) -> bool:
+        from checkduo.duo import DuoError, DuoTimeout
+
+        # an asynchronous push is sent once and its transaction id is kept in
+        # the pending marker. every request for the session, including this
+        # one, then spends a short time asking duo whether the user has
+        # answered. if they have not, the request is denied but the next one
+        # picks up where this left off instead of sending another push.
+        deadline = time.monotonic() + self.configuration["duo"].get("async_wait", 5)
+
+        breaker = self.breaker
+        marker = json.dumps({"username": username})
+        if self.store.claim(pending, marker, PENDING_EXPIRY):
+            with self.metrics.timer("duo") as timer:
+                started = time.monotonic()
+                try:
+                    txid = self.duo.auth_async(username, ip_address)
+                except DuoError as e:
+                    record_duo_error(breaker, e)
+                    timer.outcome = "timeout" if isinstance(e, DuoTimeout) else "error"
+                    self.audit.emit(
+                        "second_factor",
+                        str(e),
+                        result=timer.outcome,
+                        username=username,
+                        ip=ip_address,
+                    )
+                    self.store.delete(pending)
+                    return False
+
+                # sending a push does not wait for the user so a slow answer
+                # means duo is struggling
+                if breaker is not None:
+                    breaker.record(failed=time.monotonic() - started > breaker.slow)
+                timer.outcome = "sent"
+
+            marker = json.dumps({"username": username, "txid": txid})
+            self.store.set(pending, marker, PENDING_EXPIRY)
+        else:
+            if breaker is not None:
+                breaker.release()
+            existing = self._wait_for_txid(pending, deadline)
+            if existing is None:
+                return self._has_session(key, username)
+
+            txid = existing
+
+            self.audit.emit(
+                "second_factor",
+                f"{username} resuming second factor transaction {txid} from {ip_address}",
+                result="waiting",
+                username=username,
+                ip=ip_address,
+                txid=txid,
+            )
+
+        result = "waiting"
+        while result == "waiting" and time.monotonic() < deadline:
+            started = time.monotonic()
+            with self.metrics.timer("duo_status") as timer:
+                try:
+                    result = self.duo.auth_status(
+                        txid,
+                        timeout=max(deadline - started, 0.1),
+                    )
+                except DuoError as e:
+                    # we do not know how this ended so leave it for the next
+                    # request
+                    timer.outcome = "timeout" if isinstance(e, DuoTimeout) else "error"
+                    self.audit.emit(
+                        "second_factor",
+                        str(e),
+                        result=timer.outcome,
+                        username=username,
+                        ip=ip_address,
+                        txid=txid,
+                    )
+                    return False
+                timer.outcome = result
+
+            # duo holds on to the request until something changes but do not
+            # spin if it ever answers straight away.
+            if (
+                result == "waiting"
+                and time.monotonic() - started < PENDING_POLL_INTERVAL
+            ):
+                time.sleep(PENDING_POLL_INTERVAL)
+
+        if result == "waiting":
+            self.audit.emit(
+                "second_factor",
+                f"{username} has not yet answered second factor from {ip_address}",
+                result="waiting",
+                username=username,
+                ip=ip_address,
+                txid=txid,
+            )
+            return False
+
+        if result == "allow":
+            self._save_session(key, username, remembered)
+
+        self.store.delete(pending)
+        return result == "allow"
+
+    def _save_session(
+        self,
+        key: str,
+        username: str,
+        remembered: typing.Optional[str] = None,
+    ) -> None:
+        index = session_index(self.configuration["cache"].get("prefix", ""), username)
+        expiry = self.configuration["session"]["expiry"]
+        with self.metrics.timer("session_write"):
+            self.store.set(
+                key,
+                json.dumps(
+                    {
+                        "username": username,
+                        "timestamp": str(datetime.utcnow()),
+                        # a session that is refreshed never lasts past this
+                        "expires": time.time() + expiry,
+                    },
+                ),
+                expiry,
+                index=index,
+                # only sessions end early when they are not used
+                idle=self.configuration["session"].get("idle"),
+            )
+
+        # the approval is indexed with the user's sessions so that revoking
+        # them makes the user go through duo again from every device
+        if remembered is not None:
+            ttl = self.configuration["session"]["remember"]["ttl"]
+            self.store.set(
+                remembered,
+                json.dumps(
+                    {
+                        "username": username,
+                        "timestamp": str(datetime.utcnow()),
+                        "expires": time.time() + ttl,
+                        "device": True,
+                    },
+                ),
+                ttl,
+                index=index,
+            )
+
+
 def main(configuration_file: str) -> int:
-    configuration = load_configuration(configuration_file)
+    started = time.perf_counter()
+    authenticator = Authenticator(load_compiled_configuration(configuration_file))
+    authenticator.metrics.observe("configuration", time.perf_counter() - started)
 
     # username comes first on stdin pipe, then the password.
     # we cannot function if we do not have these.
     username = sys.stdin.readline().strip()
     password = sys.stdin.readline().strip()
 
-    ip_address = os.environ.get("IP", "").strip()
-    request_host = os.environ.get("HTTP_HOST", "").strip()
-    request_path = os.environ.get("URI", "").strip()
-    context = os.environ.get("CONTEXT", "").strip()
-    cookies = os.environ.get("COOKIE", "").strip()
-
-    if not is_valid_password(
-        configuration["usernames"],
-        username,
-        password,
-        ip_address,
-        f"{request_host}{request_path}",
-    ):
-        return 1
-
-    # if they are logging in for the first time then we're good here
-    if context == "login":
-        return 0
-
-    # if the context is NOT "login" then they are NOT logging in for
-    # the first time so we need to check to see if they have passed
-    # through duo.
-    cookie = get_cookie(cookies, configuration["session"]["name"])
-    if cookie is None:
-        return 1  # no cookie, no login
-
-    # connect to redis
-    prefix = configuration["cache"].pop("prefix", "")
-    redis = Redis(**configuration["cache"])
-    key = f"{prefix}{cookie}"
-
-    if redis.exists(key):
-        # found the key in redis, the user already went through duo
-        print(
-            f"{username} successfully passed cookie check from {ip_address} for {request_host}{request_path}",
-        )
-        return 0
-
-    # send the user to duo and if they succeed then save it but
-    # with an expiration so that they have to reauthenticate after
-    # some configurable period of time.
-    duo_success = check_duo(username, ip_address, configuration["duo"])
-    if duo_success:
-        print(
-            f"{username} successfully passed second factor from {ip_address} for {request_host}{request_path}",
-        )
-        redis.set(
-            key,
-            json.dumps(
-                {
-                    "username": username,
-                    "timestamp": str(datetime.utcnow()),
-                },
-            ),
-        )
-        redis.expire(key, configuration["session"]["expiry"])
-        return 0
+    try:
+        return authenticator.authenticate(username, password, os.environ)
+    finally:
+        # this process only lives for one request so send what it measured
+        # and write what it logged
+        authenticator.metrics.flush()
+        authenticator.close()
 
-    print(f"second factor failed from {ip_address} for {request_host}{request_path}")
-    return 1
 
+def cli() -> None:
+    import argparse
 
-if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="check-duo")
     parser.add_argument(
         "--configuration-file",
@@ -262,10 +1345,30 @@ if __name__ == "__main__":
         metavar="FILE",
         help="the path to the authentication configuration",
     )
+    parser.add_argument(
+        "--compile",
+        dest="compile_only",
+        action="store_true",
+        help="validate the configuration, write a compiled snapshot next to it, and exit",
+    )
     args = parser.parse_args()
 
+    if args.compile_only:
+        try:
+            compile_configuration(args.configuration_file)
+        except Exception as exc:
+            print(f"could not compile configuration: {exc}")
+            sys.exit(1)
+
+        print(f"wrote {snapshot_path(args.configuration_file)}")
+        sys.exit(0)
+
     try:
-        sys.exit(main(**vars(args)))
+        sys.exit(main(args.configuration_file))
     except Exception as exc:
         print(f"could not authenticate user: {exc}")
         sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+# these are the variables that mod_auth_external gives us and that the
+# daemon needs to make a decision, and the browser for remembering devices
+# when something sets it. nothing else is forwarded.
+ENVIRONMENT = ("IP", "HTTP_HOST", "URI", "CONTEXT", "COOKIE", "HTTP_USER_AGENT")
+
+DEFAULT_SOCKET = "/run/check-duo/check-duo.sock"
+
+
+def main(socket_path: str, timeout: float, stats: bool = False) -> int:
+    if stats:
+        request: dict = {"command": "stats"}
+    else:
+        # username comes first on stdin pipe, then the password.
+        username = sys.stdin.readline().strip()
+        password = sys.stdin.readline().strip()
+
+        request = {
+            "username": username,
+            "password": password,
+            "environment": {name: os.environ.get(name, "") for name in ENVIRONMENT},
+        }
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(timeout)
+            s.connect(socket_path)
+            s.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            with s.makefile("rb") as f:
+                response = f.readline()
+    except OSError as e:
+        print(f"could not contact check-duo daemon at {socket_path}: {e}")
+        return 1
+
+    if stats:
+        print(response.decode("utf-8").strip())
+        return 0
+
+    # anything other than an explicit success is a failure
+    return 0 if response.strip() == b"0" else 1
+
+
+def cli() -> None:
+    parser = argparse.ArgumentParser(prog="check-duo-client")
+    parser.add_argument(
+        "--socket",
+        "-s",
+        dest="socket_path",
+        default=DEFAULT_SOCKET,
+        action="store",
+        metavar="PATH",
+        help="the path to the check-duo daemon socket",
+    )
+    parser.add_argument(
+        "--timeout",
+        "-t",
+        default=60.0,
+        type=float,
+        action="store",
+        metavar="SECONDS",
+        help="how long to wait for the daemon to make a decision",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="print the daemon's cache statistics instead of authenticating",
+    )
+    args = parser.parse_args()
+
+    try:
+        sys.exit(main(**vars(args)))
+    except Exception as exc:
+        print(f"could not authenticate user: {exc}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,66 @@
+import collections
+import hashlib
+import hmac
+import os
+import threading
+import time
+import typing
+
+
+class CredentialCache:
+    def __init__(self, size: int = 1024, ttl: int = 300, failure_ttl: int = 30) -> None:
+        self.size = size
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.hits = 0
+        self.misses = 0
+
+        # entries are keyed by an hmac using a secret that only lives in this
+        # process so that nothing stored here can be used to recover or test
+        # a password. the stored hash is part of the key so changing a user's
+        # password in the configuration invalidates their entries.
+        self._secret = os.urandom(32)
+        self._entries: typing.OrderedDict[bytes, typing.Tuple[bool, float]]
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, username: str, password: str, hashed: str) -> bytes:
+        message = "\0".join([username, password, hashed]).encode("utf-8")
+        return hmac.new(self._secret, message, hashlib.sha256).digest()
+
+    def get(self, username: str, password: str, hashed: str) -> typing.Optional[bool]:
+        key = self._key(username, password, hashed)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, username: str, password: str, hashed: str, valid: bool) -> None:
+        ttl = self.ttl if valid else self.failure_ttl
+        if self.size <= 0 or ttl <= 0:
+            return
+
+        key = self._key(username, password, hashed)
+        with self._lock:
+            self._entries[key] = (valid, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "capacity": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
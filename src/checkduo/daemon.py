@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import socketserver
+import sys
+import threading
+import time
+import typing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from checkduo.checkduo import PENDING_EXPIRY, Authenticator, load_configuration
+from checkduo.client import DEFAULT_SOCKET, ENVIRONMENT
+from checkduo.metrics import Metrics
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    server: "Server"
+
+    def handle(self) -> None:
+        # a reload can swap the authenticator at any time so each request
+        # keeps using the one that it started with
+        authenticator = self.server.authenticator
+
+        try:
+            request = json.loads(self.rfile.readline())
+            if request.get("command") == "stats":
+                stats = json.dumps(authenticator.stats())
+                self.wfile.write(stats.encode("utf-8") + b"\n")
+                return
+
+            environment = request.get("environment") or {}
+            status = authenticator.authenticate(
+                str(request.get("username", "")).strip(),
+                str(request.get("password", "")).strip(),
+                {name: str(environment.get(name, "")) for name in ENVIRONMENT},
+            )
+        except Exception as e:
+            print(f"could not authenticate user: {e}")
+            status = 1
+        finally:
+            authenticator.metrics.flush()
+
+        try:
+            self.wfile.write(f"{status}\n".encode("utf-8"))
+        except OSError as e:
+            print(f"could not respond to client: {e}")
+
+
+class ReloadableServer(socketserver.BaseServer):
+    # every server keeps the authenticator for the running configuration
+    # here so that it can be swapped while requests are being answered
+    authenticator: Authenticator
+
+    def reload(self, configuration: dict) -> None:
+        current = self.authenticator
+        if configuration == current.configuration:
+            return
+
+        replacement = current.reconfigure(configuration)
+        self.authenticator = replacement
+
+        changed = sorted(
+            section
+            for section in set(configuration) | set(current.configuration)
+            if configuration.get(section) != current.configuration.get(section)
+        )
+        print(f"reloaded configuration, changed: {', '.join(changed)}")
+        if "metrics" in changed:
+            print("changes to metrics take effect when the daemon is restarted")
+
+        # requests that started before the swap, including any waiting on a
+        # duo push, get as long as a push can take before what they are using
+        # is closed.
+        timer = threading.Timer(PENDING_EXPIRY, current.retire, (replacement,))
+        timer.daemon = True
+        timer.start()
+
+
+class Server(ReloadableServer, socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, authenticator: Authenticator) -> None:
+        self.authenticator = authenticator
+
+        # a socket left over from a previous run would stop us from binding
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        super().__init__(socket_path, RequestHandler)
+
+
+class ConfigurationWatcher:
+    def __init__(
+        self,
+        configuration_file: str,
+        server: ReloadableServer,
+        interval: float,
+    ) -> None:
+        self.configuration_file = configuration_file
+        self.server = server
+        self.interval = interval
+        self._identity = self._stat()
+        self._wake = threading.Event()
+
+    def _stat(self) -> typing.Optional[typing.Tuple[int, int, int]]:
+        try:
+            source = os.stat(self.configuration_file)
+        except OSError:
+            return None
+        return source.st_ino, source.st_mtime_ns, source.st_size
+
+    def start(self) -> None:
+        thread = threading.Thread(target=self._run, name="reload", daemon=True)
+        thread.start()
+
+    def wake(self) -> None:
+        # check now even if the file looks the same
+        self._identity = None
+        self._wake.set()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.check()
+
+    def check(self) -> bool:
+        # editors often replace the file rather than writing to it so the
+        # inode is compared along with the modification time and the size.
+        identity = self._stat()
+        if identity is None or identity == self._identity:
+            return False
+        self._identity = identity
+
+        # a broken edit leaves the running configuration alone. it is tried
+        # again when the file changes.
+        try:
+            configuration = load_configuration(self.configuration_file)
+            self.server.reload(configuration)
+        except Exception as e:
+            print(f"could not reload configuration, keeping the running one: {e}")
+            return False
+
+        return True
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    server: "MetricsServer"
+
+    def log_message(self, format: str, *args: typing.Any) -> None:  # noqa: A002
+        pass  # a scrape every few seconds would drown out everything else
+
+    def do_GET(self) -> None:  # noqa: N802
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, metrics: Metrics, host: str, port: int) -> None:
+        self.metrics = metrics
+        super().__init__((host, port), MetricsHandler)
+
+
+def start_authenticator(configuration_file: str) -> Authenticator:
+    started = time.perf_counter()
+    authenticator = Authenticator(load_configuration(configuration_file))
+    authenticator.metrics.observe("configuration", time.perf_counter() - started)
+
+    authenticator.start()
+
+    prometheus = authenticator.configuration.get("metrics", {}).get("prometheus")
+    if prometheus is not None:
+        metrics_server = MetricsServer(
+            authenticator.metrics,
+            prometheus.get("host", "127.0.0.1"),
+            prometheus["port"],
+        )
+        threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+        print(
+            f"serving metrics on {prometheus.get('host', '127.0.0.1')}:{prometheus['port']}",
+        )
+
+    return authenticator
+
+
+def serve(
+    server: ReloadableServer,
+    configuration_file: str,
+    reload_interval: float,
+) -> None:
+    watcher = ConfigurationWatcher(configuration_file, server, reload_interval)
+    if reload_interval > 0:
+        watcher.start()
+
+        # sighup asks for a reload straight away
+        signal.signal(signal.SIGHUP, lambda signum, frame: watcher.wake())
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.authenticator.close()
+
+
+def main(
+    configuration_file: str,
+    socket_path: str,
+    socket_mode: str,
+    socket_group: typing.Optional[str],
+    reload_interval: float,
+) -> int:
+    authenticator = start_authenticator(configuration_file)
+
+    with Server(socket_path, authenticator) as server:
+        os.chmod(socket_path, int(socket_mode, 8))
+        if socket_group is not None:
+            shutil.chown(socket_path, group=socket_group)
+
+        print(f"listening on {socket_path}")
+        try:
+            serve(server, configuration_file, reload_interval)
+        finally:
+            os.unlink(socket_path)
+
+    return 0
+
+
+def cli() -> None:
+    parser = argparse.ArgumentParser(prog="check-duo-daemon")
+    parser.add_argument(
+        "--configuration-file",
+        "-c",
+        required=True,
+        action="store",
+        metavar="FILE",
+        help="the path to the authentication configuration",
+    )
+    parser.add_argument(
+        "--socket",
+        "-s",
+        dest="socket_path",
+        default=DEFAULT_SOCKET,
+        action="store",
+        metavar="PATH",
+        help="the path to the socket to listen on",
+    )
+    parser.add_argument(
+        "--socket-mode",
+        default="660",
+        action="store",
+        metavar="MODE",
+        help="the octal permissions to give the socket",
+    )
+    parser.add_argument(
+        "--socket-group",
+        default=None,
+        action="store",
+        metavar="GROUP",
+        help="the group that should own the socket, usually the web server's group",
+    )
+    parser.add_argument(
+        "--reload-interval",
+        default=5.0,
+        type=float,
+        action="store",
+        metavar="SECONDS",
+        help="how often to check the configuration for changes, zero to never reload",
+    )
+    args = parser.parse_args()
+
+    try:
+        sys.exit(main(**vars(args)))
+    except Exception as exc:
+        print(f"could not start daemon: {exc}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
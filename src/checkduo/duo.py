@@ -0,0 +1,248 @@
+import hashlib
+import hmac
+import random
+import time
+import typing
+import urllib.parse
+from datetime import datetime
+
+# requests is only imported once a client is created so that importing this
+# module stays cheap for requests that never talk to duo.
+if typing.TYPE_CHECKING:
+    import requests
+
+
+class DuoError(Exception):
+    pass
+
+
+class DuoUnavailable(DuoError):
+    # duo could not be reached, was failing, or was rate limiting us
+    pass
+
+
+class DuoTimeout(DuoUnavailable):
+    pass
+
+
+class DuoReadTimeout(DuoTimeout):
+    # duo was sent the request but did not answer in time
+    pass
+
+
+def sign(
+    skey: str,
+    host: str,
+    path: str,
+    date: str,
+    params: dict,
+    method: str = "POST",
+) -> str:
+    canonical_params = []
+    for key, value in sorted(
+        (urllib.parse.quote(key, "~"), urllib.parse.quote(value, "~"))
+        for (key, value) in list(params.items())
+    ):
+        canonical_params.append(f"{key}={value}")
+
+    parts = [
+        date,
+        method,
+        host.lower(),
+        path,
+        "&".join(canonical_params),
+    ]
+
+    sig = hmac.new(skey.encode("utf-8"), "\n".join(parts).encode("utf-8"), hashlib.sha1)
+    return sig.hexdigest()
+
+
+class DuoClient:
+    # duo is only ever reached over https. the benchmarks change this to talk
+    # to a fake duo running locally.
+    scheme = "https"
+
+    def __init__(
+        self,
+        ikey: str,
+        skey: str,
+        host: str,
+        connect_timeout: float = 5,
+        timeout: float = 30,
+        retries: int = 3,
+        backoff: float = 1,
+        max_backoff: float = 32,
+        pool_size: int = 10,
+    ) -> None:
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.ikey = ikey
+        self.skey = skey
+        self.host = host
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        # one session holds a pool of keep-alive connections to duo so that
+        # a long running process only pays for the tls handshake once. the
+        # adapter does no retrying of its own because we do it below.
+        self.session = requests.Session()
+        self.session.mount(
+            "https://",
+            HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0),
+        )
+
+    def _delay(self, attempt: int) -> float:
+        # exponential backoff with jitter as duo recommends for rate limits
+        delay = min(self.backoff * (2**attempt), self.max_backoff)
+        return random.uniform(delay / 2, delay)  # noqa: S311
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        params: dict,
+        timeout: typing.Optional[float] = None,
+    ) -> dict:
+        import requests
+
+        # only requests that do not change anything are retried after a
+        # server error or a lost connection. a push that might have been sent
+        # is never sent again, but duo does not act on rate limited requests
+        # and a request that never connected never reached duo.
+        idempotent = method == "GET"
+
+        # a caller that gives a timeout wants an answer by then, so nothing
+        # is tried again once there would be no time left for it
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        attempt = 0
+        while True:
+            now = datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S -0000")
+            signature = sign(self.skey, self.host, path, now, params, method)
+
+            retryable = False
+            failure: typing.Type[DuoError] = DuoError
+            try:
+                r = self.session.request(
+                    method,
+                    f"{self.scheme}://{self.host}{path}",
+                    headers={"Date": now},
+                    params=params if method == "GET" else None,
+                    data=params if method != "GET" else None,
+                    auth=(self.ikey, signature),
+                    timeout=(self.connect_timeout, timeout or self.timeout),
+                )
+            except requests.exceptions.ConnectTimeout as e:
+                error = f"could not connect to duo: {e}"
+                retryable = True
+                failure = DuoTimeout
+            except requests.exceptions.Timeout as e:
+                # a request that could wait until the deadline has used it up
+                error = f"timed out talking to duo: {e}"
+                retryable = idempotent and deadline is None
+                failure = DuoReadTimeout
+            except requests.exceptions.ConnectionError as e:
+                error = f"could not talk to duo: {e}"
+                retryable = idempotent
+                failure = DuoUnavailable
+            except requests.exceptions.RequestException as e:
+                error = f"could not talk to duo: {e}"
+                retryable = idempotent
+            else:
+                if r.status_code == 429:
+                    error = "rate limited by duo"
+                    retryable = True
+                    failure = DuoUnavailable
+                elif r.status_code >= 500:
+                    error = f"received {r.status_code} from duo"
+                    retryable = idempotent
+                    failure = DuoUnavailable
+                else:
+                    return self._parse(r)
+
+            if not retryable or attempt >= self.retries:
+                raise failure(error)
+
+            delay = self._delay(attempt)
+            if deadline is not None:
+                timeout = deadline - time.monotonic() - delay
+                if timeout <= 0:
+                    raise failure(error)
+            print(f"{error}, trying again in {delay:.1f} seconds")
+            time.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    def _parse(r: "requests.Response") -> dict:
+        try:
+            data = r.json()
+        except ValueError as e:
+            raise DuoError(f"unable to parse duo response: {e}") from e
+
+        if not isinstance(data, dict):
+            raise DuoError("unexpected response from duo")
+
+        if r.status_code != 200:
+            raise DuoError(
+                f"received {r.status_code} from duo: {data.get('message')}, {data.get('message_detail')}",
+            )
+
+        response = data.get("response")
+        if not isinstance(response, dict):
+            raise DuoError("empty response from duo")
+
+        return response
+
+    @staticmethod
+    def _auth_params(username: str, ip_address: str) -> dict:
+        return {
+            "username": username,
+            "factor": "auto",
+            "device": "auto",
+            "ipaddr": ip_address,
+            "pushinfo": f"IP={ip_address}",
+        }
+
+    def auth(self, username: str, ip_address: str) -> bool:
+        response = self.request(
+            "POST",
+            "/auth/v2/auth",
+            self._auth_params(username, ip_address),
+        )
+        return response.get("result", "deny") == "allow"
+
+    def auth_async(self, username: str, ip_address: str) -> str:
+        response = self.request(
+            "POST",
+            "/auth/v2/auth",
+            {**self._auth_params(username, ip_address), "async": "1"},
+        )
+
+        txid = response.get("txid")
+        if not isinstance(txid, str) or not txid:
+            raise DuoError("no transaction id in duo response")
+        return txid
+
+    def auth_status(self, txid: str, timeout: typing.Optional[float] = None) -> str:
+        # duo holds on to this request until the status of the transaction
+        # changes. returns "allow", "deny", or "waiting".
+        try:
+            response = self.request(
+                "GET",
+                "/auth/v2/auth_status",
+                {"txid": txid},
+                timeout=timeout,
+            )
+        except DuoReadTimeout:
+            # nothing changed before we stopped waiting
+            return "waiting"
+
+        result = response.get("result", "deny")
+        return result if result in ("allow", "waiting") else "deny"
+
+    def close(self) -> None:
+        self.session.close()
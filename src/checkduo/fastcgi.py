@@ -0,0 +1,293 @@
+#!/usr/bin/python3
+
+import argparse
+import contextlib
+import io
+import socketserver
+import struct
+import sys
+import typing
+
+from checkduo.checkduo import Authenticator, get_basic_credentials
+from checkduo.daemon import ReloadableServer, serve, start_authenticator
+
+# https://fastcgi-archives.github.io/FastCGI_Specification.html
+VERSION = 1
+HEADER = struct.Struct("!BBHHBx")
+MAX_CONTENT = 65535
+
+# cookies and headers are all that an authorizer is sent, so anything this
+# large is not a web server talking to us
+MAX_PARAMS = 1 << 20
+
+BEGIN_REQUEST = 1
+ABORT_REQUEST = 2
+END_REQUEST = 3
+PARAMS = 4
+STDOUT = 6
+GET_VALUES = 9
+GET_VALUES_RESULT = 10
+UNKNOWN_TYPE = 11
+
+AUTHORIZER = 3
+KEEP_CONN = 1
+
+REQUEST_COMPLETE = 0
+UNKNOWN_ROLE = 3
+
+# what we tell the web server about ourselves when it asks. requests on one
+# connection are answered one after another.
+VALUES = {"FCGI_MPXS_CONNS": "0"}
+
+
+def read_record(
+    stream: io.BufferedIOBase,
+) -> typing.Optional[typing.Tuple[int, int, bytes]]:
+    # returns the type, request id, and content of the next record, or none
+    # once the web server has hung up
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+
+    version, kind, request_id, length, padding = HEADER.unpack(header)
+    content = stream.read(length + padding)
+    if version != VERSION or len(content) < length + padding:
+        return None
+
+    return kind, request_id, content[:length]
+
+
+def write_record(
+    stream: io.BufferedIOBase,
+    kind: int,
+    request_id: int,
+    content: bytes = b"",
+) -> None:
+    # a stream is ended by a record with no content so this always writes at
+    # least one record
+    position = 0
+    while True:
+        chunk = content[position : position + MAX_CONTENT]
+        stream.write(HEADER.pack(VERSION, kind, request_id, len(chunk), 0) + chunk)
+        position += len(chunk)
+        if position >= len(content):
+            return
+
+
+def decode_params(data: bytes) -> typing.Dict[str, str]:
+    # each name and value is preceded by its length, which takes one byte
+    # when it is short and four bytes with the top bit set when it is not. a
+    # truncated pair is dropped along with anything after it.
+    params = {}
+    position = 0
+    with contextlib.suppress(IndexError, struct.error):
+        while position < len(data):
+            lengths = []
+            for _ in range(2):
+                if data[position] >> 7:
+                    (length,) = struct.unpack_from("!I", data, position)
+                    lengths.append(length & 0x7FFFFFFF)
+                    position += 4
+                else:
+                    lengths.append(data[position])
+                    position += 1
+
+            name_length, value_length = lengths
+            if position + name_length + value_length > len(data):
+                break
+            name = data[position : position + name_length]
+            position += name_length
+            value = data[position : position + value_length]
+            position += value_length
+            params[name.decode("latin-1")] = value.decode("utf-8", "replace")
+
+    return params
+
+
+def encode_params(params: typing.Mapping[str, str]) -> bytes:
+    encoded = b""
+    for name, value in params.items():
+        for data in (name.encode("latin-1"), value.encode("utf-8")):
+            if len(data) < 128:
+                encoded += bytes([len(data)])
+            else:
+                encoded += struct.pack("!I", len(data) | 0x80000000)
+        encoded += name.encode("latin-1") + value.encode("utf-8")
+    return encoded
+
+
+def request_environment(params: typing.Mapping[str, str]) -> typing.Dict[str, str]:
+    # the web server sends the same variables as it would to a cgi script.
+    # these are turned into what mod_auth_external would have given us.
+    return {
+        "IP": params.get("REMOTE_ADDR", ""),
+        "HTTP_HOST": params.get("HTTP_HOST", ""),
+        "URI": params.get("REQUEST_URI", ""),
+        "CONTEXT": params.get("CONTEXT", ""),
+        "COOKIE": params.get("HTTP_COOKIE", ""),
+        "HTTP_USER_AGENT": params.get("HTTP_USER_AGENT", ""),
+    }
+
+
+def authorize(authenticator: Authenticator, params: typing.Mapping[str, str]) -> int:
+    # mod_authnz_fcgi gives an authentication provider the username and
+    # password that mod_auth_form read. an authorizer that is not used as a
+    # provider only gets the request so look for basic authentication.
+    if "REMOTE_PASSWD" in params:
+        username = params.get("REMOTE_USER", "").strip()
+        password = params["REMOTE_PASSWD"].strip()
+    else:
+        username, password = get_basic_credentials(
+            params.get("HTTP_AUTHORIZATION", ""),
+        )
+
+    try:
+        return authenticator.authenticate(
+            username,
+            password,
+            request_environment(params),
+        )
+    except Exception as e:
+        print(f"could not authenticate user: {e}")
+        return 1
+    finally:
+        authenticator.metrics.flush()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    server: "Server"
+
+    def handle(self) -> None:
+        # requests that have begun, with whether to keep the connection open
+        # after each one and the parameters received so far
+        requests: typing.Dict[int, typing.Tuple[bool, bytearray]] = {}
+
+        while True:
+            record = read_record(self.rfile)
+            if record is None:
+                return
+
+            kind, request_id, content = record
+            if kind == GET_VALUES:
+                wanted = decode_params(content)
+                values = {name: VALUES[name] for name in wanted if name in VALUES}
+                write_record(self.wfile, GET_VALUES_RESULT, 0, encode_params(values))
+            elif kind == BEGIN_REQUEST and len(content) >= 3:
+                role, flags = struct.unpack_from("!HB", content)
+                if role != AUTHORIZER:
+                    self.end_request(request_id, UNKNOWN_ROLE)
+                    if not flags & KEEP_CONN:
+                        return
+                    continue
+                requests[request_id] = (bool(flags & KEEP_CONN), bytearray())
+            elif kind == ABORT_REQUEST and request_id in requests:
+                keep, _ = requests.pop(request_id)
+                self.end_request(request_id, REQUEST_COMPLETE)
+                if not keep:
+                    return
+            elif kind == PARAMS and request_id in requests:
+                keep, params = requests[request_id]
+                if content:
+                    params.extend(content)
+                    if len(params) > MAX_PARAMS:
+                        return
+                    continue
+
+                # an authorizer is never sent a request body, so the request
+                # is answered as soon as its parameters end
+                del requests[request_id]
+                self.respond(request_id, decode_params(bytes(params)))
+                if not keep:
+                    return
+            elif request_id == 0:
+                write_record(self.wfile, UNKNOWN_TYPE, 0, bytes([kind]) + bytes(7))
+
+    def respond(self, request_id: int, params: typing.Mapping[str, str]) -> None:
+        # a reload can swap the authenticator at any time so each request
+        # keeps using the one that it started with
+        status = authorize(self.server.authenticator, params)
+
+        response = "Status: 200 OK" if status == 0 else "Status: 401 Unauthorized"
+        write_record(
+            self.wfile,
+            STDOUT,
+            request_id,
+            f"{response}\r\nContent-Type: text/plain\r\n\r\n".encode("ascii"),
+        )
+        write_record(self.wfile, STDOUT, request_id)
+        self.end_request(request_id, REQUEST_COMPLETE)
+
+    def end_request(self, request_id: int, protocol_status: int) -> None:
+        write_record(
+            self.wfile,
+            END_REQUEST,
+            request_id,
+            struct.pack("!IB3x", 0, protocol_status),
+        )
+        self.wfile.flush()
+
+
+class Server(ReloadableServer, socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str, port: int, authenticator: Authenticator) -> None:
+        self.authenticator = authenticator
+        super().__init__((host, port), RequestHandler)
+
+
+def main(configuration_file: str, host: str, port: int, reload_interval: float) -> int:
+    authenticator = start_authenticator(configuration_file)
+
+    with Server(host, port, authenticator) as server:
+        print(f"listening for fastcgi on {host}:{port}")
+        serve(server, configuration_file, reload_interval)
+
+    return 0
+
+
+def cli() -> None:
+    parser = argparse.ArgumentParser(prog="check-duo-fastcgi")
+    parser.add_argument(
+        "--configuration-file",
+        "-c",
+        required=True,
+        action="store",
+        metavar="FILE",
+        help="the path to the authentication configuration",
+    )
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        action="store",
+        metavar="HOST",
+        help="the address to listen on",
+    )
+    parser.add_argument(
+        "--port",
+        "-p",
+        required=True,
+        type=int,
+        action="store",
+        metavar="PORT",
+        help="the port to listen on",
+    )
+    parser.add_argument(
+        "--reload-interval",
+        default=5.0,
+        type=float,
+        action="store",
+        metavar="SECONDS",
+        help="how often to check the configuration for changes, zero to never reload",
+    )
+    args = parser.parse_args()
+
+    try:
+        sys.exit(main(**vars(args)))
+    except Exception as exc:
+        print(f"could not start fastcgi authorizer: {exc}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,175 @@
+import bisect
+import socket
+import threading
+import time
+import typing
+
+# upper bounds in seconds. bcrypt and redis live at the bottom of this range
+# and a duo push that waits on a person lives at the top.
+BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+class Timer:
+    def __init__(self, metrics: "Metrics", stage: str) -> None:
+        self.metrics = metrics
+        self.stage = stage
+        self.outcome = "ok"
+        self.started = 0.0
+
+    def __enter__(self) -> "Timer":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type: typing.Any, *args: typing.Any) -> None:
+        # anything that escapes a stage is an error unless the stage already
+        # decided what happened
+        if exc_type is not None and self.outcome == "ok":
+            self.outcome = "error"
+        self.metrics.observe(
+            self.stage,
+            time.perf_counter() - self.started,
+            self.outcome,
+        )
+
+
+class Metrics:
+    def __init__(
+        self,
+        statsd: typing.Optional[dict] = None,
+    ) -> None:
+        self._histograms: typing.Dict[typing.Tuple[str, str], Histogram] = {}
+        self._lock = threading.Lock()
+
+        # statsd does its own aggregation so it is sent every observation.
+        # they are held here until flush is called, which is once a request.
+        self._statsd = statsd
+        self._pending: typing.List[str] = []
+
+        # gauges are read when they are rendered or sent
+        self._gauges: typing.Dict[str, typing.Tuple[str, typing.Callable[[], float]]]
+        self._gauges = {}
+
+    def gauge(
+        self,
+        name: str,
+        description: str,
+        read: typing.Callable[[], float],
+    ) -> None:
+        # a gauge with the same name replaces the one that was there before
+        with self._lock:
+            self._gauges[name] = (description, read)
+
+    def timer(self, stage: str) -> Timer:
+        return Timer(self, stage)
+
+    def observe(self, stage: str, seconds: float, outcome: str = "ok") -> None:
+        with self._lock:
+            histogram = self._histograms.get((stage, outcome))
+            if histogram is None:
+                histogram = self._histograms[(stage, outcome)] = Histogram()
+            histogram.observe(seconds)
+
+            if self._statsd is not None:
+                prefix = self._statsd.get("prefix", "checkduo")
+                self._pending.append(
+                    f"{prefix}.{stage}.{outcome}:{seconds * 1000:.3f}|ms",
+                )
+
+    def flush(self) -> None:
+        if self._statsd is None:
+            return
+
+        with self._lock:
+            lines, self._pending = self._pending, []
+            gauges = sorted(self._gauges.items())
+        if not lines:
+            return
+
+        prefix = self._statsd.get("prefix", "checkduo")
+        for name, (_, read) in gauges:
+            lines.append(f"{prefix}.{name}:{read()}|g")
+
+        # statsd takes several metrics in one packet when they are separated
+        # by newlines. losing a packet is better than slowing down a request.
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                s.sendto(
+                    "\n".join(lines).encode("utf-8"),
+                    (
+                        self._statsd.get("host", "127.0.0.1"),
+                        self._statsd.get("port", 8125),
+                    ),
+                )
+        except OSError as e:
+            print(f"could not send metrics to statsd: {e}")
+
+    def render(self) -> str:
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            lines = [
+                "# HELP checkduo_stage_seconds Time spent in each stage of authenticating a request.",
+                "# TYPE checkduo_stage_seconds histogram",
+            ]
+            for (stage, outcome), histogram in histograms:
+                labels = f'stage="{stage}",outcome="{outcome}"'
+                total = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    total += count
+                    lines.append(
+                        f'checkduo_stage_seconds_bucket{{{labels},le="{bound}"}} {total}',
+                    )
+                lines.append(
+                    f'checkduo_stage_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}',
+                )
+                lines.append(f"checkduo_stage_seconds_sum{{{labels}}} {histogram.sum}")
+                lines.append(
+                    f"checkduo_stage_seconds_count{{{labels}}} {histogram.count}",
+                )
+
+            for name, (description, read) in sorted(self._gauges.items()):
+                lines.extend(
+                    [
+                        f"# HELP checkduo_{name} {description}",
+                        f"# TYPE checkduo_{name} gauge",
+                        f"checkduo_{name} {read()}",
+                    ],
+                )
+
+        # bcrypt is the only thing that uses much cpu so this shows how close
+        # password checks are to saturating the host
+        lines.extend(
+            [
+                "# HELP process_cpu_seconds_total Total user and system CPU time spent in seconds.",
+                "# TYPE process_cpu_seconds_total counter",
+                f"process_cpu_seconds_total {time.process_time()}",
+            ],
+        )
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,63 @@
+import bisect
+import ipaddress
+import typing
+
+
+def compile_networks(networks: typing.Iterable[str]) -> dict:
+    # the networks become sorted ranges of addresses that do not overlap,
+    # kept as plain lists of numbers so that they can be written into the
+    # compiled configuration. change SNAPSHOT_VERSION if this ever changes.
+    ranges: typing.Dict[int, typing.List[typing.Tuple[int, int]]] = {4: [], 6: []}
+    for network in networks:
+        parsed = ipaddress.ip_network(network, strict=False)
+        ranges[parsed.version].append(
+            (int(parsed.network_address), int(parsed.broadcast_address)),
+        )
+
+    compiled = {}
+    for version, found in ranges.items():
+        starts: typing.List[int] = []
+        ends: typing.List[int] = []
+        for start, end in sorted(found):
+            # networks that overlap or sit next to each other become one range
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        compiled[str(version)] = [starts, ends]
+    return compiled
+
+
+class NetworkIndex:
+    def __init__(self, compiled: dict) -> None:
+        self.ranges = {
+            int(version): (starts, ends) for version, (starts, ends) in compiled.items()
+        }
+
+    @classmethod
+    def from_networks(cls, networks: typing.Iterable[str]) -> "NetworkIndex":
+        return cls(compile_networks(networks))
+
+    def __contains__(self, ip_address: object) -> bool:
+        if not isinstance(ip_address, str):
+            return False
+
+        try:
+            address = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return False
+
+        # ipv4 clients of a server listening on ipv6 can show up like this
+        if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped:
+            address = address.ipv4_mapped
+
+        # the range that starts at or before the address is the only one that
+        # could hold it
+        starts, ends = self.ranges.get(address.version, ([], []))
+        number = int(address)
+        position = bisect.bisect_right(starts, number) - 1
+        return position >= 0 and number <= ends[position]
+
+    def __len__(self) -> int:
+        return sum(len(starts) for starts, _ in self.ranges.values())
@@ -0,0 +1,475 @@
+#!/usr/bin/python3
+
+import hashlib
+import hmac
+import os
+import sys
+import time
+import typing
+
+# every hash is verified against this when timing so that nothing real is
+# ever needed to calibrate
+CALIBRATION_PASSWORD = "correct horse battery staple"  # noqa: S105
+
+
+class UnsupportedHash(ValueError):
+    pass
+
+
+def _b64encode(data: bytes, adapted: bool = True) -> str:
+    # unpadded base64 like passlib writes, which is what most tools that write
+    # these hashes produce. pbkdf2 hashes use "." in place of "+" and scrypt
+    # hashes do not.
+    import base64
+
+    encoded = base64.b64encode(data).decode("ascii").rstrip("=")
+    return encoded.replace("+", ".") if adapted else encoded
+
+
+def _b64decode(data: str) -> bytes:
+    import base64
+
+    data = data.replace(".", "+")
+    return base64.b64decode(data + "=" * (-len(data) % 4))
+
+
+class Verifier:
+    name: str
+    prefixes: typing.Tuple[str, ...]
+
+    def verify(self, password: str, hashed: str) -> bool:
+        raise NotImplementedError
+
+    def hash(self, *args: typing.Any, **kwargs: typing.Any) -> str:  # noqa: A003
+        raise NotImplementedError
+
+    def parameters(self, hashed: str) -> dict:
+        raise NotImplementedError
+
+    def levels(self) -> typing.Iterator[dict]:
+        # parameters from the cheapest that is worth using upwards, each
+        # roughly twice as expensive as the one before it
+        raise NotImplementedError
+
+
+class BcryptVerifier(Verifier):
+    name = "bcrypt"
+    prefixes = ("$2y$", "$2b$", "$2a$")
+
+    def verify(self, password: str, hashed: str) -> bool:
+        import bcrypt
+
+        try:
+            return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+        except ValueError as e:
+            raise UnsupportedHash(f"invalid bcrypt hash: {e}") from e
+
+    def hash(self, password: str, cost: int = 12) -> str:  # noqa: A003
+        import bcrypt
+
+        salt = bcrypt.gensalt(rounds=cost)
+        return bcrypt.hashpw(password.encode("utf-8"), salt).decode("utf-8")
+
+    def parameters(self, hashed: str) -> dict:
+        return {"cost": int(hashed.split("$")[2])}
+
+    def levels(self) -> typing.Iterator[dict]:
+        for cost in range(4, 20):
+            yield {"cost": cost}
+
+
+class Argon2Verifier(Verifier):
+    name = "argon2id"
+    prefixes = ("$argon2id$",)
+
+    def _hasher(self, **parameters: typing.Any) -> typing.Any:
+        try:
+            from argon2 import PasswordHasher  # type: ignore
+        except ImportError as e:
+            raise UnsupportedHash("argon2id hashes need the argon2-cffi package") from e
+
+        return PasswordHasher(**parameters)
+
+    def verify(self, password: str, hashed: str) -> bool:
+        hasher = self._hasher()
+        from argon2 import exceptions
+
+        try:
+            return hasher.verify(hashed, password)
+        except exceptions.VerifyMismatchError:
+            return False
+        except exceptions.InvalidHashError as e:
+            raise UnsupportedHash(f"invalid argon2id hash: {e}") from e
+
+    def hash(  # noqa: A003
+        self,
+        password: str,
+        time_cost: int = 3,
+        memory_cost: int = 65536,
+        parallelism: int = 1,
+    ) -> str:
+        return self._hasher(
+            time_cost=time_cost,
+            memory_cost=memory_cost,
+            parallelism=parallelism,
+        ).hash(password)
+
+    def parameters(self, hashed: str) -> dict:
+        # $argon2id$v=19$m=65536,t=3,p=1$salt$hash
+        values = dict(part.split("=") for part in hashed.split("$")[3].split(","))
+        return {
+            "time_cost": int(values["t"]),
+            "memory_cost": int(values["m"]),
+            "parallelism": int(values["p"]),
+        }
+
+    def levels(self) -> typing.Iterator[dict]:
+        # memory is what makes argon2id hard to attack so it stays at what
+        # owasp recommends and only the number of passes goes up
+        for time_cost in range(1, 16):
+            yield {"time_cost": time_cost, "memory_cost": 65536, "parallelism": 1}
+
+
+class ScryptVerifier(Verifier):
+    name = "scrypt"
+    prefixes = ("$scrypt$",)
+
+    @staticmethod
+    def _derive(password: str, salt: bytes, ln: int, r: int, p: int) -> bytes:
+        n = 2**ln
+        return hashlib.scrypt(
+            password.encode("utf-8"),
+            salt=salt,
+            n=n,
+            r=r,
+            p=p,
+            maxmem=128 * r * (n + p + 2) + 2**20,
+            dklen=32,
+        )
+
+    def verify(self, password: str, hashed: str) -> bool:
+        # $scrypt$ln=16,r=8,p=1$salt$hash
+        try:
+            _, _, _, salt, checksum = hashed.split("$")
+            parameters = self.parameters(hashed)
+            expected = _b64decode(checksum)
+            derived = self._derive(password, _b64decode(salt), **parameters)
+        except (ValueError, KeyError) as e:
+            raise UnsupportedHash(f"invalid scrypt hash: {e}") from e
+
+        return hmac.compare_digest(derived, expected)
+
+    def hash(  # noqa: A003
+        self,
+        password: str,
+        ln: int = 16,
+        r: int = 8,
+        p: int = 1,
+    ) -> str:
+        salt = os.urandom(16)
+        derived = self._derive(password, salt, ln, r, p)
+        return f"$scrypt$ln={ln},r={r},p={p}${_b64encode(salt, False)}${_b64encode(derived, False)}"
+
+    def parameters(self, hashed: str) -> dict:
+        values = dict(part.split("=") for part in hashed.split("$")[2].split(","))
+        return {"ln": int(values["ln"]), "r": int(values["r"]), "p": int(values["p"])}
+
+    def levels(self) -> typing.Iterator[dict]:
+        for ln in range(12, 21):
+            yield {"ln": ln, "r": 8, "p": 1}
+
+
+class PBKDF2Verifier(Verifier):
+    name = "pbkdf2-sha256"
+    prefixes = ("$pbkdf2-sha256$",)
+
+    def verify(self, password: str, hashed: str) -> bool:
+        # $pbkdf2-sha256$29000$salt$hash
+        try:
+            _, _, rounds, salt, checksum = hashed.split("$")
+            expected = _b64decode(checksum)
+            derived = hashlib.pbkdf2_hmac(
+                "sha256",
+                password.encode("utf-8"),
+                _b64decode(salt),
+                int(rounds),
+                len(expected),
+            )
+        except ValueError as e:
+            raise UnsupportedHash(f"invalid pbkdf2-sha256 hash: {e}") from e
+
+        return hmac.compare_digest(derived, expected)
+
+    def hash(self, password: str, rounds: int = 600000) -> str:  # noqa: A003
+        salt = os.urandom(16)
+        derived = hashlib.pbkdf2_hmac(
+            "sha256",
+            password.encode("utf-8"),
+            salt,
+            rounds,
+            32,
+        )
+        return f"$pbkdf2-sha256${rounds}${_b64encode(salt)}${_b64encode(derived)}"
+
+    def parameters(self, hashed: str) -> dict:
+        return {"rounds": int(hashed.split("$")[2])}
+
+    def levels(self) -> typing.Iterator[dict]:
+        for exponent in range(14, 24):
+            yield {"rounds": 2**exponent}
+
+
+VERIFIERS: typing.List[Verifier] = [
+    BcryptVerifier(),
+    Argon2Verifier(),
+    ScryptVerifier(),
+    PBKDF2Verifier(),
+]
+
+
+def find_verifier(hashed: str) -> Verifier:
+    for verifier in VERIFIERS:
+        if hashed.startswith(verifier.prefixes):
+            return verifier
+
+    raise UnsupportedHash(f"unsupported password hash starting with {hashed[:12]!r}")
+
+
+def verifier_named(name: str) -> Verifier:
+    for verifier in VERIFIERS:
+        if verifier.name == name:
+            return verifier
+
+    raise UnsupportedHash(f"unknown password hash algorithm: {name}")
+
+
+def verify_password(password: str, hashed: str) -> bool:
+    return find_verifier(hashed).verify(password, hashed)
+
+
+def time_verification(hashed: str, repeat: int = 3) -> float:
+    # the fastest of a few tries is the closest to what the hash really costs
+    # without noise from everything else running on the host
+    verifier = find_verifier(hashed)
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        verifier.verify(CALIBRATION_PASSWORD, hashed)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def calibrate(verifier: Verifier, target: float) -> typing.Tuple[dict, float]:
+    # find the most expensive parameters that still verify within the target
+    # on this host. the cheapest parameters are returned even if they are too
+    # slow because there is nothing cheaper to recommend.
+    best: typing.Optional[typing.Tuple[dict, float]] = None
+    for parameters in verifier.levels():
+        seconds = time_verification(verifier.hash(CALIBRATION_PASSWORD, **parameters))
+        if seconds > target and best is not None:
+            break
+
+        best = (parameters, seconds)
+        if seconds > target:
+            break
+
+    if best is None:
+        raise UnsupportedHash(f"{verifier.name} has nothing to calibrate")
+    return best
+
+
+def report(
+    usernames: typing.Mapping[str, typing.Optional[str]],
+    target: float,
+    tolerance: float,
+) -> typing.List[dict]:
+    # every user with the same kind of hash and the same parameters costs the
+    # same to verify so each of those is only timed once
+    timings: typing.Dict[typing.Tuple[str, str], float] = {}
+
+    rows: typing.List[dict] = []
+    for username, hashed in sorted(usernames.items()):
+        if not hashed:
+            rows.append({"username": username, "status": "no password"})
+            continue
+
+        try:
+            verifier = find_verifier(hashed)
+            parameters = verifier.parameters(hashed)
+            key = (verifier.name, repr(sorted(parameters.items())))
+            if key not in timings:
+                timings[key] = time_verification(hashed)
+        except UnsupportedHash as e:
+            rows.append({"username": username, "status": f"unsupported: {e}"})
+            continue
+
+        seconds = timings[key]
+        if seconds > target * tolerance:
+            status = "over"
+        elif seconds < target / tolerance:
+            status = "under"
+        else:
+            status = "ok"
+
+        rows.append(
+            {
+                "username": username,
+                "algorithm": verifier.name,
+                "parameters": parameters,
+                "seconds": seconds,
+                "status": status,
+            },
+        )
+
+    return rows
+
+
+def _format_parameters(parameters: dict) -> str:
+    return ",".join(f"{name}={value}" for name, value in parameters.items())
+
+
+def main_calibrate(target: float, algorithms: typing.List[str]) -> int:
+    print(f"finding parameters that verify in {target * 1000:.0f}ms on this host")
+    for name in algorithms:
+        verifier = verifier_named(name)
+        try:
+            parameters, seconds = calibrate(verifier, target)
+        except UnsupportedHash as e:
+            print(f"{name}: {e}")
+            continue
+
+        print(
+            f"{name}: {_format_parameters(parameters)} verifies in {seconds * 1000:.1f}ms",
+        )
+
+    return 0
+
+
+def main_report(configuration_file: str, target: float, tolerance: float) -> int:
+    import statistics
+
+    from checkduo.checkduo import load_configuration, load_usernames
+
+    configuration = load_configuration(configuration_file)
+    rows = report(load_usernames(configuration), target, tolerance)
+
+    for row in rows:
+        if "seconds" not in row:
+            print(f"{row['username']}: {row['status']}")
+            continue
+
+        print(
+            f"{row['username']}: {row['status']} {row['algorithm']} {_format_parameters(row['parameters'])} {row['seconds'] * 1000:.1f}ms",
+        )
+
+    seconds = [row["seconds"] for row in rows if "seconds" in row]
+    if seconds:
+        print(
+            f"{len(seconds)} users, median {statistics.median(seconds) * 1000:.1f}ms, target {target * 1000:.0f}ms",
+        )
+
+    return 1 if any(row["status"] != "ok" for row in rows) else 0
+
+
+def main_hash(algorithm: str, parameters: typing.List[str]) -> int:
+    import getpass
+
+    verifier = verifier_named(algorithm)
+    password = (
+        getpass.getpass("password: ")
+        if sys.stdin.isatty()
+        else sys.stdin.readline().rstrip("\n")
+    )
+    if not password:
+        print("no password given")
+        return 1
+
+    values = dict(parameter.split("=", 1) for parameter in parameters)
+    print(
+        verifier.hash(password, **{name: int(value) for name, value in values.items()}),
+    )
+    return 0
+
+
+def cli() -> None:
+    # verifying passwords is on the path of every login so nothing that only
+    # the command line needs is imported until it is run
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="check-duo-passwords")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    algorithms = [verifier.name for verifier in VERIFIERS]
+
+    calibrate_parser = subparsers.add_parser(
+        "calibrate",
+        help="recommend hash parameters for this host",
+    )
+    calibrate_parser.add_argument(
+        "--target",
+        type=float,
+        default=0.1,
+        metavar="SECONDS",
+        help="how long verifying a password should take",
+    )
+    calibrate_parser.add_argument(
+        "--algorithm",
+        dest="algorithms",
+        action="append",
+        choices=algorithms,
+        help="the algorithms to calibrate, all of them by default",
+    )
+
+    report_parser = subparsers.add_parser(
+        "report",
+        help="list the users whose hashes are too slow or too fast to verify",
+    )
+    report_parser.add_argument(
+        "--configuration-file",
+        "-c",
+        required=True,
+        metavar="FILE",
+        help="the path to the authentication configuration",
+    )
+    report_parser.add_argument(
+        "--target",
+        type=float,
+        default=0.1,
+        metavar="SECONDS",
+        help="how long verifying a password should take",
+    )
+    report_parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=2,
+        help="how many times faster or slower than the target is still ok",
+    )
+
+    hash_parser = subparsers.add_parser(
+        "hash",
+        help="hash a password read from stdin",
+    )
+    hash_parser.add_argument("--algorithm", choices=algorithms, default="bcrypt")
+    hash_parser.add_argument(
+        "parameters",
+        nargs="*",
+        metavar="NAME=VALUE",
+        help="parameters for the algorithm, like cost=12 for bcrypt",
+    )
+
+    args = parser.parse_args()
+
+    try:
+        if args.command == "calibrate":
+            sys.exit(main_calibrate(args.target, args.algorithms or algorithms))
+        elif args.command == "report":
+            sys.exit(main_report(args.configuration_file, args.target, args.tolerance))
+        else:
+            sys.exit(main_hash(args.algorithm, args.parameters))
+    except Exception as exc:
+        print(f"could not {args.command}: {exc}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
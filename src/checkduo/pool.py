@@ -0,0 +1,143 @@
+import os
+import queue
+import threading
+import time
+import typing
+
+from checkduo.metrics import Metrics
+from checkduo.passwords import verify_password
+
+
+class VerificationPoolError(Exception):
+    pass
+
+
+class VerificationPoolFull(VerificationPoolError):
+    pass
+
+
+class VerificationTimeout(VerificationPoolError):
+    pass
+
+
+class Job:
+    def __init__(self, password: str, hashed: str) -> None:
+        self.password = password
+        self.hashed = hashed
+        self.queued = time.monotonic()
+        self.abandoned = False
+        self.valid: typing.Optional[bool] = None
+        self.error: typing.Optional[Exception] = None
+        self.done = threading.Event()
+
+
+class VerificationPool:
+    def __init__(
+        self,
+        workers: typing.Optional[int] = None,
+        queue_size: int = 64,
+        timeout: float = 5,
+        metrics: typing.Optional[Metrics] = None,
+    ) -> None:
+        # bcrypt and hashlib let go of the gil while they hash so threads are
+        # enough to use every core, and keeping to one per core stops a burst
+        # of logins from slowing every one of them down.
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.timeout = timeout
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.busy = 0
+        self.shed = 0
+        self.timeouts = 0
+
+        # when the queue is full new checks are turned away straight away
+        # rather than waiting behind work that will not finish in time
+        self._queue: "queue.Queue[typing.Optional[Job]]" = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._threads: typing.List[threading.Thread] = []
+
+    def start(self) -> None:
+        for number in range(self.workers):
+            thread = threading.Thread(
+                target=self._run,
+                name=f"verification-{number}",
+                daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+        self.metrics.gauge(
+            "verification_queue_depth",
+            "Password checks waiting for a verification worker.",
+            self._queue.qsize,
+        )
+        self.metrics.gauge(
+            "verification_workers_busy",
+            "Verification workers that are checking a password.",
+            lambda: self.busy,
+        )
+
+    def close(self) -> None:
+        # workers finish what is ahead of these before they stop
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+
+            # nobody is waiting for a check that has already timed out
+            if job.abandoned:
+                continue
+
+            self.metrics.observe("verification_wait", time.monotonic() - job.queued)
+            with self._lock:
+                self.busy += 1
+            try:
+                job.valid = verify_password(job.password, job.hashed)
+            except Exception as e:
+                job.error = e
+            finally:
+                with self._lock:
+                    self.busy -= 1
+                job.done.set()
+
+    def verify(self, password: str, hashed: str) -> bool:
+        # returns what verify_password would or raises if the check could not
+        # be done in time
+        job = Job(password, hashed)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full as e:
+            with self._lock:
+                self.shed += 1
+            raise VerificationPoolFull(
+                "too many passwords are waiting to be checked",
+            ) from e
+
+        if not job.done.wait(self.timeout):
+            job.abandoned = True
+            with self._lock:
+                self.timeouts += 1
+            raise VerificationTimeout(
+                f"password was not checked within {self.timeout} seconds",
+            )
+
+        if job.error is not None:
+            raise job.error
+        return bool(job.valid)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "busy": self.busy,
+                "queued": self._queue.qsize(),
+                "capacity": self._queue.maxsize,
+                "shed": self.shed,
+                "timeouts": self.timeouts,
+            }
@@ -0,0 +1,219 @@
+import collections
+import threading
+import time
+import typing
+
+# redis is only imported by the limiter that uses it
+
+# how long to stop asking redis after it could not be reached so that every
+# request during an outage does not wait for a connection to time out
+REDIS_RETRY_INTERVAL = 5
+
+# see whether every bucket has a token left or, when the first argument is 1,
+# take a token from every bucket. buckets are hashes of the tokens left and
+# when that was worked out, and they expire once they would have filled up
+# again anyway. redis supplies the time so that every host agrees on it.
+TOKEN_BUCKET_SCRIPT = """
+local now = redis.call("TIME")
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local take = ARGV[1] == "1"
+
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local bucket = redis.call("HMGET", key, "tokens", "updated")
+    local tokens = tonumber(bucket[1]) or burst
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    if tokens < 1 and not take then
+        return 0
+    end
+    levels[i] = tokens
+end
+
+if not take then
+    return 1
+end
+
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local tokens = math.max(0, levels[i] - 1)
+    redis.call("HSET", key, "tokens", tostring(tokens), "updated", tostring(now))
+    redis.call("PEXPIRE", key, math.ceil(burst / rate * 1000))
+end
+return 1
+"""  # noqa: S105
+
+
+class Bucket(typing.NamedTuple):
+    key: str
+    rate: float
+    burst: int
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        ip: typing.Optional[dict] = None,
+        username: typing.Optional[dict] = None,
+        prefix: str = "rate-limit:",
+    ) -> None:
+        # each limit is how many checks can happen at once and how many more
+        # are allowed every second after that
+        self.ip = {"rate": 1.0, "burst": 20, **(ip or {})}
+        self.username = {"rate": 0.5, "burst": 10, **(username or {})}
+        self.prefix = prefix
+        self.allowed = 0
+        self.limited = 0
+        self._lock = threading.Lock()
+
+    def buckets(self, username: str, ip_address: str) -> typing.List[Bucket]:
+        buckets = [Bucket(f"{self.prefix}user:{username}", **self.username)]
+        if ip_address:
+            buckets.append(Bucket(f"{self.prefix}ip:{ip_address}", **self.ip))
+        return buckets
+
+    def allow(self, username: str, ip_address: str) -> bool:
+        # returns true if this user from this address may have their password
+        # checked right now. nothing is used up until a check fails so that
+        # people who know their password are never limited.
+        allowed = self._update(self.buckets(username, ip_address), take=False)
+        with self._lock:
+            if allowed:
+                self.allowed += 1
+            else:
+                self.limited += 1
+        return allowed
+
+    def failed(self, username: str, ip_address: str) -> None:
+        # a wrong password uses up a token from every bucket
+        self._update(self.buckets(username, ip_address), take=True)
+
+    def _update(self, buckets: typing.List[Bucket], take: bool) -> bool:
+        # returns whether every bucket has a token, taking one from each when
+        # asked to. a bucket that is already empty stays empty.
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"allowed": self.allowed, "limited": self.limited}
+
+
+class LocalRateLimiter(RateLimiter):
+    def __init__(self, size: int = 10000, **kwargs: typing.Any) -> None:
+        super().__init__(**kwargs)
+        self.size = size
+
+        # the tokens left in each bucket and when that was worked out. the
+        # buckets that were used least recently are forgotten first, which
+        # only ever lets someone have another try.
+        self._buckets: typing.OrderedDict[str, typing.Tuple[float, float]]
+        self._buckets = collections.OrderedDict()
+        self._bucket_lock = threading.Lock()
+
+    def _update(self, buckets: typing.List[Bucket], take: bool) -> bool:
+        now = time.monotonic()
+
+        with self._bucket_lock:
+            levels = []
+            for bucket in buckets:
+                tokens, updated = self._buckets.get(bucket.key, (bucket.burst, now))
+                tokens = min(bucket.burst, tokens + (now - updated) * bucket.rate)
+                if tokens < 1 and not take:
+                    return False
+                levels.append(tokens)
+
+            if not take:
+                return True
+
+            for bucket, tokens in zip(buckets, levels):
+                self._buckets[bucket.key] = (max(0, tokens - 1), now)
+                self._buckets.move_to_end(bucket.key)
+            while len(self._buckets) > self.size:
+                self._buckets.popitem(last=False)
+
+        return True
+
+
+class RedisRateLimiter(RateLimiter):
+    def __init__(
+        self,
+        redis: dict,
+        ip: typing.Optional[dict] = None,
+        username: typing.Optional[dict] = None,
+        prefix: str = "rate-limit:",
+    ) -> None:
+        from checkduo.stores import redis_clients
+
+        # all of the buckets for a check have to be on the same node for the
+        # script to see them at once
+        if redis.get("cluster"):
+            prefix = f"{{{prefix}}}"
+
+        super().__init__(ip=ip, username=username, prefix=prefix)
+
+        # limits are always read and written on the primary
+        self.redis, _ = redis_clients(
+            **{
+                name: value
+                for name, value in redis.items()
+                if name not in ("replicas", "read_from_replicas")
+            },
+        )
+        self.script = self.redis.register_script(TOKEN_BUCKET_SCRIPT)
+        self.fallbacks = 0
+        self._retry_at = 0.0
+
+        # when redis cannot be reached every process limits on its own
+        self.fallback = LocalRateLimiter(ip=ip, username=username, prefix=prefix)
+
+    def _update(self, buckets: typing.List[Bucket], take: bool) -> bool:
+        from redis import exceptions
+
+        if time.monotonic() >= self._retry_at:
+            arguments: typing.List[float] = [1 if take else 0]
+            for bucket in buckets:
+                arguments.extend([bucket.rate, bucket.burst])
+
+            try:
+                keys = [bucket.key for bucket in buckets]
+                return bool(self.script(keys=keys, args=arguments))
+            except (exceptions.ConnectionError, exceptions.TimeoutError) as e:
+                print(f"using local rate limits: could not reach redis: {e}")
+                self._retry_at = time.monotonic() + REDIS_RETRY_INTERVAL
+
+        with self._lock:
+            self.fallbacks += 1
+        return self.fallback._update(buckets, take)
+
+    def close(self) -> None:
+        self.redis.close()
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        with self._lock:
+            stats["fallbacks"] = self.fallbacks
+        return stats
+
+
+def create_rate_limiter(
+    configuration: dict,
+    cache: dict,
+    prefix: str = "rate-limit:",
+) -> RateLimiter:
+    # limits are kept in the same redis as sessions when there is one so that
+    # every host shares them. the prefix has to keep them apart from sessions.
+    if cache.get("backend", "redis") != "redis":
+        return LocalRateLimiter(**configuration, prefix=prefix)
+
+    redis = {
+        name: value
+        for name, value in cache.items()
+        if name not in ("backend", "prefix", "fallback", "local")
+    }
+    return RedisRateLimiter(redis, **configuration, prefix=prefix)
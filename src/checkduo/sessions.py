@@ -0,0 +1,159 @@
+import argparse
+import hashlib
+import json
+import sys
+import time
+import typing
+from datetime import datetime
+
+from checkduo.checkduo import REMEMBERED, load_configuration, session_index
+from checkduo.stores import Session, SessionStore, create_session_store
+
+
+def created(session: Session) -> typing.Optional[datetime]:
+    # when the user went through duo, if the session says
+    try:
+        return datetime.fromisoformat(json.loads(session.value)["timestamp"])
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+def fingerprint(session: Session, prefix: str) -> str:
+    # the key is the cookie, which would log in anybody who had it, so it is
+    # never shown
+    return hashlib.sha256(session.key[len(prefix) :].encode("utf-8")).hexdigest()[:12]
+
+
+def find_sessions(
+    store: SessionStore,
+    prefix: str,
+    username: str,
+    older_than: typing.Optional[float] = None,
+) -> typing.List[Session]:
+    # only the index for this user is read so this costs the same no matter
+    # how many other sessions there are
+    sessions = store.sessions(session_index(prefix, username))
+    if older_than is None:
+        return sessions
+
+    # a session that does not say when it was made is treated as old
+    now = datetime.utcnow()
+    found = []
+    for session in sessions:
+        started = created(session)
+        if started is None or (now - started).total_seconds() > older_than:
+            found.append(session)
+    return found
+
+
+def main_list(
+    configuration: dict,
+    usernames: typing.List[str],
+    older_than: typing.Optional[float],
+) -> int:
+    prefix = configuration["cache"].get("prefix", "")
+    store = create_session_store(configuration["cache"])
+    try:
+        now = time.time()
+        for username in usernames:
+            for session in find_sessions(store, prefix, username, older_than):
+                started = created(session) or "unknown"
+                expires = max(session.expires - now, 0)
+                device = session.key.startswith(f"{prefix}{REMEMBERED}")
+                kind = " (remembered device)" if device else ""
+                print(
+                    f"{username} {fingerprint(session, prefix)} created {started} expires in {expires:.0f}s{kind}",
+                )
+    finally:
+        store.close()
+    return 0
+
+
+def main_count(
+    configuration: dict,
+    usernames: typing.List[str],
+    older_than: typing.Optional[float],
+) -> int:
+    prefix = configuration["cache"].get("prefix", "")
+    store = create_session_store(configuration["cache"])
+    try:
+        for username in usernames:
+            sessions = find_sessions(store, prefix, username, older_than)
+            print(f"{username} {len(sessions)}")
+    finally:
+        store.close()
+    return 0
+
+
+def main_revoke(
+    configuration: dict,
+    usernames: typing.List[str],
+    older_than: typing.Optional[float],
+) -> int:
+    prefix = configuration["cache"].get("prefix", "")
+    store = create_session_store(configuration["cache"])
+    try:
+        for username in usernames:
+            sessions = find_sessions(store, prefix, username, older_than)
+            store.revoke(
+                session_index(prefix, username),
+                [session.key for session in sessions],
+            )
+            print(f"revoked {len(sessions)} sessions for {username}")
+    finally:
+        store.close()
+    return 0
+
+
+def cli() -> None:
+    parser = argparse.ArgumentParser(prog="check-duo-sessions")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    commands = {
+        "list": (main_list, "list a user's sessions"),
+        "count": (main_count, "count a user's sessions"),
+        "revoke": (main_revoke, "log a user out so that they go through duo again"),
+    }
+    for name, (_, description) in commands.items():
+        subparser = subparsers.add_parser(name, help=description)
+        subparser.add_argument(
+            "--configuration-file",
+            "-c",
+            required=True,
+            metavar="FILE",
+            help="the path to the authentication configuration",
+        )
+        subparser.add_argument(
+            "--user",
+            "-u",
+            dest="usernames",
+            action="append",
+            required=True,
+            metavar="USERNAME",
+            help="the user whose sessions to look at, can be given more than once",
+        )
+        subparser.add_argument(
+            "--older-than",
+            type=float,
+            metavar="SECONDS",
+            help="only sessions that were created more than this long ago",
+        )
+
+    args = parser.parse_args()
+    main, _ = commands[args.command]
+
+    try:
+        sys.exit(
+            main(
+                load_configuration(args.configuration_file),
+                args.usernames,
+                args.older_than,
+            ),
+        )
+    except Exception as exc:
+        print(f"could not {args.command} sessions: {exc}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
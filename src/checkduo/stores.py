@@ -0,0 +1,1219 @@
+import collections
+import contextlib
+import hashlib
+import json
+import math
+import random
+import socket
+import sqlite3
+import threading
+import time
+import typing
+
+# memcached treats any expiry longer than this as a unix timestamp
+MEMCACHED_MAX_RELATIVE_EXPIRY = 60 * 60 * 24 * 30
+
+T = typing.TypeVar("T")
+
+# push back when a session ends, but never past the expires that its value
+# says it must end by. sessions without one are left alone.
+REFRESH_SCRIPT = """
+local value = redis.call("GET", KEYS[1])
+if not value then
+    return 0
+end
+
+local ok, session = pcall(cjson.decode, value)
+if not ok or type(session) ~= "table" or not tonumber(session["expires"]) then
+    return 0
+end
+
+local now = redis.call("TIME")
+now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local ends = math.min(now + tonumber(ARGV[1]) * 1000, tonumber(session["expires"]) * 1000)
+redis.call("PEXPIREAT", KEYS[1], math.floor(ends))
+return 1
+"""
+
+# give a key longer to live but never less. a key without an expiry is given
+# one. this is what EXPIRE with NX and GT does, but that needs redis 7.
+EXTEND_SCRIPT = """
+local ttl = redis.call("PTTL", KEYS[1])
+local expiry = tonumber(ARGV[1]) * 1000
+if ttl >= expiry then
+    return 0
+end
+
+redis.call("PEXPIRE", KEYS[1], expiry)
+return 1
+"""
+
+
+class SessionStoreError(Exception):
+    pass
+
+
+class Session(typing.NamedTuple):
+    key: str
+    value: str
+    expires: float  # unix time
+
+
+class Lookup(typing.NamedTuple):
+    value: str
+    remaining: typing.Optional[float]  # seconds, or None if the store cannot tell
+
+
+class SessionStore:
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def lookup(self, key: str) -> typing.Optional[Lookup]:
+        # what a session was written with and how long it has left, or None
+        # if it does not exist. stores that can read both at once do.
+        value = self.get(key)
+        if value is None:
+            return None
+        return Lookup(value, self.remaining(key))
+
+    def remaining(self, key: str) -> typing.Optional[float]:
+        # how many seconds the session has left, or None if it does not exist
+        # or the store cannot tell. memcached cannot tell.
+        return None
+
+    def get(self, key: str) -> typing.Optional[str]:
+        raise NotImplementedError
+
+    def set(  # noqa: A003
+        self,
+        key: str,
+        value: str,
+        expiry: int,
+        index: typing.Optional[str] = None,
+        idle: typing.Optional[int] = None,
+    ) -> None:
+        # sessions written with an index can be found again with sessions()
+        # without looking through every session in the store. sessions with
+        # an idle timeout end after that long unless they are refreshed.
+        raise NotImplementedError
+
+    def claim(self, key: str, value: str, expiry: int) -> bool:
+        # set the key only if it does not already exist. returns true if it
+        # was set by us.
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def sessions(self, index: str) -> typing.List[Session]:
+        # the sessions that are still alive under an index. entries for
+        # sessions that have expired or been removed are pruned as we go.
+        raise SessionStoreError(f"{type(self).__name__} does not index sessions")
+
+    def revoke(self, index: str, keys: typing.List[str]) -> None:
+        # delete sessions and remove them from an index
+        raise SessionStoreError(f"{type(self).__name__} does not index sessions")
+
+    def refresh(self, keys: typing.List[str], idle: int) -> None:
+        # let sessions live for another idle seconds but never past the
+        # expires, as a unix time, in their value
+        raise NotImplementedError
+
+    def increment(self, key: str, expiry: int) -> int:
+        # add one to a counter, creating it if needed, and return the total.
+        # the counter goes away expiry seconds after it was last changed.
+        raise NotImplementedError
+
+    def start(self) -> None:
+        # called once by long running processes to start any background work
+        pass
+
+    def close(self) -> None:
+        # called by long running processes once the store is no longer used
+        pass
+
+    def stats(self) -> dict:
+        return {}
+
+
+def redis_clients(
+    sentinel: typing.Optional[dict] = None,
+    cluster: bool = False,
+    replicas: typing.Optional[typing.List[dict]] = None,
+    read_from_replicas: bool = False,
+    **kwargs: typing.Any,
+) -> typing.Tuple[typing.Any, typing.List[typing.Any]]:
+    # returns a client for the primary and any clients that reads can go to
+    # instead. everything else in the configuration is passed straight through
+    # so that any option that the redis library supports can be used.
+    if sentinel is not None:
+        from redis.sentinel import Sentinel
+
+        hosts = []
+        for entry in sentinel["hosts"]:
+            host, _, port = entry.partition(":")
+            hosts.append((host, int(port) if port else 26379))
+
+        manager = Sentinel(hosts, **kwargs)
+        primary = manager.master_for(sentinel["service"])
+        if read_from_replicas:
+            # this spreads reads over every replica that sentinel knows about
+            # and uses the primary when there are none
+            return primary, [manager.slave_for(sentinel["service"])]
+        return primary, []
+
+    if cluster:
+        from redis.cluster import RedisCluster
+
+        # the cluster sends every command for a key to the node that has it.
+        # a second client is allowed to send reads to that node's replicas.
+        primary = RedisCluster(**kwargs)
+        if read_from_replicas:
+            return primary, [RedisCluster(read_from_replicas=True, **kwargs)]
+        return primary, []
+
+    from redis import Redis
+
+    return Redis(**kwargs), [
+        Redis(**{**kwargs, **replica}) for replica in (replicas or [])
+    ]
+
+
+class RedisSessionStore(SessionStore):
+    def __init__(self, **kwargs: typing.Any) -> None:
+        self.redis, self.replicas = redis_clients(**kwargs)
+        self.replica_hits = 0
+        self.primary_rechecks = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _errors(self) -> typing.Iterator[None]:
+        from redis import exceptions
+
+        try:
+            yield
+        except (exceptions.ConnectionError, exceptions.TimeoutError) as e:
+            raise SessionStoreError(f"could not reach redis: {e}") from e
+
+    def _read(
+        self,
+        command: typing.Callable[[typing.Any], T],
+        found: typing.Callable[[T], bool],
+    ) -> T:
+        # session lookups go to a replica when there is one. a session that
+        # was only just written might not have reached the replica yet so a
+        # miss, or a replica that cannot be reached, is asked of the primary.
+        if self.replicas:
+            from redis import exceptions
+
+            try:
+                value = command(random.choice(self.replicas))  # noqa: S311
+            except (exceptions.ConnectionError, exceptions.TimeoutError):
+                pass
+            else:
+                if found(value):
+                    with self._lock:
+                        self.replica_hits += 1
+                    return value
+
+            with self._lock:
+                self.primary_rechecks += 1
+
+        with self._errors():
+            return command(self.redis)
+
+    def exists(self, key: str) -> bool:
+        return self._read(lambda client: bool(client.exists(key)), bool)
+
+    def remaining(self, key: str) -> typing.Optional[float]:
+        ttl = self._read(lambda client: client.pttl(key), lambda ttl: ttl != -2)
+
+        if ttl == -2:
+            return None  # no such key
+        if ttl < 0:
+            return float("inf")  # no expiry
+        return ttl / 1000
+
+    def lookup(self, key: str) -> typing.Optional[Lookup]:
+        from redis import exceptions
+
+        def read(client: typing.Any) -> typing.List[typing.Any]:
+            pipeline = client.pipeline(transaction=False)
+            pipeline.get(key)
+            pipeline.pttl(key)
+            return pipeline.execute()
+
+        try:
+            value, ttl = self._read(read, lambda result: result[0] is not None)
+        except exceptions.ResponseError:
+            return None  # something that is not a string is never a session
+
+        if value is None:
+            return None
+        return Lookup(
+            value.decode("utf-8", "replace"),
+            ttl / 1000 if ttl >= 0 else float("inf"),
+        )
+
+    def set(  # noqa: A003
+        self,
+        key: str,
+        value: str,
+        expiry: int,
+        index: typing.Optional[str] = None,
+        idle: typing.Optional[int] = None,
+    ) -> None:
+        # an expiry of zero means that sessions are never remembered
+        if expiry <= 0:
+            return
+
+        ttl = expiry if idle is None else min(idle, expiry)
+        if index is None:
+            with self._errors():
+                self.redis.set(key, value, ex=ttl)
+            return
+
+        # the index is a sorted set of session keys scored by when they
+        # expire. it is written in the same round trip as the session, which
+        # is also a good time to drop anything in it that has expired. the
+        # index has to outlive everything in it, so an index that already
+        # expires is only ever given longer.
+        now = time.time()
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.set(key, value, ex=ttl)
+        pipeline.zadd(index, {key: now + expiry})
+        pipeline.zremrangebyscore(index, "-inf", now)
+        pipeline.eval(EXTEND_SCRIPT, 1, index, expiry)
+        with self._errors():
+            pipeline.execute()
+
+    def get(self, key: str) -> typing.Optional[str]:
+        with self._errors():
+            value = self.redis.get(key)
+        return None if value is None else value.decode("utf-8")
+
+    def claim(self, key: str, value: str, expiry: int) -> bool:
+        with self._errors():
+            return bool(self.redis.set(key, value, ex=expiry, nx=True))
+
+    def delete(self, key: str) -> None:
+        with self._errors():
+            self.redis.delete(key)
+
+    def sessions(self, index: str) -> typing.List[Session]:
+        now = time.time()
+        with self._errors():
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.zremrangebyscore(index, "-inf", now)
+            pipeline.zrange(index, 0, -1, withscores=True)
+            _, entries = pipeline.execute()
+            if not entries:
+                return []
+
+            pipeline = self.redis.pipeline(transaction=False)
+            for key, _ in entries:
+                pipeline.get(key)
+            values = pipeline.execute()
+
+            # sessions that were deleted or evicted before they expired are
+            # still in the index until somebody looks
+            sessions = []
+            stale = []
+            for (key, expires), value in zip(entries, values):
+                key = key.decode("utf-8")
+                if value is None:
+                    stale.append(key)
+                else:
+                    sessions.append(Session(key, value.decode("utf-8"), expires))
+            if stale:
+                self.redis.zrem(index, *stale)
+
+        return sessions
+
+    def revoke(self, index: str, keys: typing.List[str]) -> None:
+        if not keys:
+            return
+
+        # keys are deleted one at a time because in a cluster they can be on
+        # different nodes
+        pipeline = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipeline.delete(key)
+        pipeline.zrem(index, *keys)
+        with self._errors():
+            pipeline.execute()
+
+    def refresh(self, keys: typing.List[str], idle: int) -> None:
+        # one script call for each session so that in a cluster each goes to
+        # the node that has it. the script is sent every time because a
+        # cluster pipeline cannot load it ahead of time.
+        pipeline = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipeline.eval(REFRESH_SCRIPT, 1, key, idle)
+        with self._errors():
+            pipeline.execute()
+
+    def increment(self, key: str, expiry: int) -> int:
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.incr(key)
+        pipeline.expire(key, expiry)
+        with self._errors():
+            count, _ = pipeline.execute()
+        return int(count)
+
+    def close(self) -> None:
+        self.redis.close()
+        for replica in self.replicas:
+            replica.close()
+
+    def stats(self) -> dict:
+        if not self.replicas:
+            return {}
+
+        with self._lock:
+            return {
+                "replica_hits": self.replica_hits,
+                "primary_rechecks": self.primary_rechecks,
+            }
+
+
+class SQLiteSessionStore(SessionStore):
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+        # sqlite connections cannot be shared between threads so every thread
+        # that the daemon uses gets its own.
+        self._local = threading.local()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            try:
+                connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("PRAGMA synchronous=NORMAL")
+                connection.execute(
+                    """
+                        CREATE TABLE IF NOT EXISTS sessions (
+                            key TEXT PRIMARY KEY,
+                            value TEXT NOT NULL,
+                            expires REAL NOT NULL
+                        )
+                    """,
+                )
+                connection.execute(
+                    """
+                        CREATE TABLE IF NOT EXISTS session_index (
+                            name TEXT NOT NULL,
+                            key TEXT NOT NULL,
+                            PRIMARY KEY (name, key)
+                        ) WITHOUT ROWID
+                    """,
+                )
+            except sqlite3.Error as e:
+                raise SessionStoreError(f"could not open {self.path}: {e}") from e
+            self._local.connection = connection
+        return connection
+
+    def exists(self, key: str) -> bool:
+        try:
+            row = self.connection.execute(
+                "SELECT 1 FROM sessions WHERE key = ? AND expires > ?",
+                (key, time.time()),
+            ).fetchone()
+        except sqlite3.Error as e:
+            raise SessionStoreError(f"could not read {self.path}: {e}") from e
+        return row is not None
+
+    def remaining(self, key: str) -> typing.Optional[float]:
+        now = time.time()
+        try:
+            row = self.connection.execute(
+                "SELECT expires FROM sessions WHERE key = ? AND expires > ?",
+                (key, now),
+            ).fetchone()
+        except sqlite3.Error as e:
+            raise SessionStoreError(f"could not read {self.path}: {e}") from e
+        return None if row is None else row[0] - now
+
+    def lookup(self, key: str) -> typing.Optional[Lookup]:
+        now = time.time()
+        try:
+            row = self.connection.execute(
+                "SELECT value, expires FROM sessions WHERE key = ? AND expires > ?",
+                (key, now),
+            ).fetchone()
+        except sqlite3.Error as e:
+            raise SessionStoreError(f"could not read {self.path}: {e}") from e
+        return None if row is None else Lookup(str(row[0]), row[1] - now)
+
+    def set(  # noqa: A003
+        self,
+        key: str,
+        value: str,
+        expiry: int,
+        index: typing.Optional[str] = None,
+        idle: typing.Optional[int] = None,
+    ) -> None:
+        if expiry <= 0:
+            return
+
+        now = time.time()
+        try:
+            with self.connection as connection:
+                connection.execute("BEGIN IMMEDIATE")
+                # writes only happen after a successful duo push so this is a
+                # good time to throw away anything that has expired.
+                connection.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+                connection.execute(
+                    "INSERT OR REPLACE INTO sessions (key, value, expires) VALUES (?, ?, ?)",
+                    (key, value, now + (expiry if idle is None else min(idle, expiry))),
+                )
+                if index is not None:
+                    connection.execute(
+                        "INSERT OR IGNORE INTO session_index (name, key) VALUES (?, ?)",
+                        (index, key),
+                    )
+        except sqlite3.Error as e:
+            raise SessionStoreError(f"could not write {self.path}: {e}") from e
+
+    def get(self, key: str) -> typing.Optional[str]:
+        try:
+            row = self.connection.execute(
+                "SELECT value FROM sessions WHERE key = ? AND expires > ?",
+                (key, time.time()),
+            ).fetchone()
+        except sqlite3.Error as e:
+            raise SessionStoreError(f"could not read {self.path}: {e}") from e
+        return None if row is None else row[0]
+
+    def claim(self, key: str, value: str, expiry: int) -> bool:
+        now = time.time()
+        try:
+            with self.connection as connection:
+                connection.execute("BEGIN IMMEDIATE")
+                connection.execute(
+                    "DELETE FROM sessions WHERE key = ? AND expires <= ?",
+                    (key, now),
+                )
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO sessions (key, value, expires) VALUES (?, ?, ?)",
+                    (key, value, now + expiry),
+                )
+                return cursor.rowcount == 1
+        except sqlite3.Error as e:
+            raise SessionStoreError(f"could not write {self.path}: {e}") from e
+
+    def delete(self, key: str) -> None:
+        try:
+            self.connection.execute("DELETE FROM sessions WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            raise SessionStoreError(f"could not write {self.path}: {e}") from e
+
+    def sessions(self, index: str) -> typing.List[Session]:
+        now = time.time()
+        try:
+            with self.connection as connection:
+                connection.execute("BEGIN IMMEDIATE")
+                connection.execute(
+                    """
+                        DELETE FROM session_index
+                        WHERE name = ? AND NOT EXISTS (
+                            SELECT 1 FROM sessions
+                            WHERE sessions.key = session_index.key
+                            AND expires > ?
+                        )
+                    """,
+                    (index, now),
+                )
+                rows = connection.execute(
+                    """
+                        SELECT sessions.key, sessions.value, sessions.expires
+                        FROM session_index
+                        JOIN sessions ON sessions.key = session_index.key
+                        WHERE session_index.name = ?
+                    """,
+                    (index,),
+                ).fetchall()
+        except sqlite3.Error as e:
+            raise SessionStoreError(f"could not read {self.path}: {e}") from e
+        return [Session(*row) for row in rows]
+
+    def revoke(self, index: str, keys: typing.List[str]) -> None:
+        try:
+            with self.connection as connection:
+                connection.execute("BEGIN IMMEDIATE")
+                connection.executemany(
+                    "DELETE FROM sessions WHERE key = ?",
+                    [(key,) for key in keys],
+                )
+                connection.executemany(
+                    "DELETE FROM session_index WHERE name = ? AND key = ?",
+                    [(index, key) for key in keys],
+                )
+        except sqlite3.Error as e:
+            raise SessionStoreError(f"could not write {self.path}: {e}") from e
+
+    def refresh(self, keys: typing.List[str], idle: int) -> None:
+        now = time.time()
+        try:
+            self.connection.executemany(
+                """
+                    UPDATE sessions
+                    SET expires = MIN(?, json_extract(value, '$.expires'))
+                    WHERE key = ? AND expires > ? AND (
+                        CASE WHEN json_valid(value)
+                        THEN json_extract(value, '$.expires')
+                        END
+                    ) IS NOT NULL
+                """,
+                [(now + idle, key, now) for key in keys],
+            )
+        except sqlite3.Error as e:
+            raise SessionStoreError(f"could not write {self.path}: {e}") from e
+
+    def increment(self, key: str, expiry: int) -> int:
+        now = time.time()
+        try:
+            with self.connection as connection:
+                connection.execute("BEGIN IMMEDIATE")
+                connection.execute(
+                    "DELETE FROM sessions WHERE key = ? AND expires <= ?",
+                    (key, now),
+                )
+                connection.execute(
+                    """
+                        INSERT INTO sessions (key, value, expires) VALUES (?, 1, ?)
+                        ON CONFLICT (key) DO UPDATE SET
+                            value = CAST(value AS INTEGER) + 1,
+                            expires = excluded.expires
+                    """,
+                    (key, now + expiry),
+                )
+                row = connection.execute(
+                    "SELECT value FROM sessions WHERE key = ?",
+                    (key,),
+                ).fetchone()
+        except sqlite3.Error as e:
+            raise SessionStoreError(f"could not write {self.path}: {e}") from e
+        return int(row[0])
+
+
+class MemcachedSessionStore(SessionStore):
+    def __init__(self, host: str, port: int = 11211, timeout: float = 5) -> None:
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._socket: typing.Optional[socket.socket] = None
+        self._file: typing.Optional[typing.BinaryIO] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(key: str) -> str:
+        # memcached keys are limited in length and cannot contain whitespace
+        # but session cookies are long. every key is hashed, because hashing
+        # only the unusual ones would let a cookie that is the hash of another
+        # key, like a pending marker, read that key.
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _command(
+        self,
+        command: bytes,
+        payload: typing.Optional[bytes] = None,
+    ) -> typing.List[bytes]:
+        with self._lock:
+            try:
+                if self._socket is None or self._file is None:
+                    self._socket = socket.create_connection(
+                        (self.host, self.port),
+                        timeout=self.timeout,
+                    )
+                    self._file = self._socket.makefile("rb")
+
+                request = command + b"\r\n"
+                if payload is not None:
+                    request += payload + b"\r\n"
+                self._socket.sendall(request)
+
+                # read until the end of the response. a get ends with END and
+                # everything else that we send is a single line.
+                lines = []
+                while True:
+                    line = self._file.readline()
+                    if not line:
+                        raise OSError("connection closed by server")
+                    lines.append(line.rstrip(b"\r\n"))
+                    if not command.startswith(b"get ") or lines[-1] == b"END":
+                        return lines
+            except OSError as e:
+                self._close()
+                raise SessionStoreError(f"could not reach memcached: {e}") from e
+
+    def _close(self) -> None:
+        for resource in (self._file, self._socket):
+            if resource is not None:
+                with contextlib.suppress(OSError):
+                    resource.close()
+        self._socket = None
+        self._file = None
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+
+    def exists(self, key: str) -> bool:
+        lines = self._command(f"get {self._key(key)}".encode("utf-8"))
+        return lines[0].startswith(b"VALUE ")
+
+    @staticmethod
+    def _expiry(expiry: int) -> int:
+        if expiry > MEMCACHED_MAX_RELATIVE_EXPIRY:
+            return int(time.time()) + expiry
+        return expiry
+
+    def _store(self, command: str, key: str, value: str, expiry: int) -> bool:
+        payload = value.encode("utf-8")
+        lines = self._command(
+            f"{command} {self._key(key)} 0 {self._expiry(expiry)} {len(payload)}".encode(
+                "utf-8",
+            ),
+            payload,
+        )
+        if lines[0] not in (b"STORED", b"NOT_STORED"):
+            raise SessionStoreError(f"memcached would not store session: {lines[0]!r}")
+        return lines[0] == b"STORED"
+
+    def get(self, key: str) -> typing.Optional[str]:
+        lines = self._command(f"get {self._key(key)}".encode("utf-8"))
+        if not lines[0].startswith(b"VALUE "):
+            return None
+        return lines[1].decode("utf-8")
+
+    def set(  # noqa: A003
+        self,
+        key: str,
+        value: str,
+        expiry: int,
+        index: typing.Optional[str] = None,
+        idle: typing.Optional[int] = None,
+    ) -> None:
+        # memcached has no way to list keys so there is no index
+        if expiry <= 0:
+            return
+
+        ttl = expiry if idle is None else min(idle, expiry)
+        if not self._store("set", key, value, ttl):
+            raise SessionStoreError("memcached would not store session")
+
+    def claim(self, key: str, value: str, expiry: int) -> bool:
+        return self._store("add", key, value, expiry)
+
+    def delete(self, key: str) -> None:
+        self._command(f"delete {self._key(key)}".encode("utf-8"))
+
+    def refresh(self, keys: typing.List[str], idle: int) -> None:
+        # touch cannot be limited by anything so we read each session first
+        for key in keys:
+            value = self.get(key)
+            try:
+                expires = float(json.loads(value or "")["expires"])
+            except (ValueError, TypeError, KeyError):
+                continue
+
+            ttl = min(idle, expires - time.time())
+            if ttl <= 0:
+                self.delete(key)
+            else:
+                self._command(
+                    f"touch {self._key(key)} {self._expiry(math.ceil(ttl))}".encode(
+                        "utf-8",
+                    ),
+                )
+
+    def increment(self, key: str, expiry: int) -> int:
+        # incr does not create counters or change when they expire, so a
+        # counter lasts for expiry seconds from when it was created
+        command = f"incr {self._key(key)} 1".encode("utf-8")
+        lines = self._command(command)
+        if lines[0] == b"NOT_FOUND":
+            if self._store("add", key, "1", expiry):
+                return 1
+            lines = self._command(command)
+
+        try:
+            return int(lines[0])
+        except ValueError as e:
+            raise SessionStoreError(
+                f"memcached would not increment counter: {lines[0]!r}",
+            ) from e
+
+
+class FailoverSessionStore(SessionStore):
+    def __init__(self, primary: SessionStore, fallback: SessionStore) -> None:
+        self.primary = primary
+        self.fallback = fallback
+
+    def exists(self, key: str) -> bool:
+        try:
+            return self.primary.exists(key)
+        except SessionStoreError as e:
+            print(f"using fallback session store: {e}")
+            return self.fallback.exists(key)
+
+    def set(  # noqa: A003
+        self,
+        key: str,
+        value: str,
+        expiry: int,
+        index: typing.Optional[str] = None,
+        idle: typing.Optional[int] = None,
+    ) -> None:
+        try:
+            self.primary.set(key, value, expiry, index=index, idle=idle)
+        except SessionStoreError as e:
+            print(f"using fallback session store: {e}")
+            self.fallback.set(key, value, expiry, index=index, idle=idle)
+
+    def remaining(self, key: str) -> typing.Optional[float]:
+        try:
+            return self.primary.remaining(key)
+        except SessionStoreError as e:
+            print(f"using fallback session store: {e}")
+            return self.fallback.remaining(key)
+
+    def lookup(self, key: str) -> typing.Optional[Lookup]:
+        try:
+            return self.primary.lookup(key)
+        except SessionStoreError as e:
+            print(f"using fallback session store: {e}")
+            return self.fallback.lookup(key)
+
+    def get(self, key: str) -> typing.Optional[str]:
+        try:
+            return self.primary.get(key)
+        except SessionStoreError as e:
+            print(f"using fallback session store: {e}")
+            return self.fallback.get(key)
+
+    def claim(self, key: str, value: str, expiry: int) -> bool:
+        try:
+            return self.primary.claim(key, value, expiry)
+        except SessionStoreError as e:
+            print(f"using fallback session store: {e}")
+            return self.fallback.claim(key, value, expiry)
+
+    def delete(self, key: str) -> None:
+        try:
+            self.primary.delete(key)
+        except SessionStoreError as e:
+            print(f"using fallback session store: {e}")
+            self.fallback.delete(key)
+
+    def sessions(self, index: str) -> typing.List[Session]:
+        try:
+            return self.primary.sessions(index)
+        except SessionStoreError as e:
+            print(f"using fallback session store: {e}")
+            return self.fallback.sessions(index)
+
+    def revoke(self, index: str, keys: typing.List[str]) -> None:
+        try:
+            self.primary.revoke(index, keys)
+        except SessionStoreError as e:
+            print(f"using fallback session store: {e}")
+            self.fallback.revoke(index, keys)
+
+    def refresh(self, keys: typing.List[str], idle: int) -> None:
+        try:
+            self.primary.refresh(keys, idle)
+        except SessionStoreError as e:
+            print(f"using fallback session store: {e}")
+            self.fallback.refresh(keys, idle)
+
+    def increment(self, key: str, expiry: int) -> int:
+        try:
+            return self.primary.increment(key, expiry)
+        except SessionStoreError as e:
+            print(f"using fallback session store: {e}")
+            return self.fallback.increment(key, expiry)
+
+    def start(self) -> None:
+        self.primary.start()
+        self.fallback.start()
+
+    def close(self) -> None:
+        self.primary.close()
+        self.fallback.close()
+
+    def stats(self) -> dict:
+        return self.primary.stats()
+
+
+class CachingSessionStore(SessionStore):
+    def __init__(
+        self,
+        store: RedisSessionStore,
+        prefix: str = "",
+        db: int = 0,
+        size: int = 1024,
+        ttl: int = 60,
+    ) -> None:
+        self.store = store
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        # redis publishes an event on this channel whenever one of our keys is
+        # changed, deleted, expired, or evicted.
+        self.channel = f"__keyspace@{db}__:{prefix}*"
+
+        # each session that we remember is kept with when we stop remembering
+        # it, when redis said that it ends, and its value
+        self._entries: typing.OrderedDict[
+            str,
+            typing.Tuple[float, float, str],
+        ] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        # counts invalidations so that a session that was read from redis just
+        # before it was revoked is not remembered just after
+        self._generation = 0
+
+        # entries are only served while we are subscribed to invalidations.
+        # if we are not then we could miss a revocation.
+        self._listening = threading.Event()
+        self._closed = threading.Event()
+        self._pubsub: typing.Any = None
+
+    def exists(self, key: str) -> bool:
+        return self.lookup(key) is not None
+
+    def lookup(self, key: str) -> typing.Optional[Lookup]:
+        # take the time before asking redis so that we can never remember a
+        # session for longer than redis will.
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now and self._listening.is_set():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return Lookup(entry[2], entry[1] - now)
+            self._entries.pop(key, None)
+            self.misses += 1
+            generation = self._generation
+
+        found = self.store.lookup(key)
+        if found is None:
+            return None
+
+        remaining = found.remaining
+        if remaining is not None and remaining > 0 and self._listening.is_set():
+            with self._lock:
+                if self._generation != generation:
+                    return found
+                self._entries[key] = (
+                    now + min(remaining, self.ttl),
+                    now + remaining,
+                    found.value,
+                )
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+
+        return found
+
+    def remaining(self, key: str) -> typing.Optional[float]:
+        return self.store.remaining(key)
+
+    def get(self, key: str) -> typing.Optional[str]:
+        return self.store.get(key)
+
+    def set(  # noqa: A003
+        self,
+        key: str,
+        value: str,
+        expiry: int,
+        index: typing.Optional[str] = None,
+        idle: typing.Optional[int] = None,
+    ) -> None:
+        self.invalidate(key)
+        self.store.set(key, value, expiry, index=index, idle=idle)
+
+    def claim(self, key: str, value: str, expiry: int) -> bool:
+        return self.store.claim(key, value, expiry)
+
+    def delete(self, key: str) -> None:
+        self.invalidate(key)
+        self.store.delete(key)
+
+    def sessions(self, index: str) -> typing.List[Session]:
+        return self.store.sessions(index)
+
+    def revoke(self, index: str, keys: typing.List[str]) -> None:
+        for key in keys:
+            self.invalidate(key)
+        self.store.revoke(index, keys)
+
+    def refresh(self, keys: typing.List[str], idle: int) -> None:
+        self.store.refresh(keys, idle)
+
+    def increment(self, key: str, expiry: int) -> int:
+        return self.store.increment(key, expiry)
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def start(self) -> None:
+        self.store.start()
+        thread = threading.Thread(
+            target=self._listen,
+            name="invalidations",
+            daemon=True,
+        )
+        thread.start()
+
+    def close(self) -> None:
+        # stop listening, which also stops us from serving what we remember
+        self._closed.set()
+        if self._pubsub is not None:
+            with contextlib.suppress(Exception):
+                self._pubsub.close()
+        self.store.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "capacity": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "listening": self._listening.is_set(),
+            }
+
+    def handle(self, message: dict) -> None:
+        if message.get("type") != "pmessage":
+            return
+
+        channel = message["channel"]
+        if isinstance(channel, bytes):
+            channel = channel.decode("utf-8")
+
+        # the channel is "__keyspace@0__:" followed by the key itself
+        self.invalidate(channel.split(":", 1)[1])
+
+    def _listen(self) -> None:
+        while not self._closed.is_set():
+            try:
+                pubsub = self._pubsub = self.store.redis.pubsub(
+                    ignore_subscribe_messages=True,
+                )
+                pubsub.psubscribe(self.channel)
+
+                # anything remembered from before we subscribed might have
+                # been revoked while we were not listening.
+                self.clear()
+                self._listening.set()
+                for message in pubsub.listen():
+                    self.handle(message)
+            except Exception as e:
+                if not self._closed.is_set():
+                    print(f"stopped listening for session invalidations: {e}")
+            finally:
+                self._listening.clear()
+                self.clear()
+
+            self._closed.wait(1)
+
+
+class SlidingSessionStore(SessionStore):
+    def __init__(
+        self,
+        store: SessionStore,
+        idle: int,
+        interval: int = 60,
+        size: int = 10000,
+    ) -> None:
+        self.store = store
+        self.idle = idle
+        self.interval = interval
+        self.size = size
+        self.refreshed = 0
+        self.failures = 0
+
+        # when we last saw each session refreshed, and the sessions waiting to
+        # be refreshed. a session that is used all the time is only refreshed
+        # once every interval and the refreshes are sent together.
+        self._seen: typing.OrderedDict[str, float] = collections.OrderedDict()
+        self._pending: typing.Set[str] = set()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+
+    def exists(self, key: str) -> bool:
+        return self.lookup(key) is not None
+
+    def lookup(self, key: str) -> typing.Optional[Lookup]:
+        found = self.store.lookup(key)
+        if found is None:
+            return None
+
+        now = time.monotonic()
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen is not None and now - seen < self.interval:
+                return found
+
+            self._seen[key] = now
+            self._seen.move_to_end(key)
+            while len(self._seen) > self.size:
+                self._seen.popitem(last=False)
+
+            # a session with most of its idle time left was refreshed by
+            # another process not long ago. this is also what stops a process
+            # that only lives for one request from refreshing on every hit.
+            # otherwise each process refreshes once every interval, which is
+            # also all that can be done when the store cannot say how long
+            # is left.
+            if found.remaining is None or found.remaining <= self.idle - self.interval:
+                self._pending.add(key)
+
+        return found
+
+    def remaining(self, key: str) -> typing.Optional[float]:
+        return self.store.remaining(key)
+
+    def get(self, key: str) -> typing.Optional[str]:
+        return self.store.get(key)
+
+    def set(  # noqa: A003
+        self,
+        key: str,
+        value: str,
+        expiry: int,
+        index: typing.Optional[str] = None,
+        idle: typing.Optional[int] = None,
+    ) -> None:
+        self.store.set(key, value, expiry, index=index, idle=idle)
+
+    def claim(self, key: str, value: str, expiry: int) -> bool:
+        return self.store.claim(key, value, expiry)
+
+    def delete(self, key: str) -> None:
+        self._forget([key])
+        self.store.delete(key)
+
+    def sessions(self, index: str) -> typing.List[Session]:
+        return self.store.sessions(index)
+
+    def revoke(self, index: str, keys: typing.List[str]) -> None:
+        self._forget(keys)
+        self.store.revoke(index, keys)
+
+    def refresh(self, keys: typing.List[str], idle: int) -> None:
+        self.store.refresh(keys, idle)
+
+    def increment(self, key: str, expiry: int) -> int:
+        return self.store.increment(key, expiry)
+
+    def _forget(self, keys: typing.List[str]) -> None:
+        with self._lock:
+            for key in keys:
+                self._seen.pop(key, None)
+                self._pending.discard(key)
+
+    def flush(self) -> None:
+        with self._lock:
+            keys = list(self._pending)
+            self._pending.clear()
+        if not keys:
+            return
+
+        # a session that could not be refreshed ends sooner than it should
+        # have, which only means another duo push
+        try:
+            self.store.refresh(keys, self.idle)
+        except SessionStoreError as e:
+            print(f"could not refresh sessions: {e}")
+            with self._lock:
+                self.failures += 1
+            return
+
+        with self._lock:
+            self.refreshed += len(keys)
+
+    def start(self) -> None:
+        self.store.start()
+        self.start_refresh()
+
+    def start_refresh(self) -> None:
+        # refresh in the background without starting the store underneath,
+        # for a new layer over a store that is already running
+        thread = threading.Thread(
+            target=self._run,
+            name="session-refresh",
+            daemon=True,
+        )
+        thread.start()
+
+    def _run(self) -> None:
+        while not self._closed.wait(self.interval):
+            self.flush()
+
+    def stop_refresh(self) -> None:
+        # send what is waiting and stop, leaving the store underneath open
+        self._closed.set()
+        self.flush()
+
+    def close(self) -> None:
+        # a process that only lives for one request refreshes here
+        self.stop_refresh()
+        self.store.close()
+
+    def stats(self) -> dict:
+        stats = self.store.stats()
+        with self._lock:
+            stats["refresh"] = {
+                "pending": len(self._pending),
+                "refreshed": self.refreshed,
+                "failures": self.failures,
+            }
+        return stats
+
+
+def create_session_store(configuration: dict) -> SessionStore:
+    # the prefix belongs to the caller and is not an option for any backend
+    configuration = dict(configuration)
+    prefix = configuration.pop("prefix", "")
+    backend = configuration.pop("backend", "redis")
+    fallback = configuration.pop("fallback", None)
+    local = configuration.pop("local", None)
+
+    store: SessionStore
+    if backend == "redis":
+        store = RedisSessionStore(**configuration)
+        if local is not None:
+            store = CachingSessionStore(
+                store,
+                prefix=prefix,
+                db=configuration.get("db", 0),
+                **local,
+            )
+    elif backend == "sqlite":
+        store = SQLiteSessionStore(**configuration)
+    elif backend == "memcached":
+        store = MemcachedSessionStore(**configuration)
+    else:
+        raise ValueError(f"unknown session store backend: {backend}")
+
+    if fallback is not None:
+        store = FailoverSessionStore(store, create_session_store(fallback))
+
+    return store
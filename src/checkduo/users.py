@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import typing
+
+from checkduo.passwords import UnsupportedHash, find_verifier
+
+
+class UserDirectoryError(Exception):
+    pass
+
+
+class UserDirectory(typing.Mapping[str, typing.Optional[str]]):
+    # a read only map of usernames to password hashes kept in a sqlite file.
+    # each lookup reads one row by its primary key so neither opening the file
+    # nor checking a password depends on how many users there are. users in
+    # overrides are found there first.
+
+    def __init__(
+        self,
+        path: str,
+        overrides: typing.Optional[typing.Mapping[str, typing.Optional[str]]] = None,
+    ) -> None:
+        self.path = path
+        self.overrides = overrides or {}
+
+        # sqlite connections cannot be shared between threads so every thread
+        # that the daemon uses gets its own.
+        self._local = threading.local()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        try:
+            source = os.stat(self.path)
+        except OSError as e:
+            raise UserDirectoryError(f"could not open {self.path}: {e}") from e
+
+        # the directory is rebuilt by replacing the file. a connection to the
+        # file that was replaced would keep reading the old users forever.
+        identity = (source.st_ino, source.st_mtime_ns)
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.identity != identity:
+            if connection is not None:
+                connection.close()
+
+            try:
+                connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            except sqlite3.Error as e:
+                raise UserDirectoryError(f"could not open {self.path}: {e}") from e
+
+            self._local.connection = connection
+            self._local.identity = identity
+        return connection
+
+    def _row(self, username: str) -> typing.Optional[tuple]:
+        try:
+            return self.connection.execute(
+                "SELECT hash FROM users WHERE username = ?",
+                (username,),
+            ).fetchone()
+        except sqlite3.Error as e:
+            raise UserDirectoryError(f"could not read {self.path}: {e}") from e
+
+    def __contains__(self, username: object) -> bool:
+        if username in self.overrides:
+            return True
+        return isinstance(username, str) and self._row(username) is not None
+
+    def __getitem__(self, username: str) -> typing.Optional[str]:
+        if username in self.overrides:
+            return self.overrides[username]
+
+        row = self._row(username)
+        if row is None:
+            raise KeyError(username)
+        return row[0]
+
+    def __iter__(self) -> typing.Iterator[str]:
+        try:
+            rows = self.connection.execute(
+                "SELECT username FROM users",
+            ).fetchall()
+        except sqlite3.Error as e:
+            raise UserDirectoryError(f"could not read {self.path}: {e}") from e
+        return iter(sorted({row[0] for row in rows} | set(self.overrides)))
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+def read_configuration_usernames(path: str) -> typing.Dict[str, typing.Optional[str]]:
+    # only the usernames are needed so the rest of the configuration is not
+    # validated, but the usernames are cleaned up the same way.
+    try:
+        with open(path, "rt", encoding="utf8") as f:
+            usernames = json.load(f)["usernames"]
+        return {
+            username.strip(): (hashed.strip() if hashed is not None else None)
+            for username, hashed in usernames.items()
+            if username.strip()
+        }
+    except (IOError, ValueError, KeyError, AttributeError) as e:
+        raise UserDirectoryError(f"could not read usernames from {path}: {e}") from e
+
+
+def read_htpasswd(path: str) -> typing.Dict[str, typing.Optional[str]]:
+    usernames: typing.Dict[str, typing.Optional[str]] = {}
+    try:
+        with open(path, "rt", encoding="utf8") as f:
+            for number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+
+                username, separator, hashed = line.partition(":")
+                if not separator or not username.strip():
+                    raise UserDirectoryError(f"{path} line {number} is not user:hash")
+                usernames[username.strip()] = hashed.strip() or None
+    except IOError as e:
+        raise UserDirectoryError(f"could not read {path}: {e}") from e
+
+    return usernames
+
+
+def build(path: str, usernames: typing.Mapping[str, typing.Optional[str]]) -> None:
+    # write the new directory next to the old one and swap it into place so
+    # that requests never see a half written file.
+    fd, temporary_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".",
+        prefix=".checkduo-",
+    )
+    os.close(fd)
+    try:
+        connection = sqlite3.connect(temporary_path, isolation_level=None)
+        try:
+            connection.execute("PRAGMA journal_mode=OFF")
+            connection.execute(
+                """
+                    CREATE TABLE users (
+                        username TEXT PRIMARY KEY,
+                        hash TEXT
+                    ) WITHOUT ROWID
+                """,
+            )
+            connection.execute("BEGIN")
+            connection.executemany(
+                "INSERT INTO users (username, hash) VALUES (?, ?)",
+                usernames.items(),
+            )
+            connection.execute("COMMIT")
+            connection.execute("VACUUM")
+        finally:
+            connection.close()
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+def main_build(
+    output: str,
+    configuration_files: typing.List[str],
+    htpasswd_files: typing.List[str],
+) -> int:
+    # later files win when the same user is in more than one
+    usernames: typing.Dict[str, typing.Optional[str]] = {}
+    for path in configuration_files:
+        usernames.update(read_configuration_usernames(path))
+    for path in htpasswd_files:
+        usernames.update(read_htpasswd(path))
+
+    for username, hashed in sorted(usernames.items()):
+        if not hashed:
+            print(f"warning: {username} has no password and will not be able to log in")
+            continue
+
+        try:
+            find_verifier(hashed)
+        except UnsupportedHash as e:
+            print(f"warning: {username} will not be able to log in: {e}")
+
+    build(output, usernames)
+    print(f"wrote {len(usernames)} users to {output}")
+    return 0
+
+
+def cli() -> None:
+    parser = argparse.ArgumentParser(prog="check-duo-users")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser(
+        "build",
+        help="build a user directory from configuration or htpasswd files",
+    )
+    build_parser.add_argument(
+        "--output",
+        "-o",
+        required=True,
+        metavar="FILE",
+        help="where to write the user directory",
+    )
+    build_parser.add_argument(
+        "--configuration-file",
+        "-c",
+        dest="configuration_files",
+        action="append",
+        default=[],
+        metavar="FILE",
+        help="read the usernames section of a check-duo configuration file",
+    )
+    build_parser.add_argument(
+        "--htpasswd",
+        dest="htpasswd_files",
+        action="append",
+        default=[],
+        metavar="FILE",
+        help="read an htpasswd file",
+    )
+
+    args = parser.parse_args()
+    if not args.configuration_files and not args.htpasswd_files:
+        parser.error("give at least one --configuration-file or --htpasswd")
+
+    try:
+        sys.exit(
+            main_build(args.output, args.configuration_files, args.htpasswd_files),
+        )
+    except Exception as exc:
+        print(f"could not {args.command}: {exc}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,40 @@
+import json
+import typing
+
+import pytest
+
+from checkduo import checkduo
+from checkduo.stores import SessionStore
+
+# the password for this is "password"
+PASSWORD_HASH = (
+    "$2y$05$4GIpGUOxzIK61gmshbAprOGNJKSOGmEtVaJZYoX6M5o3CBTXUdSy."  # noqa: S105
+)
+
+
+class FakeStore(SessionStore):
+    def __init__(self, sessions: typing.Dict[str, str]) -> None:
+        self.usernames = sessions
+
+    def exists(self, key: str) -> bool:
+        return key in self.usernames
+
+    def get(self, key: str) -> typing.Optional[str]:
+        if key not in self.usernames:
+            return None
+        return json.dumps({"username": self.usernames[key]})
+
+
+@pytest.fixture()
+def session_authenticator() -> checkduo.Authenticator:
+    # foo already has a session with the cookie abc123
+    authenticator = checkduo.Authenticator(
+        {
+            "usernames": {"foo": PASSWORD_HASH},
+            "duo": {"ikey": "asdf", "skey": "fdsa", "host": "api-1234.example.com"},
+            "cache": {"host": "foo.local", "prefix": "session:"},
+            "session": {"name": "foobar", "expiry": 10},
+        },
+    )
+    authenticator._store = FakeStore({"session:abc123": "foo"})
+    return authenticator
@@ -0,0 +1,213 @@
+import json
+import os
+import tempfile
+import threading
+import typing
+
+import pytest
+
+from checkduo import checkduo
+from checkduo.audit import (
+    AUDIT_STREAM,
+    AuditLog,
+    ConsoleSink,
+    FileSink,
+    RedisStreamSink,
+    Sink,
+    create_audit_log,
+)
+from tests.conftest import PASSWORD_HASH
+
+
+class ListSink(Sink):
+    def __init__(self) -> None:
+        self.batches: typing.List[typing.List[dict]] = []
+        self.closed = False
+
+    def write(self, records: typing.List[dict]) -> None:
+        self.batches.append(records)
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class BlockedSink(ListSink):
+    def __init__(self) -> None:
+        super().__init__()
+        self.release = threading.Event()
+
+    def write(self, records: typing.List[dict]) -> None:
+        self.release.wait(5)
+        super().write(records)
+
+
+class BrokenSink(Sink):
+    def write(self, records: typing.List[dict]) -> None:
+        raise OSError("disk full")
+
+
+def test_batches_and_close() -> None:
+    sink = ListSink()
+    audit = AuditLog([sink], batch_size=2)
+    for i in range(5):
+        audit.emit("test", f"message {i}", number=i)
+
+    # nothing is written until something writes it
+    assert sink.batches == []
+
+    audit.close()
+    assert [record["number"] for batch in sink.batches for record in batch] == [
+        0,
+        1,
+        2,
+        3,
+        4,
+    ]
+    assert sink.batches[0][0]["event"] == "test"
+    assert sink.batches[0][0]["message"] == "message 0"
+    assert sink.closed
+
+
+def test_background_writer() -> None:
+    sink = ListSink()
+    audit = AuditLog([sink], interval=0.1)
+    audit.start()
+    audit.emit("test", "one")
+    audit.emit("test", "two")
+    audit.close()
+
+    assert [record["message"] for batch in sink.batches for record in batch] == [
+        "one",
+        "two",
+    ]
+
+
+def test_full_queue_drops() -> None:
+    sink = BlockedSink()
+    audit = AuditLog([sink], queue_size=2)
+    audit.start()
+
+    # the writer takes the first event and then sits on it so the queue
+    # fills up behind it
+    audit.emit("test", "taken")
+    for _ in range(100):
+        if audit.stats()["queued"] == 0:
+            break
+        threading.Event().wait(0.01)
+
+    for i in range(5):
+        audit.emit("test", f"message {i}")
+    assert audit.stats() == {"queued": 2, "dropped": 3}
+
+    sink.release.set()
+    audit.close()
+    assert [record["message"] for batch in sink.batches for record in batch] == [
+        "taken",
+        "message 0",
+        "message 1",
+    ]
+
+
+def test_broken_sink(capsys: pytest.CaptureFixture) -> None:
+    sink = ListSink()
+    audit = AuditLog([BrokenSink(), sink])
+    audit.emit("test", "message")
+    audit.close()
+
+    assert (
+        "could not write 1 audit events to BrokenSink: disk full"
+        in capsys.readouterr().out
+    )
+    assert len(sink.batches) == 1
+
+
+def test_file_and_console(capsys: pytest.CaptureFixture) -> None:
+    with tempfile.TemporaryDirectory() as t:
+        path = os.path.join(t, "audit.log")
+        audit = AuditLog([ConsoleSink(), FileSink(path)])
+        audit.emit("first_factor", "foo passed", result="allow", username="foo")
+        audit.emit("first_factor", "bar failed", result="deny", username="bar")
+        audit.close()
+
+        with open(path, "rt", encoding="utf8") as f:
+            records = [json.loads(line) for line in f]
+
+    assert [(r["username"], r["result"]) for r in records] == [
+        ("foo", "allow"),
+        ("bar", "deny"),
+    ]
+    assert capsys.readouterr().out == "foo passed\nbar failed\n"
+
+
+def test_create_audit_log() -> None:
+    audit = create_audit_log({})
+    assert [type(sink) for sink in audit.sinks] == [ConsoleSink]
+
+    audit = create_audit_log(
+        {"console": False, "file": {"path": "audit.log"}, "queue_size": 5},
+    )
+    assert [type(sink) for sink in audit.sinks] == [FileSink]
+    assert audit._queue.maxsize == 5
+
+
+def test_redis_stream_name() -> None:
+    configuration: dict = {
+        "usernames": {},
+        "duo": {"ikey": "asdf", "skey": "fdsa", "host": "api-1234.example.com"},
+        "cache": {"host": "localhost"},
+        "session": {"name": "foobar", "expiry": 10},
+        "audit": {"redis": {"host": "localhost"}},
+    }
+    checkduo.validate_configuration(configuration)
+    assert RedisStreamSink().stream == f"{AUDIT_STREAM}checkduo"
+
+    # a stream that a session cookie could name is never written to
+    for stream in ("checkduo:audit", AUDIT_STREAM):
+        configuration["audit"]["redis"]["stream"] = stream
+        with pytest.raises(checkduo.ConfigurationError):
+            checkduo.validate_configuration(configuration)
+    assert checkduo.get_cookie(f"foobar={AUDIT_STREAM}checkduo", "foobar") is None
+
+
+def test_authenticator_events() -> None:
+    with tempfile.TemporaryDirectory() as t:
+        authenticator = checkduo.Authenticator(
+            {
+                "usernames": {"foo": PASSWORD_HASH},
+                "duo": {"ikey": "asdf", "skey": "fdsa", "host": "api-1234.example.com"},
+                "cache": {"backend": "sqlite", "path": os.path.join(t, "sessions.db")},
+                "session": {"name": "foobar", "expiry": 10},
+            },
+        )
+        sink = ListSink()
+        authenticator.audit.sinks = [sink]
+        authenticator.store.set("abc123", json.dumps({"username": "foo"}), 10)
+
+        environment = {"IP": "127.0.0.1", "HTTP_HOST": "localhost", "URI": "/private"}
+        authenticator.authenticate("bar", "password", environment)
+        authenticator.authenticate(
+            "foo",
+            "password",
+            {**environment, "COOKIE": "nope=1"},
+        )
+        authenticator.authenticate(
+            "foo",
+            "password",
+            {**environment, "COOKIE": "foobar=abc123"},
+        )
+        authenticator.close()
+
+    events = [
+        (r["event"], r["result"], r.get("reason"))
+        for batch in sink.batches
+        for r in batch
+    ]
+    assert events == [
+        ("first_factor", "deny", "unknown_user"),
+        ("first_factor", "allow", None),
+        ("cookie", "missing", None),
+        ("first_factor", "allow", None),
+        ("cookie", "allow", None),
+    ]
+    assert sink.batches[0][0]["ip"] == "127.0.0.1"
+    assert sink.batches[0][0]["request"] == "localhost/private"
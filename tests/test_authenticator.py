@@ -0,0 +1,335 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import typing
+
+import pytest
+
+from checkduo import checkduo
+from checkduo.stores import SQLiteSessionStore
+from tests.conftest import PASSWORD_HASH
+
+ENVIRONMENT = {"IP": "127.0.0.1", "HTTP_HOST": "localhost", "COOKIE": "foobar=abc123"}
+
+
+@pytest.fixture()
+def authenticator() -> typing.Iterator[checkduo.Authenticator]:
+    with tempfile.TemporaryDirectory() as t:
+        authenticator = checkduo.Authenticator(
+            {
+                "usernames": {"foo": PASSWORD_HASH},
+                "duo": {"ikey": "asdf", "skey": "fdsa", "host": "api-1234.example.com"},
+                "cache": {"backend": "sqlite", "path": os.path.join(t, "sessions.db")},
+                "session": {"name": "foobar", "expiry": 10, "wait": 5},
+            },
+        )
+        yield authenticator
+
+
+def fake_duo(
+    monkeypatch: pytest.MonkeyPatch,
+    result: bool,
+    delay: float = 0,
+) -> typing.List[str]:
+    calls = []
+
+    def check_duo(
+        username: str,
+        ip_address: str,
+        configuration: dict,
+        client: typing.Any = None,
+        metrics: typing.Any = None,
+        audit: typing.Any = None,
+        breaker: typing.Any = None,
+    ) -> bool:
+        calls.append(username)
+        time.sleep(delay)
+        return result
+
+    monkeypatch.setattr(checkduo, "check_duo", check_duo)
+    return calls
+
+
+def test_duo_then_cookie(
+    monkeypatch: pytest.MonkeyPatch,
+    authenticator: checkduo.Authenticator,
+) -> None:
+    calls = fake_duo(monkeypatch, True)
+    assert authenticator.authenticate("foo", "password", ENVIRONMENT) == 0
+    assert authenticator.authenticate("foo", "password", ENVIRONMENT) == 0
+    assert calls == ["foo"]
+    assert authenticator.store.exists("abc123")
+    assert not authenticator.store.exists(f"{checkduo.PENDING}abc123")
+
+
+def test_only_sessions_are_accepted(
+    monkeypatch: pytest.MonkeyPatch,
+    authenticator: checkduo.Authenticator,
+) -> None:
+    calls = fake_duo(monkeypatch, False)
+    authenticator.configuration["usernames"]["bar"] = PASSWORD_HASH
+    assert authenticator.store.claim(f"{checkduo.PENDING}def456", "{}", 60)
+    authenticator.store.set("abc123", json.dumps({"username": "bar"}), 10)
+    authenticator.store.set("ghi789", "nonsense", 10)
+
+    # a session belongs to the user that it was written for
+    assert authenticator.authenticate("bar", "password", ENVIRONMENT) == 0
+    assert authenticator.authenticate("foo", "password", ENVIRONMENT) == 1
+
+    # and anything else in the store is not a session at all
+    other = {**ENVIRONMENT, "COOKIE": "foobar=ghi789"}
+    assert authenticator.authenticate("foo", "password", other) == 1
+    pending = {**ENVIRONMENT, "COOKIE": f"foobar={checkduo.PENDING}def456"}
+    assert authenticator.authenticate("foo", "password", pending) == 1
+    assert calls == ["foo", "foo"]
+
+
+def test_duo_denied(
+    monkeypatch: pytest.MonkeyPatch,
+    authenticator: checkduo.Authenticator,
+) -> None:
+    calls = fake_duo(monkeypatch, False)
+    assert authenticator.authenticate("foo", "password", ENVIRONMENT) == 1
+    assert authenticator.authenticate("foo", "password", ENVIRONMENT) == 1
+    assert calls == ["foo", "foo"]
+    assert not authenticator.store.exists("abc123")
+
+
+@pytest.mark.parametrize("result", [True, False])
+def test_single_flight(
+    monkeypatch: pytest.MonkeyPatch,
+    authenticator: checkduo.Authenticator,
+    result: bool,
+) -> None:
+    calls = fake_duo(monkeypatch, result, delay=0.5)
+    statuses = []
+
+    def request() -> None:
+        statuses.append(authenticator.authenticate("foo", "password", ENVIRONMENT))
+
+    threads = [threading.Thread(target=request) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # one push for the whole burst and everyone gets the same answer
+    assert calls == ["foo"]
+    assert statuses == [0 if result else 1] * 10
+
+
+def test_single_flight_timeout(
+    monkeypatch: pytest.MonkeyPatch,
+    authenticator: checkduo.Authenticator,
+) -> None:
+    calls = fake_duo(monkeypatch, True)
+    authenticator.configuration["session"]["wait"] = 0
+
+    # something else is already asking duo about this session
+    assert authenticator.store.claim(f"{checkduo.PENDING}abc123", "foo", 60)
+    assert authenticator.authenticate("foo", "password", ENVIRONMENT) == 1
+    assert calls == []
+
+
+def test_login_skips_cookie(
+    monkeypatch: pytest.MonkeyPatch,
+    authenticator: checkduo.Authenticator,
+) -> None:
+    calls = fake_duo(monkeypatch, True)
+    environment = {**ENVIRONMENT, "CONTEXT": "login"}
+    assert authenticator.authenticate("foo", "password", environment) == 0
+    assert authenticator.authenticate("foo", "wrong", environment) == 1
+    assert calls == []
+    assert isinstance(authenticator.store, SQLiteSessionStore)
+
+
+class FakeAsyncDuo:
+    def __init__(self, results: typing.List[str]) -> None:
+        self.results = results
+        self.pushes: typing.List[str] = []
+        self.polls: typing.List[str] = []
+
+    def auth_async(self, username: str, ip_address: str) -> str:
+        self.pushes.append(username)
+        return f"tx{len(self.pushes)}"
+
+    def auth_status(self, txid: str, timeout: typing.Optional[float] = None) -> str:
+        self.polls.append(txid)
+        return self.results.pop(0) if self.results else "waiting"
+
+
+def test_async_allow(
+    monkeypatch: pytest.MonkeyPatch,
+    authenticator: checkduo.Authenticator,
+) -> None:
+    monkeypatch.setattr(checkduo, "PENDING_POLL_INTERVAL", 0.01)
+    authenticator.configuration["duo"].update({"async": True, "async_wait": 0.2})
+    duo = FakeAsyncDuo(["waiting", "allow"])
+    authenticator._duo = duo  # type: ignore
+
+    assert authenticator.authenticate("foo", "password", ENVIRONMENT) == 0
+    assert duo.pushes == ["foo"]
+    assert duo.polls == ["tx1", "tx1"]
+    assert authenticator.store.exists("abc123")
+    assert not authenticator.store.exists(f"{checkduo.PENDING}abc123")
+
+
+def test_async_resume(
+    monkeypatch: pytest.MonkeyPatch,
+    authenticator: checkduo.Authenticator,
+) -> None:
+    monkeypatch.setattr(checkduo, "PENDING_POLL_INTERVAL", 0.01)
+    authenticator.configuration["duo"].update({"async": True, "async_wait": 0.05})
+    duo = FakeAsyncDuo([])
+    authenticator._duo = duo  # type: ignore
+
+    # the user has not answered yet so the request gives up quickly but the
+    # push is remembered for the next request
+    assert authenticator.authenticate("foo", "password", ENVIRONMENT) == 1
+    assert duo.pushes == ["foo"]
+    assert authenticator.store.exists(f"{checkduo.PENDING}abc123")
+
+    # the next request picks up the same transaction instead of pushing again
+    duo.results = ["allow"]
+    assert authenticator.authenticate("foo", "password", ENVIRONMENT) == 0
+    assert duo.pushes == ["foo"]
+    assert set(duo.polls) == {"tx1"}
+    assert authenticator.store.exists("abc123")
+    assert not authenticator.store.exists(f"{checkduo.PENDING}abc123")
+
+
+def test_async_deny(
+    monkeypatch: pytest.MonkeyPatch,
+    authenticator: checkduo.Authenticator,
+) -> None:
+    monkeypatch.setattr(checkduo, "PENDING_POLL_INTERVAL", 0.01)
+    authenticator.configuration["duo"].update({"async": True, "async_wait": 0.2})
+    duo = FakeAsyncDuo(["deny"])
+    authenticator._duo = duo  # type: ignore
+
+    assert authenticator.authenticate("foo", "password", ENVIRONMENT) == 1
+    assert not authenticator.store.exists("abc123")
+
+    # a denied push is forgotten so the next request sends a new one
+    duo.results = ["allow"]
+    assert authenticator.authenticate("foo", "password", ENVIRONMENT) == 0
+    assert duo.pushes == ["foo", "foo"]
+
+
+def test_duo_settings_are_not_client_options() -> None:
+    authenticator = checkduo.Authenticator(
+        checkduo.validate_configuration(
+            {
+                "usernames": {"foo": PASSWORD_HASH},
+                "duo": {
+                    "ikey": "asdf",
+                    "skey": "fdsa",
+                    "host": "api-1234.example.com",
+                    "timeout": 10,
+                    "async": True,
+                    "async_wait": 2,
+                    "circuit": {"cooldown": 60},
+                },
+                "cache": {"backend": "sqlite", "path": "sessions.db"},
+                "session": {"name": "foobar", "expiry": 10},
+            },
+        ),
+    )
+    assert authenticator.duo.timeout == 10
+
+
+def test_remembered_device(
+    monkeypatch: pytest.MonkeyPatch,
+    authenticator: checkduo.Authenticator,
+) -> None:
+    calls = fake_duo(monkeypatch, True)
+    authenticator.configuration["session"]["remember"] = {
+        "ttl": 60,
+        "match": ["ip", "user_agent"],
+    }
+    device = {**ENVIRONMENT, "HTTP_USER_AGENT": "Firefox"}
+    assert authenticator.authenticate("foo", "password", device) == 0
+
+    # a new cookie from the same device does not send another push
+    rotated = {**device, "COOKIE": "foobar=def456"}
+    assert authenticator.authenticate("foo", "password", rotated) == 0
+    assert authenticator.store.exists("def456")
+    assert calls == ["foo"]
+
+    # but another browser, another address, or another user does
+    for username, environment in (
+        ("foo", {**rotated, "COOKIE": "foobar=a", "HTTP_USER_AGENT": "Chrome"}),
+        ("foo", {**rotated, "COOKIE": "foobar=b", "IP": "127.0.0.2"}),
+        ("bar", {**rotated, "COOKIE": "foobar=c"}),
+    ):
+        authenticator.usernames[username] = PASSWORD_HASH  # type: ignore
+        assert authenticator.authenticate(username, "password", environment) == 0
+    assert calls == ["foo", "foo", "foo", "bar"]
+
+    # and a device that cannot be told apart is never remembered
+    anonymous = {**ENVIRONMENT, "COOKIE": "foobar=d"}
+    assert authenticator.authenticate("foo", "password", anonymous) == 0
+    assert authenticator.authenticate("foo", "password", anonymous) == 0
+    assert len(calls) == 5
+
+
+def test_remembered_device_expires(
+    monkeypatch: pytest.MonkeyPatch,
+    authenticator: checkduo.Authenticator,
+) -> None:
+    now = [1000.0]
+    monkeypatch.setattr("time.time", lambda: now[0])
+    calls = fake_duo(monkeypatch, True)
+    authenticator.configuration["session"].update(
+        {"expiry": 100, "remember": {"ttl": 5}},
+    )
+    assert authenticator.authenticate("foo", "password", ENVIRONMENT) == 0
+
+    now[0] += 6
+    rotated = {**ENVIRONMENT, "COOKIE": "foobar=def456"}
+    assert authenticator.authenticate("foo", "password", rotated) == 0
+    assert calls == ["foo", "foo"]
+
+
+def test_remembered_device_is_not_a_session(
+    monkeypatch: pytest.MonkeyPatch,
+    authenticator: checkduo.Authenticator,
+) -> None:
+    calls = fake_duo(monkeypatch, True)
+    authenticator.configuration["session"]["remember"] = {"ttl": 60}
+    key = checkduo.remembered_device("", "foo", ["127.0.0.1"])
+    value = {"username": "foo", "expires": time.time() + 60, "device": True}
+    authenticator.store.set(key, json.dumps(value), 60)
+
+    # anybody can work out the key so it can never be used as a cookie to
+    # get past duo from somewhere else
+    elsewhere = {**ENVIRONMENT, "IP": "10.0.0.1"}
+    cookie = {**elsewhere, "COOKIE": f"foobar={key}"}
+    assert authenticator.authenticate("foo", "password", cookie) == 1
+    assert calls == []
+
+    # where a real cookie has to go through duo
+    assert authenticator.authenticate("foo", "password", elsewhere) == 0
+    assert calls == ["foo"]
+
+
+def test_remember_configuration() -> None:
+    configuration: dict = {
+        "usernames": {"foo": PASSWORD_HASH},
+        "duo": {"ikey": "asdf", "skey": "fdsa", "host": "api-1234.example.com"},
+        "cache": {"backend": "sqlite", "path": "sessions.db"},
+        "session": {"name": "foobar", "expiry": 10, "remember": {"ttl": "600"}},
+    }
+    validated = checkduo.validate_configuration(configuration)
+    assert validated["session"]["remember"] == {"ttl": 600}
+
+    for remember in (
+        {"ttl": 0},
+        {"ttl": 60, "match": []},
+        {"ttl": 60, "match": ["os"]},
+    ):
+        configuration["session"]["remember"] = remember
+        with pytest.raises(checkduo.ConfigurationError):
+            checkduo.validate_configuration(configuration)
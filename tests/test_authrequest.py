@@ -0,0 +1,150 @@
+import base64
+import http.client
+import os
+import tempfile
+import threading
+import typing
+
+import pytest
+
+from checkduo import authrequest, checkduo
+from tests.conftest import PASSWORD_HASH
+
+
+def basic(username: str, password: str) -> str:
+    credentials = base64.b64encode(f"{username}:{password}".encode("utf-8"))
+    return f"Basic {credentials.decode('ascii')}"
+
+
+@pytest.fixture()
+def server(
+    monkeypatch: pytest.MonkeyPatch,
+) -> typing.Iterator[typing.Tuple[authrequest.Server, typing.List[str]]]:
+    calls = []
+
+    def check_duo(
+        username: str,
+        ip_address: str,
+        *args: typing.Any,
+        **kwargs: typing.Any,
+    ) -> bool:
+        calls.append(ip_address)
+        return username == "foo"
+
+    monkeypatch.setattr(checkduo, "check_duo", check_duo)
+
+    with tempfile.TemporaryDirectory() as t:
+        authenticator = checkduo.Authenticator(
+            {
+                "usernames": {"foo": PASSWORD_HASH, "bar": PASSWORD_HASH},
+                "duo": {"ikey": "asdf", "skey": "fdsa", "host": "api-1234.example.com"},
+                "cache": {"backend": "sqlite", "path": os.path.join(t, "sessions.db")},
+                "session": {"name": "foobar", "expiry": 10},
+            },
+        )
+        with authrequest.Server("127.0.0.1", 0, authenticator) as server:
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            yield server, calls
+            server.shutdown()
+
+
+def request(
+    server: authrequest.Server,
+    headers: typing.Dict[str, str],
+    connection: typing.Optional[http.client.HTTPConnection] = None,
+) -> http.client.HTTPResponse:
+    if connection is None:
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+    connection.request("GET", "/auth", headers=headers)
+    response = connection.getresponse()
+    response.read()
+    return response
+
+
+def test_session_cookie(
+    server: typing.Tuple[authrequest.Server, typing.List[str]],
+) -> None:
+    instance, calls = server
+    headers = {"Authorization": basic("foo", "password"), "X-Real-IP": "10.1.2.3"}
+
+    # a browser without a session goes through duo and is given one
+    response = request(instance, headers)
+    assert response.status == 200
+    cookie = response.getheader("Set-Cookie")
+    assert cookie is not None
+    assert cookie.startswith("foobar=")
+    assert "HttpOnly" in cookie
+    assert calls == ["10.1.2.3"]
+
+    # and then does not need duo again
+    session = cookie.split(";")[0]
+    response = request(instance, {**headers, "Cookie": f"other=1; {session}"})
+    assert response.status == 200
+    assert response.getheader("Set-Cookie") is None
+    assert calls == ["10.1.2.3"]
+
+
+def test_chosen_cookie(
+    server: typing.Tuple[authrequest.Server, typing.List[str]],
+) -> None:
+    instance, calls = server
+    headers = {"Authorization": basic("foo", "password"), "Cookie": "foobar=chosen"}
+
+    # a cookie that we did not make is replaced by one that we did
+    response = request(instance, headers)
+    assert response.status == 200
+    cookie = response.getheader("Set-Cookie")
+    assert cookie is not None
+    assert not cookie.startswith("foobar=chosen;")
+    assert calls == ["127.0.0.1"]
+
+    # so the chosen cookie never becomes a session
+    response = request(instance, headers)
+    assert response.getheader("Set-Cookie") is not None
+    assert calls == ["127.0.0.1", "127.0.0.1"]
+
+    # and nor does a session belonging to somebody else
+    session = cookie.split(";")[0]
+    headers = {"Authorization": basic("bar", "password"), "Cookie": session}
+    response = request(instance, headers)
+    assert response.status == 401
+    assert calls == ["127.0.0.1"] * 3
+
+
+def test_denied(server: typing.Tuple[authrequest.Server, typing.List[str]]) -> None:
+    instance, calls = server
+
+    for headers in (
+        {},
+        {"Authorization": basic("foo", "wrong")},
+        {"Authorization": "Bearer abc123"},
+        {"Authorization": basic("bar", "password")},
+    ):
+        response = request(instance, headers)
+        assert response.status == 401
+        assert response.getheader("WWW-Authenticate", "").startswith("Basic realm=")
+        assert response.getheader("Set-Cookie") is None
+
+    # only bar got far enough to be asked about
+    assert calls == ["127.0.0.1"]
+
+
+def test_keep_alive(server: typing.Tuple[authrequest.Server, typing.List[str]]) -> None:
+    instance, _ = server
+    connection = http.client.HTTPConnection("127.0.0.1", instance.server_address[1])
+    headers = {"Authorization": basic("foo", "password")}
+    for _ in range(3):
+        assert request(instance, headers, connection).status == 200
+    connection.close()
+
+
+def test_basic_credentials() -> None:
+    assert checkduo.get_basic_credentials(basic("foo", "pass:word")) == (
+        "foo",
+        "pass:word",
+    )
+    assert checkduo.get_basic_credentials("basic Zm9vOmJhcg==") == ("foo", "bar")
+    assert checkduo.get_basic_credentials("Basic !!!") == ("", "")
+    assert checkduo.get_basic_credentials("Basic /w==") == ("", "")
+    assert checkduo.get_basic_credentials("") == ("", "")
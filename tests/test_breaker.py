@@ -0,0 +1,133 @@
+import json
+import os
+import tempfile
+import typing
+
+import pytest
+
+from checkduo import checkduo
+from checkduo.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from checkduo.stores import SQLiteSessionStore
+from tests.conftest import PASSWORD_HASH
+
+
+@pytest.fixture()
+def store() -> typing.Iterator[SQLiteSessionStore]:
+    with tempfile.TemporaryDirectory() as t:
+        yield SQLiteSessionStore(os.path.join(t, "sessions.db"))
+
+
+def test_opens_after_failures(store: SQLiteSessionStore) -> None:
+    breaker = CircuitBreaker(store, minimum=3, failure_rate=0.5)
+    for failed in (False, True, True):
+        assert breaker.allow()
+        breaker.record(failed=failed)
+
+    assert not breaker.allow()
+    assert breaker.stats() == {
+        "state": OPEN,
+        "trips": 1,
+        "probes": 0,
+        "fast_failures": 1,
+    }
+
+    # every process that shares the store stops asking duo
+    assert not CircuitBreaker(store).allow()
+
+
+def test_half_open_probe(
+    monkeypatch: pytest.MonkeyPatch,
+    store: SQLiteSessionStore,
+) -> None:
+    now = [1000.0]
+    monkeypatch.setattr("time.time", lambda: now[0])
+
+    breaker = CircuitBreaker(store, minimum=1, cooldown=30)
+    other = CircuitBreaker(store, minimum=1, cooldown=30)
+    assert breaker.allow()
+    breaker.record(failed=True)
+    assert not breaker.allow()
+
+    # once it has cooled down only one request gets to try duo
+    now[0] += 30
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not other.allow()
+
+    # and if duo is still failing the breaker opens again
+    breaker.record(failed=True)
+    assert not breaker.allow()
+    now[0] += 30
+    assert other.allow()
+    other.record(failed=False)
+    assert other.state == CLOSED
+    assert breaker.allow()
+    assert breaker.stats()["trips"] == 2
+
+
+def test_released_probe(
+    monkeypatch: pytest.MonkeyPatch,
+    store: SQLiteSessionStore,
+) -> None:
+    now = [1000.0]
+    monkeypatch.setattr("time.time", lambda: now[0])
+
+    breaker = CircuitBreaker(store, minimum=1, cooldown=30)
+    assert breaker.allow()
+    breaker.record(failed=True)
+
+    # a probe that never asked duo lets another request try instead
+    now[0] += 30
+    assert breaker.allow()
+    breaker.release()
+    assert CircuitBreaker(store).allow()
+
+
+def test_fail_open(monkeypatch: pytest.MonkeyPatch) -> None:
+    calls = []
+
+    def check_duo(username: str, *args: typing.Any, **kwargs: typing.Any) -> bool:
+        calls.append(username)
+        return True
+
+    monkeypatch.setattr(checkduo, "check_duo", check_duo)
+
+    with tempfile.TemporaryDirectory() as t:
+        authenticator = checkduo.Authenticator(
+            checkduo.validate_configuration(
+                {
+                    "usernames": {"foo": PASSWORD_HASH},
+                    "duo": {
+                        "ikey": "asdf",
+                        "skey": "fdsa",
+                        "host": "api-1234.example.com",
+                        "circuit": {"fail_open": ["10.0.0.0/8"]},
+                    },
+                    "cache": {
+                        "backend": "sqlite",
+                        "path": os.path.join(t, "sessions.db"),
+                        "prefix": "session:",
+                    },
+                    "session": {"name": "foobar", "expiry": 10},
+                },
+            ),
+        )
+        authenticator.store.set(
+            f"session:{checkduo.CIRCUIT}state",
+            json.dumps({"opened": 2**40}),
+            100,
+        )
+
+        # while duo is failing only the listed networks get in, and they go
+        # through duo once it is back
+        inside = {"COOKIE": "foobar=abc123", "IP": "10.1.2.3"}
+        outside = {"COOKIE": "foobar=abc123", "IP": "192.168.1.1"}
+        assert authenticator.authenticate("foo", "password", inside) == 0
+        assert authenticator.authenticate("foo", "password", outside) == 1
+        assert calls == []
+        assert not authenticator.store.exists("session:abc123")
+        assert authenticator.stats()["circuit"]["fast_failures"] == 2
+
+        # and the breaker itself can never be used as a session
+        cookie = {"COOKIE": f"foobar={checkduo.CIRCUIT}state", "IP": "10.1.2.3"}
+        assert authenticator.authenticate("foo", "password", cookie) == 1
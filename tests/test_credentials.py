@@ -0,0 +1,83 @@
+import pytest
+
+from checkduo import checkduo
+from checkduo.credentials import CredentialCache
+from tests.conftest import PASSWORD_HASH
+
+
+def test_cache_hits_and_misses() -> None:
+    cache = CredentialCache()
+    assert cache.get("foo", "password", PASSWORD_HASH) is None
+
+    cache.put("foo", "password", PASSWORD_HASH, True)
+    cache.put("foo", "asdf", PASSWORD_HASH, False)
+    assert cache.get("foo", "password", PASSWORD_HASH) is True
+    assert cache.get("foo", "asdf", PASSWORD_HASH) is False
+
+    # a different hash for the same user is a different entry
+    assert cache.get("foo", "password", "$2y$05$somethingelse") is None
+
+    assert cache.stats() == {"size": 2, "capacity": 1024, "hits": 2, "misses": 2}
+
+
+def test_cache_does_not_keep_plaintext() -> None:
+    cache = CredentialCache()
+    cache.put("foo", "password", PASSWORD_HASH, True)
+    for key in cache._entries:
+        assert b"password" not in key
+        assert b"foo" not in key
+
+
+def test_cache_eviction() -> None:
+    cache = CredentialCache(size=2)
+    cache.put("a", "password", PASSWORD_HASH, True)
+    cache.put("b", "password", PASSWORD_HASH, True)
+    assert cache.get("a", "password", PASSWORD_HASH) is True
+    cache.put("c", "password", PASSWORD_HASH, True)
+
+    # "b" was the least recently used so it is the one that goes
+    assert cache.get("b", "password", PASSWORD_HASH) is None
+    assert cache.get("a", "password", PASSWORD_HASH) is True
+    assert cache.get("c", "password", PASSWORD_HASH) is True
+
+
+def test_cache_expiry(monkeypatch: pytest.MonkeyPatch) -> None:
+    now = [1000.0]
+    monkeypatch.setattr("time.monotonic", lambda: now[0])
+
+    cache = CredentialCache(ttl=10, failure_ttl=0)
+    cache.put("foo", "password", PASSWORD_HASH, True)
+    cache.put("foo", "asdf", PASSWORD_HASH, False)
+    assert cache.get("foo", "password", PASSWORD_HASH) is True
+    assert cache.get("foo", "asdf", PASSWORD_HASH) is None
+
+    now[0] += 10
+    assert cache.get("foo", "password", PASSWORD_HASH) is None
+
+
+def test_is_valid_password_uses_cache(monkeypatch: pytest.MonkeyPatch) -> None:
+    cache = CredentialCache()
+    for _ in range(3):
+        assert checkduo.is_valid_password(
+            {"foo": PASSWORD_HASH},
+            "foo",
+            "password",
+            "127.0.0.1",
+            "localhost:8080/private",
+            cache=cache,
+        )
+
+    # only the first check went to bcrypt
+    assert cache.hits == 2
+    assert cache.misses == 1
+
+    # changing the hash in the configuration means checking again
+    assert not checkduo.is_valid_password(
+        {"foo": "$2y$05$t6moSHuz5UgPZl087cEmSOZa6nsmjsgdAazr4/0meidcZi3Rwi.bK"},
+        "foo",
+        "password",
+        "127.0.0.1",
+        "localhost:8080/private",
+        cache=cache,
+    )
+    assert cache.misses == 2
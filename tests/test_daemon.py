@@ -0,0 +1,159 @@
+import io
+import json
+import os
+import tempfile
+import threading
+import typing
+
+import pytest
+
+from checkduo import checkduo, client, daemon
+from checkduo.stores import SlidingSessionStore
+from tests.conftest import PASSWORD_HASH
+
+
+@pytest.fixture()
+def socket_path(
+    session_authenticator: checkduo.Authenticator,
+) -> typing.Iterator[str]:
+    with tempfile.TemporaryDirectory() as t:
+        path = os.path.join(t, "check-duo.sock")
+        with daemon.Server(path, session_authenticator) as server:
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            yield path
+            server.shutdown()
+
+
+def run_client(
+    monkeypatch: pytest.MonkeyPatch,
+    socket_path: str,
+    username: str,
+    password: str,
+    environment: typing.Dict[str, str],
+) -> int:
+    monkeypatch.setattr("sys.stdin", io.StringIO(f"{username}\n{password}\n"))
+    for name in client.ENVIRONMENT:
+        monkeypatch.setenv(name, environment.get(name, ""))
+    return client.main(socket_path, 5)
+
+
+def test_login(monkeypatch: pytest.MonkeyPatch, socket_path: str) -> None:
+    environment = {"IP": "127.0.0.1", "CONTEXT": "login"}
+    assert run_client(monkeypatch, socket_path, "foo", "password", environment) == 0
+    assert run_client(monkeypatch, socket_path, "foo", "asdf", environment) == 1
+    assert run_client(monkeypatch, socket_path, "bar", "password", environment) == 1
+
+
+def test_cookie(monkeypatch: pytest.MonkeyPatch, socket_path: str) -> None:
+    environment = {"IP": "127.0.0.1", "COOKIE": "foobar=abc123"}
+    assert run_client(monkeypatch, socket_path, "foo", "password", environment) == 0
+
+    # no session cookie at all means no login
+    environment = {"IP": "127.0.0.1", "COOKIE": "other=abc123"}
+    assert run_client(monkeypatch, socket_path, "foo", "password", environment) == 1
+
+
+def test_missing_daemon(monkeypatch: pytest.MonkeyPatch) -> None:
+    with tempfile.TemporaryDirectory() as t:
+        path = os.path.join(t, "check-duo.sock")
+        assert run_client(monkeypatch, path, "foo", "password", {}) == 1
+
+
+def test_stats(
+    monkeypatch: pytest.MonkeyPatch,
+    socket_path: str,
+    capsys: pytest.CaptureFixture,
+) -> None:
+    environment = {"IP": "127.0.0.1", "CONTEXT": "login"}
+    assert run_client(monkeypatch, socket_path, "foo", "password", environment) == 0
+    assert run_client(monkeypatch, socket_path, "foo", "password", environment) == 0
+    capsys.readouterr()
+
+    assert client.main(socket_path, 5, stats=True) == 0
+    stats = json.loads(capsys.readouterr().out)
+    assert stats["password_cache"]["hits"] == 1
+    assert stats["password_cache"]["misses"] == 1
+
+
+def test_reload(monkeypatch: pytest.MonkeyPatch) -> None:
+    with tempfile.TemporaryDirectory() as t:
+        configuration: typing.Dict[str, typing.Any] = {
+            "usernames": {"foo": PASSWORD_HASH},
+            "duo": {"ikey": "asdf", "skey": "fdsa", "host": "api-1234.example.com"},
+            "cache": {"backend": "sqlite", "path": os.path.join(t, "sessions.db")},
+            "session": {"name": "foobar", "expiry": 10},
+        }
+        configuration_path = os.path.join(t, "configuration.json")
+        with open(configuration_path, "wt", encoding="utf8") as f:
+            json.dump(configuration, f)
+
+        authenticator = checkduo.Authenticator(
+            checkduo.load_configuration(configuration_path),
+        )
+        authenticator.start()
+        store, duo = authenticator.store, authenticator.duo
+
+        path = os.path.join(t, "check-duo.sock")
+        with daemon.Server(path, authenticator) as server:
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+
+            watcher = daemon.ConfigurationWatcher(configuration_path, server, 5)
+            environment = {"IP": "127.0.0.1", "CONTEXT": "login"}
+            assert run_client(monkeypatch, path, "bar", "password", environment) == 1
+
+            # an edit that does not validate is ignored
+            with open(configuration_path, "wt", encoding="utf8") as f:
+                json.dump({**configuration, "session": {}}, f)
+            assert not watcher.check()
+            assert server.authenticator is authenticator
+
+            # adding a user and changing duo only rebuilds the duo client
+            configuration["usernames"]["bar"] = PASSWORD_HASH
+            configuration["duo"]["skey"] = "rotated"
+            with open(configuration_path, "wt", encoding="utf8") as f:
+                json.dump(configuration, f)
+            assert watcher.check()
+            assert not watcher.check()
+
+            replacement = server.authenticator
+            assert replacement is not authenticator
+            assert replacement.store is store
+            assert replacement.duo is not duo
+            assert replacement.duo.skey == "rotated"
+            assert replacement.password_cache is authenticator.password_cache
+            assert replacement.audit is authenticator.audit
+            assert run_client(monkeypatch, path, "bar", "password", environment) == 0
+
+            # retiring the old authenticator only closes what it did not share
+            closed = []
+            monkeypatch.setattr(duo, "close", lambda: closed.append("duo"))
+            monkeypatch.setattr(store, "close", lambda: closed.append("store"))
+            authenticator.retire(replacement)
+            assert closed == ["duo"]
+
+            # changing only the session keeps the connection to the store
+            configuration["session"]["idle"] = 5
+            with open(configuration_path, "wt", encoding="utf8") as f:
+                json.dump(configuration, f)
+            assert watcher.check()
+
+            sliding = server.authenticator
+            assert isinstance(sliding.store, SlidingSessionStore)
+            assert sliding.store.store is store
+            assert sliding.duo is replacement.duo
+            replacement.retire(sliding)
+            assert closed == ["duo"]
+
+            # and so does changing it back
+            del configuration["session"]["idle"]
+            with open(configuration_path, "wt", encoding="utf8") as f:
+                json.dump(configuration, f)
+            assert watcher.check()
+            assert server.authenticator.store is store
+            sliding.retire(server.authenticator)
+            assert closed == ["duo"]
+
+            server.shutdown()
+            server.authenticator.close()
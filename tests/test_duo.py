@@ -0,0 +1,267 @@
+import typing
+
+import pytest
+import requests
+
+from checkduo import checkduo
+from checkduo.duo import DuoClient, DuoError, DuoReadTimeout, DuoTimeout, sign
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, data: typing.Any) -> None:
+        self.status_code = status_code
+        self.data = data
+
+    def json(self) -> typing.Any:
+        if isinstance(self.data, Exception):
+            raise self.data
+        return self.data
+
+
+class FakeSession:
+    def __init__(self, responses: typing.List[typing.Any]) -> None:
+        self.responses = responses
+        self.requests: typing.List[dict] = []
+
+    def request(self, method: str, url: str, **kwargs: typing.Any) -> FakeResponse:
+        self.requests.append({"method": method, "url": url, **kwargs})
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def make_client(
+    monkeypatch: pytest.MonkeyPatch,
+    responses: typing.List[typing.Any],
+) -> typing.Tuple[DuoClient, FakeSession, typing.List[float]]:
+    client = DuoClient("asdf", "fdsa", "api-1234.example.com", retries=2)
+    session = FakeSession(responses)
+    client.session = session  # type: ignore
+
+    delays: typing.List[float] = []
+    monkeypatch.setattr("time.sleep", delays.append)
+    return client, session, delays
+
+
+def test_sign() -> None:
+    params = {"username": "foo", "ipaddr": "127.0.0.1"}
+    date = "Tue, 21 Aug 2012 17:29:18 -0000"
+    signature = sign("fdsa", "API-1234.example.com", "/auth/v2/auth", date, params)
+    assert signature == sign(
+        "fdsa",
+        "api-1234.example.com",
+        "/auth/v2/auth",
+        date,
+        params,
+    )
+    assert signature != sign(
+        "fdsa",
+        "api-1234.example.com",
+        "/auth/v2/auth",
+        date,
+        params,
+        method="GET",
+    )
+
+
+def test_auth(monkeypatch: pytest.MonkeyPatch) -> None:
+    client, session, delays = make_client(
+        monkeypatch,
+        [
+            FakeResponse(200, {"stat": "OK", "response": {"result": "allow"}}),
+            FakeResponse(200, {"stat": "OK", "response": {"result": "deny"}}),
+        ],
+    )
+    assert client.auth("foo", "127.0.0.1") is True
+    assert client.auth("foo", "127.0.0.1") is False
+    assert delays == []
+
+    request = session.requests[0]
+    assert request["method"] == "POST"
+    assert request["url"] == "https://api-1234.example.com/auth/v2/auth"
+    assert request["data"]["username"] == "foo"
+    assert request["timeout"] == (5, 30)
+
+
+def test_rate_limit_retry(monkeypatch: pytest.MonkeyPatch) -> None:
+    client, session, delays = make_client(
+        monkeypatch,
+        [
+            FakeResponse(
+                429,
+                {"stat": "FAIL", "code": 42901, "message": "Too Many Requests"},
+            ),
+            FakeResponse(
+                429,
+                {"stat": "FAIL", "code": 42901, "message": "Too Many Requests"},
+            ),
+            FakeResponse(200, {"stat": "OK", "response": {"result": "allow"}}),
+        ],
+    )
+    assert client.auth("foo", "127.0.0.1") is True
+    assert len(session.requests) == 3
+
+    # backoff is exponential with jitter
+    assert 0.5 <= delays[0] <= 1
+    assert 1 <= delays[1] <= 2
+
+
+def test_retries_exhausted(monkeypatch: pytest.MonkeyPatch) -> None:
+    client, session, delays = make_client(
+        monkeypatch,
+        [FakeResponse(429, {"stat": "FAIL"})] * 3,
+    )
+    with pytest.raises(DuoError):
+        client.auth("foo", "127.0.0.1")
+    assert len(session.requests) == 3
+
+
+def test_no_retry_after_push_sent(monkeypatch: pytest.MonkeyPatch) -> None:
+    # a server error or read timeout on an auth request could mean that the
+    # push was already sent so we do not send another
+    client, session, delays = make_client(
+        monkeypatch,
+        [FakeResponse(503, {"stat": "FAIL"})],
+    )
+    with pytest.raises(DuoError):
+        client.auth("foo", "127.0.0.1")
+
+    client, session, delays = make_client(
+        monkeypatch,
+        [requests.exceptions.ReadTimeout("too slow")],
+    )
+    with pytest.raises(DuoTimeout):
+        client.auth("foo", "127.0.0.1")
+    assert delays == []
+
+
+def test_idempotent_retry(monkeypatch: pytest.MonkeyPatch) -> None:
+    client, session, delays = make_client(
+        monkeypatch,
+        [
+            FakeResponse(503, {"stat": "FAIL"}),
+            requests.exceptions.ConnectionError("reset"),
+            FakeResponse(200, {"stat": "OK", "response": {"time": 1}}),
+        ],
+    )
+    assert client.request("GET", "/auth/v2/check", {}) == {"time": 1}
+    assert session.requests[0]["params"] == {}
+    assert len(delays) == 2
+
+    # a request that never connected never reached duo
+    client, session, delays = make_client(
+        monkeypatch,
+        [
+            requests.exceptions.ConnectTimeout("too slow"),
+            FakeResponse(200, {"stat": "OK", "response": {"result": "allow"}}),
+        ],
+    )
+    assert client.auth("foo", "127.0.0.1") is True
+
+
+def test_bad_responses(monkeypatch: pytest.MonkeyPatch) -> None:
+    for response in [
+        FakeResponse(400, {"stat": "FAIL"}),
+        FakeResponse(400, ["not", "an", "object"]),
+        FakeResponse(200, ValueError("not json")),
+        FakeResponse(200, {"stat": "OK"}),
+    ]:
+        client, session, delays = make_client(monkeypatch, [response])
+        assert checkduo.check_duo("foo", "127.0.0.1", {}, client=client) is False
+
+
+def test_auth_async(monkeypatch: pytest.MonkeyPatch) -> None:
+    client, session, delays = make_client(
+        monkeypatch,
+        [
+            FakeResponse(200, {"stat": "OK", "response": {"txid": "abc-123"}}),
+            FakeResponse(200, {"stat": "OK", "response": {"result": "waiting"}}),
+            FakeResponse(200, {"stat": "OK", "response": {"result": "allow"}}),
+            FakeResponse(200, {"stat": "OK", "response": {"result": "bogus"}}),
+        ],
+    )
+    assert client.auth_async("foo", "127.0.0.1") == "abc-123"
+    assert session.requests[0]["data"]["async"] == "1"
+
+    assert client.auth_status("abc-123", timeout=2) == "waiting"
+    assert session.requests[1]["method"] == "GET"
+    assert session.requests[1]["params"] == {"txid": "abc-123"}
+    assert session.requests[1]["timeout"] == (5, 2)
+
+    assert client.auth_status("abc-123") == "allow"
+    assert client.auth_status("abc-123") == "deny"
+
+
+def test_auth_status_deadline(monkeypatch: pytest.MonkeyPatch) -> None:
+    # a long poll that runs out of time means that the user has not answered
+    client, session, delays = make_client(
+        monkeypatch,
+        [requests.exceptions.ReadTimeout("too slow")],
+    )
+    assert client.auth_status("abc-123", timeout=2) == "waiting"
+    assert delays == []
+
+    # and nothing is tried again once there is no time left for it
+    client, session, delays = make_client(
+        monkeypatch,
+        [FakeResponse(503, {"stat": "FAIL"}), requests.exceptions.ReadTimeout("x")],
+    )
+    with pytest.raises(DuoError):
+        client.auth_status("abc-123", timeout=0.5)
+    assert len(session.requests) == 1
+    assert delays == []
+
+    # a connection that cannot be made is still an error
+    client, session, delays = make_client(
+        monkeypatch,
+        [requests.exceptions.ConnectTimeout("down")] * 3,
+    )
+    with pytest.raises(DuoTimeout) as error:
+        client.auth_status("abc-123")
+    assert not isinstance(error.value, DuoReadTimeout)
+
+
+def test_breaker_failures(monkeypatch: pytest.MonkeyPatch) -> None:
+    class Breaker:
+        def __init__(self) -> None:
+            self.calls: typing.List[typing.Optional[bool]] = []
+
+        def record(self, failed: bool) -> None:
+            self.calls.append(failed)
+
+        def release(self) -> None:
+            self.calls.append(None)
+
+    client, session, delays = make_client(
+        monkeypatch,
+        [
+            requests.exceptions.ReadTimeout("nobody answered"),
+            FakeResponse(503, {"stat": "FAIL"}),
+            requests.exceptions.ConnectionError("refused"),
+            FakeResponse(400, {"stat": "FAIL", "message": "Invalid request"}),
+            FakeResponse(200, {"stat": "OK", "response": {"result": "deny"}}),
+        ],
+    )
+    breaker = Breaker()
+    for _ in range(5):
+        assert not checkduo.check_duo(
+            "foo",
+            "127.0.0.1",
+            {},
+            client=client,
+            breaker=breaker,  # type: ignore
+        )
+
+    # only duo being unreachable or failing counts against it, and a push
+    # that the user did not answer in time counts for nothing
+    assert breaker.calls == [None, True, True, False, False]
+
+
+def test_auth_async_without_txid(monkeypatch: pytest.MonkeyPatch) -> None:
+    client, session, delays = make_client(
+        monkeypatch,
+        [FakeResponse(200, {"stat": "OK", "response": {}})],
+    )
+    with pytest.raises(DuoError):
+        client.auth_async("foo", "127.0.0.1")
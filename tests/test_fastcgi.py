@@ -0,0 +1,151 @@
+import io
+import socket
+import struct
+import threading
+import typing
+
+import pytest
+
+from checkduo import checkduo, fastcgi
+
+
+@pytest.fixture()
+def address(
+    session_authenticator: checkduo.Authenticator,
+) -> typing.Iterator[typing.Tuple[str, int]]:
+    with fastcgi.Server("127.0.0.1", 0, session_authenticator) as server:
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield "127.0.0.1", server.server_address[1]
+        server.shutdown()
+
+
+def authorize(
+    connection: socket.socket,
+    params: typing.Dict[str, str],
+    request_id: int = 1,
+    keep: bool = False,
+    role: int = fastcgi.AUTHORIZER,
+) -> typing.Tuple[bytes, int]:
+    # send a request the way mod_authnz_fcgi does and return what was written
+    # to stdout along with the protocol status
+    stream = io.BytesIO()
+    begin = struct.pack("!HB5x", role, fastcgi.KEEP_CONN if keep else 0)
+    fastcgi.write_record(stream, fastcgi.BEGIN_REQUEST, request_id, begin)
+    fastcgi.write_record(
+        stream,
+        fastcgi.PARAMS,
+        request_id,
+        fastcgi.encode_params(params),
+    )
+    fastcgi.write_record(stream, fastcgi.PARAMS, request_id)
+    connection.sendall(stream.getvalue())
+
+    output = b""
+    with connection.makefile("rb") as f:
+        while True:
+            record = fastcgi.read_record(f)
+            assert record is not None
+            kind, received_id, content = record
+            assert received_id == request_id
+            if kind == fastcgi.STDOUT:
+                output += content
+            elif kind == fastcgi.END_REQUEST:
+                return output, content[4]
+
+
+def test_params() -> None:
+    params = {"HTTP_COOKIE": "x" * 300, "REMOTE_USER": "foo", "EMPTY": ""}
+    assert fastcgi.decode_params(fastcgi.encode_params(params)) == params
+
+    # a truncated pair is dropped
+    assert fastcgi.decode_params(fastcgi.encode_params(params)[:-2]) == {
+        "HTTP_COOKIE": "x" * 300,
+        "REMOTE_USER": "foo",
+    }
+
+
+def test_records() -> None:
+    stream = io.BytesIO()
+    fastcgi.write_record(stream, fastcgi.STDOUT, 1, b"x" * 70000)
+    stream.seek(0)
+
+    # long content is split and every record can be read back
+    first = fastcgi.read_record(stream)
+    second = fastcgi.read_record(stream)
+    assert first == (fastcgi.STDOUT, 1, b"x" * 65535)
+    assert second == (fastcgi.STDOUT, 1, b"x" * 4465)
+    assert fastcgi.read_record(stream) is None
+
+
+def test_authenticator_provider(address: typing.Tuple[str, int]) -> None:
+    params = {
+        "REMOTE_ADDR": "127.0.0.1",
+        "REMOTE_USER": "foo",
+        "REMOTE_PASSWD": "password",  # noqa: S105
+        "HTTP_COOKIE": "foobar=abc123",
+        "FCGI_APACHE_ROLE": "AUTHENTICATOR",
+    }
+    with socket.create_connection(address) as connection:
+        output, status = authorize(connection, params)
+    assert output.startswith(b"Status: 200")
+    assert status == fastcgi.REQUEST_COMPLETE
+
+    with socket.create_connection(address) as connection:
+        wrong = {**params, "REMOTE_PASSWD": "wrong"}  # noqa: S105
+        output, _ = authorize(connection, wrong)
+    assert output.startswith(b"Status: 401")
+
+    # without a session cookie the user has not been through duo
+    with socket.create_connection(address) as connection:
+        output, _ = authorize(connection, {**params, "HTTP_COOKIE": "other=abc123"})
+    assert output.startswith(b"Status: 401")
+
+
+def test_basic_authentication(address: typing.Tuple[str, int]) -> None:
+    params = {
+        "REMOTE_ADDR": "127.0.0.1",
+        "HTTP_AUTHORIZATION": "Basic Zm9vOnBhc3N3b3Jk",
+        "CONTEXT": "login",
+    }
+
+    # the same connection can be used for one request after another
+    with socket.create_connection(address) as connection:
+        output, _ = authorize(connection, params, request_id=1, keep=True)
+        assert output.startswith(b"Status: 200")
+        output, _ = authorize(
+            connection,
+            {**params, "HTTP_AUTHORIZATION": "Basic bm90IGJhc2U2NA="},
+            request_id=2,
+        )
+        assert output.startswith(b"Status: 401")
+
+
+def test_unknown_role(address: typing.Tuple[str, int]) -> None:
+    with socket.create_connection(address) as connection:
+        stream = io.BytesIO()
+        begin = struct.pack("!HB5x", 1, 0)
+        fastcgi.write_record(stream, fastcgi.BEGIN_REQUEST, 1, begin)
+        connection.sendall(stream.getvalue())
+
+        with connection.makefile("rb") as f:
+            record = fastcgi.read_record(f)
+        assert record is not None
+        kind, _, content = record
+        assert kind == fastcgi.END_REQUEST
+        assert content[4] == fastcgi.UNKNOWN_ROLE
+
+
+def test_get_values(address: typing.Tuple[str, int]) -> None:
+    with socket.create_connection(address) as connection:
+        stream = io.BytesIO()
+        wanted = fastcgi.encode_params({"FCGI_MPXS_CONNS": "", "FCGI_MAX_REQS": ""})
+        fastcgi.write_record(stream, fastcgi.GET_VALUES, 0, wanted)
+        connection.sendall(stream.getvalue())
+
+        with connection.makefile("rb") as f:
+            record = fastcgi.read_record(f)
+        assert record is not None
+        kind, _, content = record
+        assert kind == fastcgi.GET_VALUES_RESULT
+        assert fastcgi.decode_params(content) == {"FCGI_MPXS_CONNS": "0"}
@@ -0,0 +1,109 @@
+import json
+import os
+import subprocess  # noqa: S404
+import sys
+import tempfile
+import typing
+
+import pytest
+
+from tests.conftest import PASSWORD_HASH
+
+# the packages that only the duo path should ever import
+DUO_PACKAGES = {"requests", "urllib3", "charset_normalizer", "idna", "checkduo.duo"}
+
+# what only the command lines and long running processes need. the password is
+# checked on every request so bcrypt is needed even when the cookie is good.
+CLI_MODULES = {"argparse", "getpass", "statistics", "checkduo.pool"}
+
+COOKIE_HIT = """
+import sys
+import redis.client
+redis.client.Pipeline.execute = lambda self, *args: [b'{"username": "foo"}', 10000]
+from checkduo import checkduo
+sys.exit(checkduo.main(sys.argv[1]))
+"""
+
+LOGIN = """
+import sys
+from checkduo import checkduo
+sys.exit(checkduo.main(sys.argv[1]))
+"""
+
+
+def run_with_imports(
+    code: str,
+    environment: typing.Dict[str, str],
+) -> typing.Tuple[int, typing.Set[str]]:
+    with tempfile.TemporaryDirectory() as t:
+        configuration_path = os.path.join(t, "configuration.json")
+        with open(configuration_path, "wt", encoding="utf8") as f:
+            json.dump(
+                {
+                    "usernames": {"foo": PASSWORD_HASH},
+                    "duo": {
+                        "ikey": "asdf",
+                        "skey": "fdsa",
+                        "host": "api-1234.example.com",
+                    },
+                    "cache": {"host": "localhost"},
+                    "session": {"name": "foobar", "expiry": 10},
+                },
+                f,
+            )
+
+        # the first run validates the configuration and leaves a snapshot
+        # behind. the run that we check is the steady state.
+        for _ in range(2):
+            result = subprocess.run(  # noqa: S603
+                [sys.executable, "-X", "importtime", "-c", code, configuration_path],
+                input="foo\npassword\n",
+                capture_output=True,
+                text=True,
+                env={**os.environ, **environment},
+                timeout=60,
+            )
+
+    modules = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        modules.add(line.rpartition("|")[2].strip())
+
+    return result.returncode, modules
+
+
+def imported(modules: typing.Set[str], packages: typing.Set[str]) -> typing.Set[str]:
+    return {
+        module
+        for module in modules
+        if any(module == p or module.startswith(f"{p}.") for p in packages)
+    }
+
+
+@pytest.mark.parametrize(
+    ("code", "environment", "excluded"),
+    [
+        (
+            LOGIN,
+            {"CONTEXT": "login"},
+            DUO_PACKAGES | CLI_MODULES | {"redis", "schema"},
+        ),
+        (
+            COOKIE_HIT,
+            {"COOKIE": "foobar=abc123"},
+            DUO_PACKAGES | CLI_MODULES | {"schema"},
+        ),
+    ],
+    ids=["login", "cookie-hit"],
+)
+def test_imports(
+    code: str,
+    environment: typing.Dict[str, str],
+    excluded: typing.Set[str],
+) -> None:
+    environment = {"IP": "127.0.0.1", "CONTEXT": "", "COOKIE": "", **environment}
+    status, modules = run_with_imports(code, environment)
+    assert status == 0
+    assert "checkduo.checkduo" in modules
+    assert imported(modules, excluded) == set()
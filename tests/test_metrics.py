@@ -0,0 +1,146 @@
+import json
+import os
+import socket
+import tempfile
+import threading
+import typing
+import urllib.request
+
+import pytest
+
+from checkduo import checkduo
+from checkduo.daemon import MetricsServer
+from checkduo.duo import DuoTimeout
+from checkduo.metrics import Metrics
+from tests.conftest import PASSWORD_HASH
+
+
+def observations(metrics: Metrics) -> typing.Dict[typing.Tuple[str, str], int]:
+    return {key: histogram.count for key, histogram in metrics._histograms.items()}
+
+
+def test_timer_outcomes() -> None:
+    metrics = Metrics()
+    with metrics.timer("duo") as timer:
+        timer.outcome = "allow"
+
+    with pytest.raises(RuntimeError), metrics.timer("duo"):
+        raise RuntimeError("boom")
+
+    with metrics.timer("hash"):
+        pass
+
+    assert observations(metrics) == {
+        ("duo", "allow"): 1,
+        ("duo", "error"): 1,
+        ("hash", "ok"): 1,
+    }
+
+
+def test_render() -> None:
+    metrics = Metrics()
+    metrics.observe("duo", 0.003, "allow")
+    metrics.observe("duo", 7, "allow")
+
+    text = metrics.render()
+    assert "# TYPE checkduo_stage_seconds histogram" in text
+    assert (
+        'checkduo_stage_seconds_bucket{stage="duo",outcome="allow",le="0.0025"} 0'
+        in text
+    )
+    assert (
+        'checkduo_stage_seconds_bucket{stage="duo",outcome="allow",le="0.005"} 1'
+        in text
+    )
+    assert (
+        'checkduo_stage_seconds_bucket{stage="duo",outcome="allow",le="10"} 2' in text
+    )
+    assert (
+        'checkduo_stage_seconds_bucket{stage="duo",outcome="allow",le="+Inf"} 2' in text
+    )
+    assert 'checkduo_stage_seconds_count{stage="duo",outcome="allow"} 2' in text
+    assert "process_cpu_seconds_total" in text
+
+
+def test_statsd() -> None:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        s.settimeout(5)
+
+        metrics = Metrics({"port": s.getsockname()[1], "prefix": "test"})
+        metrics.observe("duo", 0.25, "deny")
+        metrics.observe("request", 0.5, "deny")
+        metrics.flush()
+
+        lines = s.recv(4096).decode("utf-8").split("\n")
+        assert lines == ["test.duo.deny:250.000|ms", "test.request.deny:500.000|ms"]
+
+    # nothing is sent twice
+    metrics.flush()
+    assert metrics._pending == []
+
+
+def test_statsd_unreachable(capsys: pytest.CaptureFixture) -> None:
+    metrics = Metrics({"host": "256.256.256.256"})
+    metrics.observe("duo", 0.25, "deny")
+    metrics.flush()
+    assert "could not send metrics to statsd" in capsys.readouterr().out
+
+
+def test_check_duo_timeout() -> None:
+    class Client:
+        def auth(self, username: str, ip_address: str) -> bool:
+            raise DuoTimeout("timed out talking to duo")
+
+    metrics = Metrics()
+    assert not checkduo.check_duo(
+        "foo",
+        "127.0.0.1",
+        {},
+        client=Client(),  # type: ignore
+        metrics=metrics,
+    )
+    assert observations(metrics) == {("duo", "timeout"): 1}
+
+
+def test_authenticator_stages() -> None:
+    with tempfile.TemporaryDirectory() as t:
+        authenticator = checkduo.Authenticator(
+            {
+                "usernames": {"foo": PASSWORD_HASH},
+                "duo": {"ikey": "asdf", "skey": "fdsa", "host": "api-1234.example.com"},
+                "cache": {"backend": "sqlite", "path": os.path.join(t, "sessions.db")},
+                "session": {"name": "foobar", "expiry": 10},
+            },
+        )
+        authenticator.store.set("abc123", json.dumps({"username": "foo"}), 10)
+
+        environment = {"IP": "127.0.0.1", "COOKIE": "foobar=abc123"}
+        assert authenticator.authenticate("foo", "password", environment) == 0
+        assert authenticator.authenticate("foo", "wrong", environment) == 1
+
+    assert observations(authenticator.metrics) == {
+        ("hash", "allow"): 1,
+        ("hash", "deny"): 1,
+        ("password", "allow"): 1,
+        ("password", "deny"): 1,
+        ("cookie", "found"): 1,
+        ("session_lookup", "hit"): 1,
+        ("request", "allow"): 1,
+        ("request", "deny"): 1,
+    }
+
+
+def test_metrics_server() -> None:
+    metrics = Metrics()
+    metrics.observe("duo", 0.1, "allow")
+
+    with MetricsServer(metrics, "127.0.0.1", 0) as server:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+            with urllib.request.urlopen(url, timeout=5) as r:  # noqa: S310
+                assert r.status == 200
+                assert 'stage="duo",outcome="allow"' in r.read().decode("utf-8")
+        finally:
+            server.shutdown()
@@ -0,0 +1,113 @@
+import marshal
+import os
+import tempfile
+import typing
+
+import pytest
+
+from checkduo import checkduo
+from checkduo.networks import NetworkIndex, compile_networks
+from tests.conftest import PASSWORD_HASH
+
+
+def test_lookups() -> None:
+    index = NetworkIndex.from_networks(
+        ["10.0.0.0/8", "192.168.1.0/24", "192.168.1.7", "2001:db8::/32"],
+    )
+    assert "10.0.0.0" in index
+    assert "10.255.255.255" in index
+    assert "11.0.0.0" not in index
+    assert "9.255.255.255" not in index
+    assert "192.168.1.7" in index
+    assert "192.168.2.1" not in index
+    assert "2001:db8::1" in index
+    assert "2001:db9::1" not in index
+
+    # ipv4 addresses mapped into ipv6 are looked up as ipv4
+    assert "::ffff:10.1.2.3" in index
+
+    # anything that is not an address is never trusted
+    assert "" not in index
+    assert "nonsense" not in index
+    assert "10.0.0.0/8" not in index
+
+
+def test_ranges_are_merged() -> None:
+    compiled = compile_networks(
+        ["10.0.1.0/24", "10.0.0.0/24", "10.0.0.128/25", "10.0.3.0/24", "10.0.0.5/16"],
+    )
+
+    # overlapping and neighbouring networks become one range, and host bits
+    # are ignored
+    assert compiled == {"4": [[167772160], [167837695]], "6": [[], []]}
+    assert len(NetworkIndex(compiled)) == 1
+
+
+def test_many_networks() -> None:
+    networks = [f"10.{i // 256}.{i % 256}.0/25" for i in range(5000)]
+    index = NetworkIndex.from_networks(networks)
+    assert len(index) == 5000
+    assert "10.19.135.1" in index
+    assert "10.19.135.129" not in index
+
+
+def test_compiled_configuration() -> None:
+    configuration = checkduo.validate_configuration(
+        {
+            "usernames": {"foo": PASSWORD_HASH},
+            "trusted_networks": [" 10.0.0.0/8 ", "2001:db8::/32"],
+            "duo": {"ikey": "asdf", "skey": "fdsa", "host": "api-1234.example.com"},
+            "cache": {"host": "foo.local"},
+            "session": {"name": "foobar", "expiry": 10},
+        },
+    )
+
+    # the index is built once and kept in the configuration snapshot
+    assert marshal.loads(marshal.dumps(configuration)) == configuration  # noqa: S302
+    assert "10.1.2.3" in NetworkIndex(configuration["trusted_networks"])
+
+    with pytest.raises(checkduo.ConfigurationError):
+        checkduo.validate_configuration(
+            {**configuration, "trusted_networks": ["10.0.0.0/33"]},
+        )
+
+
+def test_trusted_networks_skip_duo(monkeypatch: pytest.MonkeyPatch) -> None:
+    calls = []
+
+    def check_duo(username: str, *args: typing.Any, **kwargs: typing.Any) -> bool:
+        calls.append(username)
+        return True
+
+    monkeypatch.setattr(checkduo, "check_duo", check_duo)
+
+    with tempfile.TemporaryDirectory() as t:
+        authenticator = checkduo.Authenticator(
+            checkduo.validate_configuration(
+                {
+                    "usernames": {"foo": PASSWORD_HASH},
+                    "trusted_networks": ["10.0.0.0/8"],
+                    "duo": {
+                        "ikey": "asdf",
+                        "skey": "fdsa",
+                        "host": "api-1234.example.com",
+                    },
+                    "cache": {
+                        "backend": "sqlite",
+                        "path": os.path.join(t, "sessions.db"),
+                    },
+                    "session": {"name": "foobar", "expiry": 10},
+                },
+            ),
+        )
+
+        # a trusted network gets a session without duo
+        trusted = {"COOKIE": "foobar=abc123", "IP": "10.1.2.3"}
+        assert authenticator.authenticate("foo", "password", trusted) == 0
+        assert authenticator.store.exists("abc123")
+        assert calls == []
+
+        # and anywhere else still goes through duo
+        untrusted = {"COOKIE": "foobar=def456", "IP": "192.168.1.1"}
+        assert authenticator.authenticate("foo", "password", untrusted) == 0
+        assert calls == ["foo"]
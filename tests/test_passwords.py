@@ -0,0 +1,104 @@
+import typing
+
+import pytest
+
+from checkduo import checkduo, passwords
+from tests.conftest import PASSWORD_HASH
+
+
+@pytest.mark.parametrize(
+    ("algorithm", "parameters"),
+    [
+        ("bcrypt", {"cost": 4}),
+        ("scrypt", {"ln": 10, "r": 8, "p": 1}),
+        ("pbkdf2-sha256", {"rounds": 1000}),
+    ],
+)
+def test_hash_and_verify(algorithm: str, parameters: typing.Dict[str, int]) -> None:
+    verifier = passwords.verifier_named(algorithm)
+    hashed = verifier.hash("password", **parameters)
+
+    assert passwords.find_verifier(hashed) is verifier
+    assert verifier.parameters(hashed) == parameters
+    assert passwords.verify_password("password", hashed) is True
+    assert passwords.verify_password("asdf", hashed) is False
+
+
+def test_passlib_compatible_hashes() -> None:
+    # written by passlib so that hashes made elsewhere keep working
+    for hashed in (
+        "$scrypt$ln=4,r=8,p=1$ntO6t1YqZaxVqlWqdY7R2g$NaI+sopgLz7tEUw3wCXkvux7n0YOKa5SHqK3K7O27eM",  # noqa: S105
+        "$pbkdf2-sha256$1000$xPg/xzgHgNB6D4GQEuKckw$k/Tzw3y2Hdd4D3UFrty8OOSgNgcHnrmVmXRh35CqQ7U",  # noqa: S105
+        PASSWORD_HASH,
+    ):
+        assert passwords.verify_password("password", hashed) is True
+        assert passwords.verify_password("asdf", hashed) is False
+
+
+def test_unsupported_hashes() -> None:
+    with pytest.raises(passwords.UnsupportedHash):
+        passwords.verify_password("password", "$1$plainoldmd5")
+
+    with pytest.raises(passwords.UnsupportedHash):
+        passwords.verify_password("password", "$scrypt$ln=10$nonsense")
+
+    with pytest.raises(passwords.UnsupportedHash):
+        passwords.verifier_named("md5")
+
+
+def test_unsupported_hash_is_denied() -> None:
+    usernames = {"foo": "$1$plainoldmd5"}
+    assert not checkduo.is_valid_password(usernames, "foo", "password", "", "")
+
+
+def test_calibrate(monkeypatch: pytest.MonkeyPatch) -> None:
+    # pretend that each level costs twice as much as the one before it
+    verifier = passwords.verifier_named("pbkdf2-sha256")
+    monkeypatch.setattr(verifier, "hash", lambda password, rounds: str(rounds))
+    monkeypatch.setattr(
+        passwords,
+        "time_verification",
+        lambda hashed: int(hashed) / 2**20 * 0.1,
+    )
+
+    parameters, seconds = passwords.calibrate(verifier, 0.1)
+    assert parameters == {"rounds": 2**20}
+    assert seconds == pytest.approx(0.1)
+
+    # nothing is cheap enough so the cheapest is all that can be recommended
+    parameters, _ = passwords.calibrate(verifier, 0.0000001)
+    assert parameters == {"rounds": 2**14}
+
+
+def test_report(monkeypatch: pytest.MonkeyPatch) -> None:
+    timed = []
+
+    def time_verification(hashed: str) -> float:
+        timed.append(hashed)
+        return {4: 0.001, 12: 0.1, 16: 2.0}[int(hashed.split("$")[2])]
+
+    monkeypatch.setattr(passwords, "time_verification", time_verification)
+
+    rows = passwords.report(
+        {
+            "cheap": "$2b$04$aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa",
+            "fine": "$2b$12$aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa",
+            "also-fine": "$2b$12$bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb",
+            "slow": "$2b$16$aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa",
+            "nobody": None,
+            "old": "$1$plainoldmd5",
+        },
+        target=0.1,
+        tolerance=2,
+    )
+
+    statuses = {row["username"]: row["status"] for row in rows}
+    assert statuses["cheap"] == "under"
+    assert statuses["fine"] == "ok"
+    assert statuses["also-fine"] == "ok"
+    assert statuses["slow"] == "over"
+    assert statuses["nobody"] == "no password"
+    assert statuses["old"].startswith("unsupported")
+
+    # users with the same parameters are only timed once
+    assert len(timed) == 3
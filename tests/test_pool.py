@@ -0,0 +1,135 @@
+import threading
+import typing
+
+import pytest
+
+from checkduo import checkduo, pool
+from checkduo.credentials import CredentialCache
+from checkduo.metrics import Metrics
+from checkduo.passwords import UnsupportedHash
+from tests.conftest import PASSWORD_HASH
+
+
+@pytest.fixture()
+def blocked(monkeypatch: pytest.MonkeyPatch) -> typing.Iterator[threading.Event]:
+    # every check waits until the test lets it go
+    release = threading.Event()
+
+    def verify_password(password: str, hashed: str) -> bool:
+        release.wait(5)
+        return password == "password"  # noqa: S105
+
+    monkeypatch.setattr(pool, "verify_password", verify_password)
+    yield release
+    release.set()
+
+
+def test_verify() -> None:
+    verification = pool.VerificationPool(workers=2)
+    verification.start()
+    try:
+        assert verification.verify("password", PASSWORD_HASH) is True
+        assert verification.verify("asdf", PASSWORD_HASH) is False
+        with pytest.raises(UnsupportedHash):
+            verification.verify("password", "$1$plainoldmd5")
+    finally:
+        verification.close()
+
+    assert verification.stats()["busy"] == 0
+
+
+def wait_for(verification: pool.VerificationPool, busy: int, queued: int) -> None:
+    for _ in range(500):
+        stats = verification.stats()
+        if stats["busy"] == busy and stats["queued"] == queued:
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError(f"pool never reached {busy} busy and {queued} queued")
+
+
+def test_shed_when_full(blocked: threading.Event) -> None:
+    verification = pool.VerificationPool(workers=1, queue_size=1, timeout=5)
+    verification.start()
+
+    results: typing.List[bool] = []
+    threads = []
+    for busy, queued in [(1, 0), (1, 1)]:
+        thread = threading.Thread(
+            target=lambda: results.append(verification.verify("password", "")),
+        )
+        thread.start()
+        threads.append(thread)
+        wait_for(verification, busy, queued)
+
+    # one check is being worked on and one is waiting so the next is shed
+    with pytest.raises(pool.VerificationPoolFull):
+        verification.verify("password", "")
+
+    blocked.set()
+    for thread in threads:
+        thread.join()
+    verification.close()
+
+    assert results == [True, True]
+    assert verification.stats()["shed"] == 1
+
+
+def test_timeout(blocked: threading.Event) -> None:
+    verification = pool.VerificationPool(workers=1, timeout=0.1)
+    verification.start()
+
+    with pytest.raises(pool.VerificationTimeout):
+        verification.verify("password", "")
+    assert verification.stats()["timeouts"] == 1
+
+    blocked.set()
+    verification.close()
+
+
+def test_saturation_metrics(blocked: threading.Event) -> None:
+    metrics = Metrics()
+    verification = pool.VerificationPool(workers=1, metrics=metrics)
+    verification.start()
+
+    thread = threading.Thread(target=verification.verify, args=("password", ""))
+    thread.start()
+    wait_for(verification, 1, 0)
+
+    text = metrics.render()
+    assert "# TYPE checkduo_verification_queue_depth gauge" in text
+    assert "checkduo_verification_workers_busy 1" in text
+
+    blocked.set()
+    thread.join()
+    verification.close()
+    assert 'stage="verification_wait"' in metrics.render()
+
+
+def test_overloaded_is_not_remembered(blocked: threading.Event) -> None:
+    verification = pool.VerificationPool(workers=1, timeout=0.1)
+    verification.start()
+
+    cache = CredentialCache()
+    usernames = {"foo": PASSWORD_HASH}
+    assert not checkduo.is_valid_password(
+        usernames,
+        "foo",
+        "password",
+        "127.0.0.1",
+        "",
+        cache=cache,
+        pool=verification,
+    )
+    assert cache.stats()["size"] == 0
+
+    blocked.set()
+    assert checkduo.is_valid_password(
+        usernames,
+        "foo",
+        "password",
+        "127.0.0.1",
+        "",
+        cache=cache,
+        pool=verification,
+    )
+    verification.close()
@@ -0,0 +1,171 @@
+import typing
+
+import pytest
+import redis
+
+from checkduo import checkduo
+from checkduo.credentials import CredentialCache
+from checkduo.ratelimit import LocalRateLimiter, RedisRateLimiter, create_rate_limiter
+from tests.conftest import PASSWORD_HASH
+
+
+def test_local_limits(monkeypatch: pytest.MonkeyPatch) -> None:
+    now = [1000.0]
+    monkeypatch.setattr("time.monotonic", lambda: now[0])
+
+    limiter = LocalRateLimiter(
+        ip={"rate": 1, "burst": 3},
+        username={"rate": 0.5, "burst": 2},
+    )
+
+    # checking does not use anything up, only failing does
+    for _ in range(5):
+        assert limiter.allow("foo", "10.0.0.1")
+    limiter.failed("foo", "10.0.0.1")
+    assert limiter.allow("foo", "10.0.0.1")
+    limiter.failed("foo", "10.0.0.1")
+    assert not limiter.allow("foo", "10.0.0.1")
+
+    # the address still has a token left
+    assert limiter.allow("bar", "10.0.0.1")
+    limiter.failed("bar", "10.0.0.1")
+    assert not limiter.allow("baz", "10.0.0.1")
+
+    # and failing again does not put a bucket further behind
+    limiter.failed("foo", "10.0.0.1")
+    now[0] += 2
+    assert limiter.allow("foo", "10.0.0.2")
+    limiter.failed("foo", "10.0.0.2")
+    assert not limiter.allow("foo", "10.0.0.2")
+
+    assert limiter.stats() == {"allowed": 8, "limited": 3}
+
+
+def test_local_limits_are_bounded() -> None:
+    limiter = LocalRateLimiter(size=4, username={"rate": 0.001, "burst": 1})
+    for username in ["a", "b", "c", "d", "e"]:
+        limiter.failed(username, "")
+    assert len(limiter._buckets) == 4
+
+    # the oldest bucket was forgotten
+    assert limiter.allow("a", "")
+    assert not limiter.allow("e", "")
+
+
+def test_redis_limits() -> None:
+    calls = []
+
+    def script(keys: typing.List[str], args: typing.List[float]) -> int:
+        calls.append((keys, args))
+        return 0
+
+    limiter = RedisRateLimiter(
+        {"host": "localhost"},
+        ip={"burst": 5},
+        prefix="limits:",
+    )
+    limiter.script = script  # type: ignore
+
+    # one call to redis checks every bucket and another takes from them
+    assert not limiter.allow("foo", "10.0.0.1")
+    limiter.failed("foo", "10.0.0.1")
+    keys = ["limits:user:foo", "limits:ip:10.0.0.1"]
+    assert calls == [(keys, [0, 0.5, 10, 1.0, 5]), (keys, [1, 0.5, 10, 1.0, 5])]
+
+
+def test_redis_limits_fall_back() -> None:
+    calls = []
+
+    def script(keys: typing.List[str], args: typing.List[float]) -> int:
+        calls.append(keys)
+        raise redis.exceptions.ConnectionError("down")
+
+    limiter = RedisRateLimiter(
+        {"host": "localhost"},
+        username={"rate": 0.001, "burst": 2},
+    )
+    limiter.script = script  # type: ignore
+
+    for _ in range(2):
+        assert limiter.allow("foo", "10.0.0.1")
+        limiter.failed("foo", "10.0.0.1")
+    assert not limiter.allow("foo", "10.0.0.1")
+    assert limiter.stats() == {"allowed": 2, "limited": 1, "fallbacks": 5}
+
+    # redis is not asked again for a while after it could not be reached
+    assert len(calls) == 1
+
+
+def test_create_rate_limiter() -> None:
+    limiter = create_rate_limiter({"ip": {"burst": 5}}, {"host": "foo.local", "db": 2})
+    assert isinstance(limiter, RedisRateLimiter)
+    assert limiter.redis.connection_pool.connection_kwargs["db"] == 2
+    assert limiter.ip == {"rate": 1.0, "burst": 5}
+
+    limiter = create_rate_limiter({}, {"backend": "sqlite", "path": "sessions.db"})
+    assert isinstance(limiter, LocalRateLimiter)
+
+    # buckets kept next to sessions are named so that no cookie can be one
+    shared = checkduo.Authenticator(
+        {
+            "usernames": {},
+            "duo": {"ikey": "asdf", "skey": "fdsa", "host": "api-1234.example.com"},
+            "cache": {"host": "foo.local", "prefix": "session:"},
+            "session": {"name": "foobar", "expiry": 10},
+            "rate_limit": {},
+        },
+    ).rate_limiter
+    assert shared is not None
+    assert shared.buckets("foo", "")[0].key == f"session:{checkduo.RATE_LIMIT}user:foo"
+
+
+def test_limited_before_hashing(monkeypatch: pytest.MonkeyPatch) -> None:
+    hashed = []
+
+    def verify_password(password: str, valid_password: str) -> bool:
+        hashed.append(password)
+        return False
+
+    monkeypatch.setattr(checkduo, "verify_password", verify_password)
+
+    usernames = {"foo": PASSWORD_HASH}
+    limiter = LocalRateLimiter(username={"rate": 0.001, "burst": 2})
+    for _ in range(5):
+        assert not checkduo.is_valid_password(
+            usernames,
+            "foo",
+            "wrong",
+            "127.0.0.1",
+            "",
+            limiter=limiter,
+        )
+
+    assert len(hashed) == 2
+    assert limiter.stats() == {"allowed": 2, "limited": 3}
+
+
+def test_authenticator_rate_limits() -> None:
+    authenticator = checkduo.Authenticator(
+        checkduo.validate_configuration(
+            {
+                "usernames": {"foo": PASSWORD_HASH},
+                "duo": {"ikey": "asdf", "skey": "fdsa", "host": "api-1234.example.com"},
+                "cache": {"backend": "sqlite", "path": "sessions.db"},
+                "session": {"name": "foobar", "expiry": 10},
+                "rate_limit": {"username": {"rate": "0.001", "burst": "1"}},
+            },
+        ),
+    )
+    environment = {"IP": "127.0.0.1", "CONTEXT": "login"}
+
+    assert authenticator.authenticate("foo", "password", environment) == 0
+
+    # a remembered password is not checked and a right one uses nothing up
+    assert authenticator.authenticate("foo", "password", environment) == 0
+    authenticator.password_cache = CredentialCache(size=0)
+    assert authenticator.authenticate("foo", "password", environment) == 0
+
+    # but a wrong one does
+    assert authenticator.authenticate("foo", "wrong", environment) == 1
+    assert authenticator.authenticate("foo", "wrong again", environment) == 1
+    assert authenticator.stats()["rate_limit"] == {"allowed": 3, "limited": 1}
@@ -0,0 +1,168 @@
+import json
+import os
+import tempfile
+import time
+import typing
+from datetime import datetime
+
+import pytest
+
+from checkduo import checkduo, sessions
+from checkduo.stores import SQLiteSessionStore
+from tests.conftest import PASSWORD_HASH
+
+
+def session(timestamp: str) -> str:
+    return json.dumps({"username": "foo", "timestamp": timestamp})
+
+
+def test_sqlite_index(monkeypatch: pytest.MonkeyPatch) -> None:
+    with tempfile.TemporaryDirectory() as t:
+        store = SQLiteSessionStore(os.path.join(t, "sessions.db"))
+        store.set("a", "{}", 10, index="foo")
+        store.set("b", "{}", 100, index="foo")
+        store.set("c", "{}", 10, index="bar")
+        store.set("d", "{}", 10)
+
+        assert sorted(s.key for s in store.sessions("foo")) == ["a", "b"]
+        assert [s.key for s in store.sessions("bar")] == ["c"]
+
+        # sessions that expired or were deleted drop out of the index
+        store.delete("b")
+        now = time.time()
+        monkeypatch.setattr("time.time", lambda: now + 20)
+        assert store.sessions("foo") == []
+        rows = store.connection.execute("SELECT key FROM session_index").fetchall()
+        assert rows == [("c",)]
+
+
+def test_find_and_revoke() -> None:
+    with tempfile.TemporaryDirectory() as t:
+        store = SQLiteSessionStore(os.path.join(t, "sessions.db"))
+        index = checkduo.session_index("session:", "foo")
+        store.set("session:old", session("2020-01-01 00:00:00"), 100, index=index)
+        store.set("session:new", session(str(datetime.utcnow())), 100, index=index)
+        store.set("session:odd", "nonsense", 100, index=index)
+        store.set(
+            "session:other",
+            session("2020-01-01 00:00:00.000000"),
+            100,
+            index=checkduo.session_index("session:", "bar"),
+        )
+
+        assert len(sessions.find_sessions(store, "session:", "foo")) == 3
+
+        # a session that does not say when it was made counts as old
+        old = sessions.find_sessions(store, "session:", "foo", older_than=3600)
+        assert sorted(s.key for s in old) == ["session:odd", "session:old"]
+
+        store.revoke(index, [s.key for s in old])
+        assert not store.exists("session:old")
+        assert store.exists("session:new")
+        assert store.exists("session:other")
+        assert [s.key for s in sessions.find_sessions(store, "session:", "foo")] == [
+            "session:new",
+        ]
+
+
+def test_commands(capsys: pytest.CaptureFixture) -> None:
+    with tempfile.TemporaryDirectory() as t:
+        configuration = {
+            "cache": {
+                "backend": "sqlite",
+                "path": os.path.join(t, "sessions.db"),
+                "prefix": "session:",
+            },
+        }
+        store = SQLiteSessionStore(configuration["cache"]["path"])
+        for key in ("session:a", "session:b"):
+            store.set(
+                key,
+                session("2020-01-01 00:00:00.000000"),
+                100,
+                index=checkduo.session_index("session:", "foo"),
+            )
+
+        assert sessions.main_count(configuration, ["foo", "bar"], None) == 0
+        assert capsys.readouterr().out == "foo 2\nbar 0\n"
+
+        # cookies are never printed
+        assert sessions.main_list(configuration, ["foo"], None) == 0
+        output = capsys.readouterr().out
+        assert output.count("foo ") == 2
+        assert "session:a" not in output
+
+        assert sessions.main_revoke(configuration, ["foo"], 3600) == 0
+        assert capsys.readouterr().out == "revoked 2 sessions for foo\n"
+        assert not store.exists("session:a")
+
+
+def test_authenticator_indexes_sessions(monkeypatch: pytest.MonkeyPatch) -> None:
+    def check_duo(*args: typing.Any, **kwargs: typing.Any) -> bool:
+        return True
+
+    monkeypatch.setattr(checkduo, "check_duo", check_duo)
+
+    with tempfile.TemporaryDirectory() as t:
+        authenticator = checkduo.Authenticator(
+            {
+                "usernames": {"foo": PASSWORD_HASH},
+                "duo": {"ikey": "asdf", "skey": "fdsa", "host": "api-1234.example.com"},
+                "cache": {
+                    "backend": "sqlite",
+                    "path": os.path.join(t, "sessions.db"),
+                    "prefix": "session:",
+                },
+                "session": {"name": "foobar", "expiry": 10},
+            },
+        )
+        environment = {"IP": "127.0.0.1", "COOKIE": "foobar=abc123"}
+        assert authenticator.authenticate("foo", "password", environment) == 0
+
+        found = sessions.find_sessions(authenticator.store, "session:", "foo")
+        assert [s.key for s in found] == ["session:abc123"]
+        assert sessions.created(found[0]) is not None
+
+
+def test_revoke_remembered_devices(
+    monkeypatch: pytest.MonkeyPatch,
+    capsys: pytest.CaptureFixture,
+) -> None:
+    calls = []
+
+    def check_duo(username: str, *args: typing.Any, **kwargs: typing.Any) -> bool:
+        calls.append(username)
+        return True
+
+    monkeypatch.setattr(checkduo, "check_duo", check_duo)
+
+    with tempfile.TemporaryDirectory() as t:
+        configuration = {
+            "usernames": {"foo": PASSWORD_HASH},
+            "duo": {"ikey": "asdf", "skey": "fdsa", "host": "api-1234.example.com"},
+            "cache": {
+                "backend": "sqlite",
+                "path": os.path.join(t, "sessions.db"),
+                "prefix": "session:",
+            },
+            "session": {"name": "foobar", "expiry": 10, "remember": {"ttl": 60}},
+        }
+        authenticator = checkduo.Authenticator(configuration)
+        environment = {"IP": "127.0.0.1", "COOKIE": "foobar=abc123"}
+        assert authenticator.authenticate("foo", "password", environment) == 0
+
+        assert sessions.main_list(configuration, ["foo"], None) == 0
+        assert capsys.readouterr().out.count("(remembered device)") == 1
+
+        # revoking a user's sessions forgets their devices too
+        assert sessions.main_revoke(configuration, ["foo"], None) == 0
+        assert capsys.readouterr().out == "revoked 2 sessions for foo\n"
+        assert authenticator.authenticate("foo", "password", environment) == 0
+        assert calls == ["foo", "foo"]
+
+
+def test_cookie_cannot_name_an_index() -> None:
+    # nor anything else that is kept next to sessions
+    for reserved in checkduo.RESERVED:
+        assert checkduo.get_cookie(f"foobar={reserved}foo", "foobar") is None
+    assert checkduo.get_cookie("foobar=abc123", "foobar") == "abc123"
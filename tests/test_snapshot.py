@@ -0,0 +1,124 @@
+import json
+import os
+import stat
+import tempfile
+import typing
+
+import pytest
+
+from checkduo import checkduo
+
+CONFIGURATION = {
+    "usernames": {" foobar ": " bazbat "},
+    "duo": {
+        "ikey": "asdf  ",
+        "skey": "  fdsa  ",
+        "host": " api-1234.example.com ",
+    },
+    "cache": {"host": "foo.local"},
+    "session": {"name": "foobar", "expiry": "10"},
+}
+
+
+def write_configuration(path: str, configuration: dict) -> None:
+    with open(path, "wt", encoding="utf8") as f:
+        json.dump(configuration, f)
+
+
+def test_compile_configuration() -> None:
+    with tempfile.TemporaryDirectory() as t:
+        configuration_path = os.path.join(t, "configuration.json")
+        write_configuration(configuration_path, CONFIGURATION)
+
+        configuration = checkduo.compile_configuration(configuration_path)
+        assert configuration == checkduo.load_configuration(configuration_path)
+
+        # the snapshot has secrets in it so only the owner can read it
+        mode = os.stat(checkduo.snapshot_path(configuration_path)).st_mode
+        assert stat.S_IMODE(mode) == 0o600
+
+        assert checkduo.load_compiled_configuration(configuration_path) == configuration
+
+
+def test_snapshot_skips_validation(monkeypatch: pytest.MonkeyPatch) -> None:
+    with tempfile.TemporaryDirectory() as t:
+        configuration_path = os.path.join(t, "configuration.json")
+        write_configuration(configuration_path, CONFIGURATION)
+        configuration = checkduo.compile_configuration(configuration_path)
+
+        def fail(configuration: dict) -> dict:
+            raise AssertionError("configuration was validated again")
+
+        monkeypatch.setattr(checkduo, "validate_configuration", fail)
+        assert checkduo.load_compiled_configuration(configuration_path) == configuration
+
+        # touching the file without changing it does not need validation either
+        os.utime(configuration_path, ns=(0, 0))
+        assert checkduo.load_compiled_configuration(configuration_path) == configuration
+
+
+def test_snapshot_invalidation() -> None:
+    with tempfile.TemporaryDirectory() as t:
+        configuration_path = os.path.join(t, "configuration.json")
+        write_configuration(configuration_path, CONFIGURATION)
+        configuration = checkduo.load_compiled_configuration(configuration_path)
+        assert configuration["usernames"] == {"foobar": "bazbat"}
+        assert os.path.exists(checkduo.snapshot_path(configuration_path))
+
+        changed = {**CONFIGURATION, "usernames": {"joe": "x"}}
+        write_configuration(configuration_path, changed)
+        configuration = checkduo.load_compiled_configuration(configuration_path)
+        assert configuration["usernames"] == {"joe": "x"}
+
+        # an invalid edit is never hidden by an old snapshot
+        write_configuration(configuration_path, {**CONFIGURATION, "usernames": None})
+        with pytest.raises(checkduo.ConfigurationError):
+            checkduo.load_compiled_configuration(configuration_path)
+
+
+def test_unwritable_snapshot(
+    monkeypatch: pytest.MonkeyPatch,
+    capsys: pytest.CaptureFixture,
+) -> None:
+    with tempfile.TemporaryDirectory() as t:
+        configuration_path = os.path.join(t, "configuration.json")
+        write_configuration(configuration_path, CONFIGURATION)
+        expected = checkduo.load_configuration(configuration_path)
+
+        def fail(*args: typing.Any, **kwargs: typing.Any) -> typing.NoReturn:
+            raise PermissionError("read only")
+
+        validate = checkduo.validate_configuration
+        validated = []
+
+        def count(configuration: dict) -> dict:
+            validated.append(configuration)
+            return validate(configuration)
+
+        monkeypatch.setattr("tempfile.mkstemp", fail)
+        monkeypatch.setattr(checkduo, "validate_configuration", count)
+
+        # the configuration is still only validated once
+        assert checkduo.load_compiled_configuration(configuration_path) == expected
+        assert len(validated) == 1
+        assert capsys.readouterr().out.count("could not write") == 1
+
+
+def test_corrupt_snapshot() -> None:
+    with tempfile.TemporaryDirectory() as t:
+        configuration_path = os.path.join(t, "configuration.json")
+        write_configuration(configuration_path, CONFIGURATION)
+        configuration = checkduo.compile_configuration(configuration_path)
+
+        with open(checkduo.snapshot_path(configuration_path), "wb") as f:
+            f.write(b"garbage")
+        assert checkduo.load_compiled_configuration(configuration_path) == configuration
+
+
+def test_missing_configuration() -> None:
+    with tempfile.TemporaryDirectory() as t:
+        configuration_path = os.path.join(t, "configuration.json")
+        with pytest.raises(checkduo.ConfigurationError):
+            checkduo.compile_configuration(configuration_path)
+        with pytest.raises(checkduo.ConfigurationError):
+            checkduo.load_compiled_configuration(configuration_path)
@@ -0,0 +1,883 @@
+import hashlib
+import json
+import os
+import socketserver
+import tempfile
+import threading
+import time
+import typing
+
+import pytest
+import redis
+
+from checkduo import checkduo
+from checkduo.stores import (
+    EXTEND_SCRIPT,
+    CachingSessionStore,
+    FailoverSessionStore,
+    Lookup,
+    MemcachedSessionStore,
+    RedisSessionStore,
+    SessionStore,
+    SessionStoreError,
+    SlidingSessionStore,
+    SQLiteSessionStore,
+    create_session_store,
+    redis_clients,
+)
+
+
+class FakeMemcachedHandler(socketserver.StreamRequestHandler):
+    server: "FakeMemcached"
+
+    def handle(self) -> None:
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            command = line.decode("utf-8").split()
+            if command[0] == "get":
+                value = self.server.values.get(command[1])
+                if value is not None:
+                    self.wfile.write(f"VALUE {command[1]} 0 {len(value)}\r\n".encode())
+                    self.wfile.write(value + b"\r\n")
+                self.wfile.write(b"END\r\n")
+            elif command[0] in ("set", "add"):
+                value = self.rfile.read(int(command[4]) + 2)[:-2]
+                if command[0] == "add" and command[1] in self.server.values:
+                    self.wfile.write(b"NOT_STORED\r\n")
+                else:
+                    self.server.values[command[1]] = value
+                    self.wfile.write(b"STORED\r\n")
+            elif command[0] == "delete":
+                self.server.values.pop(command[1], None)
+                self.wfile.write(b"DELETED\r\n")
+            elif command[0] == "incr":
+                if command[1] not in self.server.values:
+                    self.wfile.write(b"NOT_FOUND\r\n")
+                else:
+                    count = int(self.server.values[command[1]]) + int(command[2])
+                    self.server.values[command[1]] = str(count).encode()
+                    self.wfile.write(f"{count}\r\n".encode())
+            elif command[0] == "touch":
+                self.server.touched[command[1]] = int(command[2])
+                self.wfile.write(b"TOUCHED\r\n")
+
+
+class FakeMemcached(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        self.values: typing.Dict[str, bytes] = {}
+        self.touched: typing.Dict[str, int] = {}
+        super().__init__(("127.0.0.1", 0), FakeMemcachedHandler)
+
+
+class BrokenStore(SessionStore):
+    def exists(self, key: str) -> bool:
+        raise SessionStoreError("broken")
+
+    def remaining(self, key: str) -> typing.Optional[float]:
+        raise SessionStoreError("broken")
+
+    def set(  # noqa: A003
+        self,
+        key: str,
+        value: str,
+        expiry: int,
+        index: typing.Optional[str] = None,
+        idle: typing.Optional[int] = None,
+    ) -> None:
+        raise SessionStoreError("broken")
+
+
+def test_sqlite_store() -> None:
+    with tempfile.TemporaryDirectory() as t:
+        store = SQLiteSessionStore(os.path.join(t, "sessions.db"))
+        assert not store.exists("foo")
+
+        store.set("foo", "{}", 10)
+        assert store.exists("foo")
+
+        # a zero expiry means nothing is remembered
+        store.set("bar", "{}", 0)
+        assert not store.exists("bar")
+
+        # other threads get their own connection but see the same data
+        results = []
+        thread = threading.Thread(target=lambda: results.append(store.exists("foo")))
+        thread.start()
+        thread.join()
+        assert results == [True]
+
+        journal_mode = store.connection.execute("PRAGMA journal_mode").fetchone()
+        assert journal_mode == ("wal",)
+
+
+def test_sqlite_store_expiry(monkeypatch: pytest.MonkeyPatch) -> None:
+    now = [1000.0]
+    monkeypatch.setattr("time.time", lambda: now[0])
+
+    with tempfile.TemporaryDirectory() as t:
+        store = SQLiteSessionStore(os.path.join(t, "sessions.db"))
+        store.set("foo", "{}", 10)
+        assert store.exists("foo")
+
+        now[0] += 10
+        assert not store.exists("foo")
+
+
+def test_memcached_store() -> None:
+    with FakeMemcached() as server:
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        store = MemcachedSessionStore("127.0.0.1", server.server_address[1])
+        assert not store.exists("foo")
+        store.set("foo", "{}", 10)
+        assert store.exists("foo")
+
+        # long keys are hashed to fit within memcached's limits
+        key = "session:" + "a" * 300
+        store.set(key, "{}", 10)
+        assert store.exists(key)
+        assert all(len(k) <= 250 for k in server.values)
+
+        # and a key that is the hash of another key is still a different key
+        pending = "pending-duo:" + "a" * 300
+        store.set(pending, '{"username": "foo"}', 10)
+        assert not store.exists(hashlib.sha256(pending.encode("utf-8")).hexdigest())
+
+        server.shutdown()
+
+
+def test_sqlite_refresh(monkeypatch: pytest.MonkeyPatch) -> None:
+    now = [1000.0]
+    monkeypatch.setattr("time.time", lambda: now[0])
+
+    with tempfile.TemporaryDirectory() as t:
+        store = SQLiteSessionStore(os.path.join(t, "sessions.db"))
+        store.set("foo", json.dumps({"expires": 1100}), 100, idle=30)
+        store.set("bar", "{}", 100, idle=30)
+        assert store.remaining("foo") == 30
+
+        # a refreshed session gets another idle period but never outlives
+        # the expiry in its value
+        now[0] += 20
+        store.refresh(["foo", "bar", "missing"], 30)
+        assert store.remaining("foo") == 30
+        assert store.remaining("bar") == 10
+        for _ in range(3):
+            now[0] += 20
+            store.refresh(["foo"], 30)
+        assert store.remaining("foo") == 20
+
+
+def test_memcached_refresh() -> None:
+    with FakeMemcached() as server:
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        store = MemcachedSessionStore("127.0.0.1", server.server_address[1])
+        store.set("foo", json.dumps({"expires": time.time() + 100}), 100, idle=30)
+        store.set("bar", "{}", 100, idle=30)
+        store.refresh(["foo", "bar", "missing"], 30)
+        assert server.touched == {store._key("foo"): 30}
+
+        server.shutdown()
+
+
+def test_increment(monkeypatch: pytest.MonkeyPatch) -> None:
+    with tempfile.TemporaryDirectory() as t, FakeMemcached() as server:
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        stores: typing.List[SessionStore] = [
+            SQLiteSessionStore(os.path.join(t, "sessions.db")),
+            MemcachedSessionStore("127.0.0.1", server.server_address[1]),
+        ]
+        for store in stores:
+            assert store.increment("foo", 10) == 1
+            assert store.increment("foo", 10) == 2
+            assert store.increment("bar", 10) == 1
+
+        # counters go away like anything else
+        now = time.time()
+        monkeypatch.setattr("time.time", lambda: now + 10)
+        assert stores[0].increment("foo", 10) == 1
+
+        server.shutdown()
+
+
+def test_unreachable_stores() -> None:
+    with pytest.raises(SessionStoreError):
+        RedisSessionStore(host="127.0.0.1", port=1).exists("foo")
+
+    with pytest.raises(SessionStoreError):
+        MemcachedSessionStore("127.0.0.1", 1).exists("foo")
+
+
+def test_failover_store() -> None:
+    with tempfile.TemporaryDirectory() as t:
+        fallback = SQLiteSessionStore(os.path.join(t, "sessions.db"))
+        store = FailoverSessionStore(BrokenStore(), fallback)
+
+        assert not store.exists("foo")
+        store.set("foo", "{}", 10)
+        assert store.exists("foo")
+        assert fallback.exists("foo")
+        assert store.remaining("foo") == pytest.approx(10, abs=1)
+        assert store.remaining("bar") is None
+
+
+def test_create_session_store() -> None:
+    store = create_session_store({"host": "foo.local", "prefix": "session:"})
+    assert isinstance(store, RedisSessionStore)
+
+    store = create_session_store({"backend": "memcached", "host": "foo.local"})
+    assert isinstance(store, MemcachedSessionStore)
+
+    with tempfile.TemporaryDirectory() as t:
+        path = os.path.join(t, "sessions.db")
+        store = create_session_store({"backend": "sqlite", "path": path})
+        assert isinstance(store, SQLiteSessionStore)
+
+        store = create_session_store(
+            {
+                "host": "foo.local",
+                "fallback": {"backend": "sqlite", "path": path},
+            },
+        )
+        assert isinstance(store, FailoverSessionStore)
+        assert isinstance(store.primary, RedisSessionStore)
+        assert isinstance(store.fallback, SQLiteSessionStore)
+
+
+def test_cache_configuration() -> None:
+    configuration = {
+        "usernames": {},
+        "duo": {"ikey": "asdf", "skey": "fdsa", "host": "api-1234.example.com"},
+        "session": {"name": "foobar", "expiry": 10},
+    }
+
+    for cache in [
+        {"host": "foo.local", "port": "6379"},
+        {"backend": "redis", "host": "foo.local", "prefix": "session:"},
+        {"backend": "memcached", "host": "foo.local", "port": 11211},
+        {"backend": "sqlite", "path": "/var/lib/check-duo/sessions.db"},
+        {
+            "host": "foo.local",
+            "fallback": {"backend": "sqlite", "path": "/var/lib/check-duo/sessions.db"},
+        },
+    ]:
+        checkduo.validate_configuration({**configuration, "cache": cache})
+
+    for cache in [
+        {"backend": "sqlite"},
+        {"backend": "sqlite", "host": "foo.local"},
+        {"backend": "memcached", "host": "foo.local", "db": 1},
+        {"backend": "mongodb", "host": "foo.local"},
+        {"host": "foo.local", "fallback": {"host": "bar.local"}},
+    ]:
+        with pytest.raises(checkduo.ConfigurationError):
+            checkduo.validate_configuration({**configuration, "cache": cache})
+
+
+def test_redis_topology_configuration() -> None:
+    configuration = {
+        "usernames": {},
+        "duo": {"ikey": "asdf", "skey": "fdsa", "host": "api-1234.example.com"},
+        "session": {"name": "foobar", "expiry": 10},
+    }
+
+    for cache in [
+        {"host": "foo.local", "replicas": [{"host": "bar.local", "port": "6380"}]},
+        {
+            "sentinel": {"hosts": ["foo.local:26379", "bar.local"], "service": "main"},
+            "read_from_replicas": True,
+            "local": {"size": 10},
+        },
+        {"cluster": True, "host": "foo.local", "read_from_replicas": True},
+    ]:
+        checkduo.validate_configuration({**configuration, "cache": cache})
+
+    for cache in [
+        {"host": "foo.local", "replicas": [{"port": 6380}]},
+        {"sentinel": {"hosts": [], "service": "main"}},
+        {"sentinel": {"hosts": ["foo.local"]}},
+        {"cluster": True, "host": "foo.local", "db": 1},
+        # only the node that has a key says when it changes
+        {"cluster": True, "host": "foo.local", "local": {"size": 10}},
+    ]:
+        with pytest.raises(checkduo.ConfigurationError):
+            checkduo.validate_configuration({**configuration, "cache": cache})
+
+
+def test_redis_clients(monkeypatch: pytest.MonkeyPatch) -> None:
+    primary, replicas = redis_clients(
+        host="foo.local",
+        db=2,
+        replicas=[{"host": "bar.local"}, {"host": "baz.local", "port": 6380}],
+    )
+    assert primary.connection_pool.connection_kwargs["host"] == "foo.local"
+    assert [
+        (
+            replica.connection_pool.connection_kwargs["host"],
+            replica.connection_pool.connection_kwargs["port"],
+            replica.connection_pool.connection_kwargs["db"],
+        )
+        for replica in replicas
+    ] == [("bar.local", 6379, 2), ("baz.local", 6380, 2)]
+
+    primary, replicas = redis_clients(
+        sentinel={"hosts": ["foo.local:26380", "bar.local"], "service": "main"},
+        read_from_replicas=True,
+    )
+    assert primary.connection_pool.service_name == "main"
+    assert primary.connection_pool.is_master
+    assert not replicas[0].connection_pool.is_master
+    assert [
+        (
+            sentinel.connection_pool.connection_kwargs["host"],
+            sentinel.connection_pool.connection_kwargs["port"],
+        )
+        for sentinel in primary.connection_pool.sentinel_manager.sentinels
+    ] == [("foo.local", 26380), ("bar.local", 26379)]
+
+    # a cluster client connects as soon as it is created
+    created = []
+
+    def cluster(**kwargs: typing.Any) -> dict:
+        created.append(kwargs)
+        return kwargs
+
+    monkeypatch.setattr("redis.cluster.RedisCluster", cluster)
+    primary, replicas = redis_clients(
+        cluster=True,
+        host="foo.local",
+        read_from_replicas=True,
+    )
+    assert created == [
+        {"host": "foo.local"},
+        {"host": "foo.local", "read_from_replicas": True},
+    ]
+
+
+class FakeRedis:
+    def __init__(
+        self,
+        keys: typing.Dict[str, int],
+        down: bool = False,
+    ) -> None:
+        self.keys = keys
+        self.down = down
+        self.calls = 0
+
+    def exists(self, key: str) -> int:
+        self.calls += 1
+        if self.down:
+            raise redis.exceptions.ConnectionError("down")
+        return int(key in self.keys)
+
+    def pttl(self, key: str) -> int:
+        self.calls += 1
+        return self.keys.get(key, -2)
+
+
+def test_replica_reads() -> None:
+    store = RedisSessionStore(host="foo.local", replicas=[{"host": "bar.local"}])
+    primary = FakeRedis({"old": 10000, "new": 10000})
+    replica = FakeRedis({"old": 10000})
+    store.redis, store.replicas = primary, [replica]
+
+    # sessions are found on the replica without asking the primary
+    assert store.exists("old")
+    assert store.remaining("old") == 10
+    assert primary.calls == 0
+
+    # a session that has not reached the replica yet is found on the primary
+    assert store.exists("new")
+    assert not store.exists("missing")
+    assert store.remaining("missing") is None
+    assert primary.calls == 3
+
+    # and so is everything while the replica cannot be reached
+    replica.down = True
+    assert store.exists("old")
+    assert primary.calls == 4
+
+    assert store.stats() == {"replica_hits": 2, "primary_rechecks": 4}
+
+
+class FakePipeline:
+    def __init__(self, results: typing.List[typing.Any]) -> None:
+        self.commands: typing.List[typing.Tuple[str, tuple]] = []
+        self.results = results
+        self.executed = 0
+
+    def __getattr__(self, name: str) -> typing.Callable[..., None]:
+        return lambda *args, **kwargs: self.commands.append((name, args))
+
+    def execute(self) -> typing.List[typing.Any]:
+        self.executed += 1
+        return self.results
+
+
+def test_redis_index() -> None:
+    store = RedisSessionStore(host="foo.local")
+    pipelines = []
+
+    class Client:
+        def pipeline(self, transaction: bool) -> FakePipeline:
+            pipelines.append(FakePipeline(results.pop(0)))
+            return pipelines[-1]
+
+        def zrem(self, index: str, *keys: str) -> None:
+            removed.extend(keys)
+
+    results: typing.List[typing.Any] = [[]]
+    removed: typing.List[str] = []
+    store.redis = Client()
+
+    # the session and its index are written in one round trip
+    store.set("session:abc", "{}", 10, index="session:sessions-of:foo")
+    assert [name for name, _ in pipelines[0].commands] == [
+        "set",
+        "zadd",
+        "zremrangebyscore",
+        "eval",
+    ]
+    assert pipelines[0].executed == 1
+
+    # sessions that are gone are pruned from the index when it is read
+    results = [
+        [0, [(b"session:abc", 2000.0), (b"session:gone", 2000.0)]],
+        [b"{}", None],
+    ]
+    found = store.sessions("session:sessions-of:foo")
+    assert found == [("session:abc", "{}", 2000.0)]
+    assert removed == ["session:gone"]
+
+    results = [[]]
+    store.revoke("session:sessions-of:foo", ["session:abc"])
+    assert pipelines[-1].commands == [
+        ("delete", ("session:abc",)),
+        ("zrem", ("session:sessions-of:foo", "session:abc")),
+    ]
+
+
+class ExpiringRedis:
+    # runs each command as it is pipelined and only keeps track of how long
+    # each key has left, with None for keys that never expire
+    def __init__(self) -> None:
+        self.ttls: typing.Dict[str, typing.Optional[int]] = {}
+
+    def pipeline(self, transaction: bool) -> "ExpiringRedis":
+        return self
+
+    def execute(self) -> typing.List[typing.Any]:
+        return []
+
+    def set(self, key: str, value: str, ex: int) -> None:  # noqa: A003
+        self.ttls[key] = ex
+
+    def zadd(self, key: str, mapping: dict) -> None:
+        self.ttls.setdefault(key, None)
+
+    def zremrangebyscore(self, key: str, low: str, high: float) -> None:
+        pass
+
+    def eval(  # noqa: A003
+        self,
+        script: str,
+        count: int,
+        key: str,
+        seconds: int,
+    ) -> None:
+        assert script == EXTEND_SCRIPT
+        current = self.ttls[key]
+        if current is None or seconds > current:
+            self.ttls[key] = seconds
+
+
+def test_redis_index_expiry() -> None:
+    authenticator = checkduo.Authenticator(
+        {
+            "usernames": {},
+            "duo": {"ikey": "asdf", "skey": "fdsa", "host": "api-1234.example.com"},
+            "cache": {"host": "foo.local", "prefix": "session:"},
+            "session": {"name": "foobar", "expiry": 100, "remember": {"ttl": 10}},
+        },
+    )
+    client = ExpiringRedis()
+    authenticator.store.redis = client  # type: ignore
+    index = checkduo.session_index("session:", "foo")
+    remembered = checkduo.remembered_device("session:", "foo", ["127.0.0.1"])
+
+    # a remembered device that ends sooner does not cut the index short
+    authenticator._save_session("session:abc", "foo", remembered)
+    assert client.ttls == {"session:abc": 100, remembered: 10, index: 100}
+
+    # and one that ends later makes the index last as long as it does
+    authenticator.configuration["session"]["remember"]["ttl"] = 1000
+    authenticator._save_session("session:def", "foo", remembered)
+    assert client.ttls[index] == 1000
+
+
+def test_redis_lookup() -> None:
+    store = RedisSessionStore(host="foo.local")
+    pipeline = FakePipeline([b'{"username": "foo"}', 5000])
+    store.redis = type("Client", (), {"pipeline": lambda self, transaction: pipeline})()
+
+    # the value and how long it has left are read in one round trip
+    assert store.lookup("session:foo") == ('{"username": "foo"}', 5)
+    assert [name for name, _ in pipeline.commands] == ["get", "pttl"]
+    assert pipeline.executed == 1
+
+    pipeline.results = [None, -2]
+    assert store.lookup("session:missing") is None
+
+    # a key that holds something other than a string is not a session
+    def wrong_type() -> None:
+        raise redis.exceptions.ResponseError("WRONGTYPE")
+
+    pipeline.execute = wrong_type  # type: ignore
+    assert store.lookup("session:stream") is None
+
+
+def test_redis_refresh() -> None:
+    store = RedisSessionStore(host="foo.local")
+    pipeline = FakePipeline([1, 0])
+    store.redis = type("Client", (), {"pipeline": lambda self, transaction: pipeline})()
+
+    # every refresh in a batch goes in one round trip
+    store.refresh(["session:foo", "session:bar"], 30)
+    assert [(name, args[2:]) for name, args in pipeline.commands] == [
+        ("eval", ("session:foo", 30)),
+        ("eval", ("session:bar", 30)),
+    ]
+    assert pipeline.executed == 1
+
+
+class RefreshingStore(SessionStore):
+    def __init__(self, sessions: typing.Dict[str, float]) -> None:
+        self.remembered = sessions
+        self.lookups = 0
+        self.refreshes: typing.List[typing.List[str]] = []
+
+    def lookup(self, key: str) -> typing.Optional[Lookup]:
+        self.lookups += 1
+        if key not in self.remembered:
+            return None
+        return Lookup("{}", self.remaining(key))
+
+    def remaining(self, key: str) -> typing.Optional[float]:
+        return self.remembered.get(key)
+
+    def refresh(self, keys: typing.List[str], idle: int) -> None:
+        self.refreshes.append(sorted(keys))
+        for key in keys:
+            self.remembered[key] = idle
+
+
+def test_sliding_store(monkeypatch: pytest.MonkeyPatch) -> None:
+    now = [1000.0]
+    monkeypatch.setattr("time.monotonic", lambda: now[0])
+
+    backend = RefreshingStore({"foo": 250, "bar": 500, "baz": 600})
+    store = SlidingSessionStore(backend, idle=600, interval=60)
+
+    # sessions that have used up more than an interval of their idle time
+    # are refreshed and the rest were refreshed recently by someone else
+    for _ in range(3):
+        assert store.exists("foo")
+        assert store.exists("bar")
+        assert store.exists("baz")
+        assert not store.exists("missing")
+    assert backend.lookups == 12
+    assert store.stats()["refresh"]["pending"] == 2
+
+    # the refreshes are sent together
+    store.flush()
+    assert backend.refreshes == [["bar", "foo"]]
+    assert store.stats()["refresh"] == {"pending": 0, "refreshed": 2, "failures": 0}
+
+    # and each session is looked at again once an interval has passed
+    now[0] += 60
+    backend.remembered["baz"] = 530
+    for key in ("foo", "bar", "baz"):
+        assert store.exists(key)
+    store.close()
+    assert backend.refreshes == [["bar", "foo"], ["baz"]]
+
+
+class UnknownLifetimeStore(RefreshingStore):
+    def remaining(self, key: str) -> typing.Optional[float]:
+        return None
+
+
+def test_sliding_store_unknown_lifetime(monkeypatch: pytest.MonkeyPatch) -> None:
+    now = [1000.0]
+    monkeypatch.setattr("time.monotonic", lambda: now[0])
+
+    backend = UnknownLifetimeStore({"foo": 600})
+    store = SlidingSessionStore(backend, idle=600, interval=60)
+
+    # like memcached, the store cannot say how long a session has left so
+    # each session is refreshed at most once an interval
+    for _ in range(5):
+        assert store.exists("foo")
+        assert not store.exists("missing")
+        store.flush()
+    assert backend.refreshes == [["foo"]]
+
+    now[0] += 60
+    assert store.exists("foo")
+    store.flush()
+    assert backend.refreshes == [["foo"], ["foo"]]
+
+
+def test_sliding_configuration() -> None:
+    session: typing.Dict[str, typing.Any] = {
+        "name": "foobar",
+        "expiry": 3600,
+        "idle": 600,
+    }
+    configuration = {
+        "usernames": {},
+        "duo": {"ikey": "asdf", "skey": "fdsa", "host": "api-1234.example.com"},
+        "cache": {"backend": "sqlite", "path": "sessions.db"},
+        "session": session,
+    }
+    store = checkduo.Authenticator(
+        checkduo.validate_configuration(configuration),
+    ).store
+    assert isinstance(store, SlidingSessionStore)
+    assert store.idle == 600
+    assert store.interval == 60
+
+    # a session has to be idle for longer than the refresh interval
+    session["refresh_interval"] = 600
+    with pytest.raises(checkduo.ConfigurationError):
+        checkduo.validate_configuration(configuration)
+
+
+def test_sliding_only_sessions() -> None:
+    with tempfile.TemporaryDirectory() as t:
+        authenticator = checkduo.Authenticator(
+            checkduo.validate_configuration(
+                {
+                    "usernames": {},
+                    "duo": {
+                        "ikey": "asdf",
+                        "skey": "fdsa",
+                        "host": "api-1234.example.com",
+                    },
+                    "cache": {
+                        "backend": "sqlite",
+                        "path": os.path.join(t, "sessions.db"),
+                    },
+                    "session": {"name": "foobar", "expiry": 3600, "idle": 30},
+                },
+            ),
+        )
+        authenticator._save_session("abc123", "foo")
+        authenticator.store.set(f"{checkduo.CIRCUIT}state", "{}", 360)
+
+        # the idle timeout is for sessions and not for everything else that
+        # is kept in the store, like the circuit breaker
+        store = authenticator.store
+        assert 0 < typing.cast(float, store.remaining("abc123")) <= 30
+        assert typing.cast(float, store.remaining(f"{checkduo.CIRCUIT}state")) > 30
+
+
+class CountingStore(RedisSessionStore):
+    def __init__(self, sessions: typing.Dict[str, float]) -> None:
+        self.remembered = sessions
+        self.calls = 0
+        self.replicas = []
+
+    def lookup(self, key: str) -> typing.Optional[Lookup]:
+        self.calls += 1
+        if key not in self.remembered:
+            return None
+        return Lookup(key, self.remembered[key])
+
+
+def test_caching_store(monkeypatch: pytest.MonkeyPatch) -> None:
+    now = [1000.0]
+    monkeypatch.setattr("time.monotonic", lambda: now[0])
+
+    backend = CountingStore({"session:foo": 30, "session:bar": 300})
+    store = CachingSessionStore(backend, prefix="session:", ttl=60)
+    store._listening.set()
+
+    for _ in range(3):
+        assert store.exists("session:foo")
+        assert not store.exists("session:baz")
+    assert backend.calls == 4
+
+    # what a session was written with is remembered along with it
+    found = store.lookup("session:foo")
+    assert found is not None and found.value == "session:foo"
+    assert backend.calls == 4
+
+    # the local entry never outlives the key in redis
+    now[0] += 30
+    assert store.exists("session:foo")
+    assert backend.calls == 5
+
+    # and never outlives the configured ttl either
+    assert store.exists("session:bar")
+    now[0] += 59
+    assert store.exists("session:bar")
+    assert backend.calls == 6
+    now[0] += 1
+    assert store.exists("session:bar")
+    assert backend.calls == 7
+
+
+def test_caching_store_invalidation() -> None:
+    backend = CountingStore({"session:foo": 30})
+    store = CachingSessionStore(backend, prefix="session:")
+
+    # nothing is remembered unless we are subscribed to invalidations
+    assert store.exists("session:foo")
+    assert store.exists("session:foo")
+    assert backend.calls == 2
+
+    store._listening.set()
+    assert store.exists("session:foo")
+    assert store.exists("session:foo")
+    assert backend.calls == 3
+
+    # a revoked session is forgotten as soon as redis tells us about it
+    del backend.remembered["session:foo"]
+    store.handle(
+        {
+            "type": "pmessage",
+            "pattern": b"__keyspace@0__:session:*",
+            "channel": b"__keyspace@0__:session:foo",
+            "data": b"del",
+        },
+    )
+    assert not store.exists("session:foo")
+    assert store.stats()["hits"] == 1
+
+
+def test_caching_store_invalidated_while_reading() -> None:
+    class RevokedStore(CountingStore):
+        def lookup(self, key: str) -> typing.Optional[Lookup]:
+            found = super().lookup(key)
+            # the session is revoked after redis answered but before the
+            # answer is remembered
+            if self.remembered.pop(key, None) is not None:
+                store.invalidate(key)
+            return found
+
+    backend = RevokedStore({"session:foo": 30})
+    store = CachingSessionStore(backend, prefix="session:")
+    store._listening.set()
+
+    assert store.exists("session:foo")
+    assert not store.exists("session:foo")
+    assert store.stats()["size"] == 0
+
+
+def test_caching_store_close() -> None:
+    class FakePubSub:
+        def __init__(self) -> None:
+            self.closed = threading.Event()
+
+        def psubscribe(self, pattern: str) -> None:
+            pass
+
+        def listen(self) -> typing.Iterator[dict]:
+            self.closed.wait(5)
+            raise ConnectionError("closed")
+
+        def close(self) -> None:
+            self.closed.set()
+
+    class FakeRedis:
+        def pubsub(self, **kwargs: typing.Any) -> FakePubSub:
+            return pubsub
+
+        def close(self) -> None:
+            pass
+
+    pubsub = FakePubSub()
+    backend = CountingStore({"session:foo": 30})
+    backend.redis = FakeRedis()  # type: ignore
+
+    store = CachingSessionStore(backend, prefix="session:")
+    store.start()
+    for _ in range(100):
+        if store._listening.is_set():
+            break
+        time.sleep(0.01)
+    assert store.stats()["listening"]
+
+    # a closed store stops listening and so stops remembering sessions
+    store.close()
+    assert pubsub.closed.is_set()
+    for _ in range(100):
+        if not store._listening.is_set():
+            break
+        time.sleep(0.01)
+    assert not store.stats()["listening"]
+
+
+def test_create_caching_store() -> None:
+    store = create_session_store(
+        {"host": "foo.local", "db": 3, "prefix": "session:", "local": {"size": 10}},
+    )
+    assert isinstance(store, CachingSessionStore)
+    assert store.channel == "__keyspace@3__:session:*"
+    assert store.size == 10
+
+
+def test_claim_get_delete() -> None:
+    with tempfile.TemporaryDirectory() as t, FakeMemcached() as server:
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        stores: typing.List[SessionStore] = [
+            SQLiteSessionStore(os.path.join(t, "sessions.db")),
+            MemcachedSessionStore("127.0.0.1", server.server_address[1]),
+        ]
+        for store in stores:
+            assert store.get("foo") is None
+            assert store.claim("foo", "first", 10)
+            assert not store.claim("foo", "second", 10)
+            assert store.get("foo") == "first"
+
+            store.delete("foo")
+            assert store.get("foo") is None
+            assert store.claim("foo", "third", 10)
+            assert store.get("foo") == "third"
+
+        server.shutdown()
+
+
+def test_lookup() -> None:
+    with tempfile.TemporaryDirectory() as t, FakeMemcached() as server:
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        sqlite = SQLiteSessionStore(os.path.join(t, "sessions.db"))
+        memcached = MemcachedSessionStore("127.0.0.1", server.server_address[1])
+        for store in (sqlite, memcached):
+            store.set("foo", '{"username": "foo"}', 10)
+            assert store.lookup("missing") is None
+
+        found = sqlite.lookup("foo")
+        assert found is not None
+        assert found.value == '{"username": "foo"}'
+        assert found.remaining is not None and 9 < found.remaining <= 10
+
+        # memcached cannot say how long a session has left
+        assert memcached.lookup("foo") == ('{"username": "foo"}', None)
+
+        server.shutdown()
@@ -0,0 +1,120 @@
+import json
+import os
+import tempfile
+import threading
+
+import pytest
+
+from checkduo import checkduo, users
+from tests.conftest import PASSWORD_HASH
+
+
+def test_directory_lookups() -> None:
+    with tempfile.TemporaryDirectory() as t:
+        path = os.path.join(t, "users.db")
+        users.build(path, {"foo": PASSWORD_HASH, "bar": None})
+
+        directory = users.UserDirectory(path)
+        assert "foo" in directory
+        assert "bar" in directory
+        assert "baz" not in directory
+        assert directory["foo"] == PASSWORD_HASH
+        assert directory["bar"] is None
+        with pytest.raises(KeyError):
+            directory["baz"]  # noqa: B018
+        assert sorted(directory) == ["bar", "foo"]
+        assert len(directory) == 2
+
+
+def test_directory_is_rebuilt_in_place() -> None:
+    with tempfile.TemporaryDirectory() as t:
+        path = os.path.join(t, "users.db")
+        users.build(path, {"foo": PASSWORD_HASH})
+
+        directory = users.UserDirectory(path)
+        assert "foo" in directory
+
+        # a long running process picks up the new file without restarting
+        users.build(path, {"bar": PASSWORD_HASH})
+        assert "foo" not in directory
+        assert "bar" in directory
+
+        # and every thread gets its own connection
+        found = []
+        thread = threading.Thread(target=lambda: found.append("bar" in directory))
+        thread.start()
+        thread.join()
+        assert found == [True]
+
+
+def test_missing_directory() -> None:
+    with tempfile.TemporaryDirectory() as t:
+        directory = users.UserDirectory(os.path.join(t, "users.db"))
+        with pytest.raises(users.UserDirectoryError):
+            "foo" in directory  # noqa: B015
+
+        # a missing directory is never created by looking things up in it
+        assert not os.path.exists(os.path.join(t, "users.db"))
+
+
+def test_read_sources() -> None:
+    with tempfile.TemporaryDirectory() as t:
+        configuration_path = os.path.join(t, "configuration.json")
+        with open(configuration_path, "wt", encoding="utf8") as f:
+            json.dump({"usernames": {" foo ": f" {PASSWORD_HASH} ", "bar": None}}, f)
+
+        htpasswd_path = os.path.join(t, "htpasswd")
+        with open(htpasswd_path, "wt", encoding="utf8") as f:
+            f.write(f"# a comment\n\nbaz:{PASSWORD_HASH}\nqux:\n")
+
+        assert users.read_configuration_usernames(configuration_path) == {
+            "foo": PASSWORD_HASH,
+            "bar": None,
+        }
+        assert users.read_htpasswd(htpasswd_path) == {
+            "baz": PASSWORD_HASH,
+            "qux": None,
+        }
+
+        with open(htpasswd_path, "at", encoding="utf8") as f:
+            f.write("nonsense\n")
+        with pytest.raises(users.UserDirectoryError):
+            users.read_htpasswd(htpasswd_path)
+
+
+def test_authenticator_uses_directory() -> None:
+    with tempfile.TemporaryDirectory() as t:
+        path = os.path.join(t, "users.db")
+        users.build(path, {"foo": PASSWORD_HASH, "bar": PASSWORD_HASH})
+
+        configuration = checkduo.validate_configuration(
+            {
+                "usernames": {"bar": None},
+                "user_directory": {"path": path},
+                "duo": {"ikey": "asdf", "skey": "fdsa", "host": "api-1234.example.com"},
+                "cache": {"backend": "sqlite", "path": os.path.join(t, "sessions.db")},
+                "session": {"name": "foobar", "expiry": 10},
+            },
+        )
+        authenticator = checkduo.Authenticator(configuration)
+        environment = {"IP": "127.0.0.1", "CONTEXT": "login"}
+
+        assert authenticator.authenticate("foo", "password", environment) == 0
+        assert authenticator.authenticate("foo", "wrong", environment) == 1
+        assert authenticator.authenticate("baz", "password", environment) == 1
+
+        # users in the configuration take priority over the directory
+        assert authenticator.authenticate("bar", "password", environment) == 1
+
+
+def test_usernames_are_optional_with_a_directory() -> None:
+    configuration = checkduo.validate_configuration(
+        {
+            "user_directory": {"path": "/var/lib/check-duo/users.db"},
+            "duo": {"ikey": "asdf", "skey": "fdsa", "host": "api-1234.example.com"},
+            "cache": {"host": "localhost"},
+            "session": {"name": "foobar", "expiry": 10},
+        },
+    )
+    assert configuration["usernames"] == {}
+    assert isinstance(checkduo.load_usernames(configuration), users.UserDirectory)